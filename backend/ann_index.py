@@ -0,0 +1,521 @@
+import os
+import threading
+import numpy as np
+import config
+from gallery_index import GalleryIndex, ENCODING_SIZE
+from gallery_snapshot import SnapshotGallery
+
+# hnswlib is optional - the HNSW backend is only available when it is installed
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# Galleries smaller than this are searched exhaustively (a single list)
+MIN_TRAIN_SIZE = 2048
+
+# Points sampled per list when training the IVF coarse quantizer
+TRAIN_POINTS_PER_LIST = 64
+
+# Neighbours fetched from HNSW when the caller does not ask for a top-k
+HNSW_DEFAULT_K = 32
+
+def _auto_nlist(size):
+
+    return max(1, int(4 * np.sqrt(size)))
+
+def _nearest_centroids(points, centroids, count=1, chunk_size=65536):
+
+    # Squared distances up to a per-row constant: ||c||^2 - 2 x.c
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    nearest = np.empty((len(points), count), dtype=np.int64)
+
+    for start in range(0, len(points), chunk_size):
+        block = points[start:start + chunk_size]
+        scores = centroid_norms[None, :] - 2.0 * (block @ centroids.T)
+        if count == 1:
+            nearest[start:start + len(block), 0] = np.argmin(scores, axis=1)
+        else:
+            top = np.argpartition(scores, count - 1, axis=1)[:, :count]
+            order = np.argsort(np.take_along_axis(scores, top, axis=1), axis=1)
+            nearest[start:start + len(block)] = np.take_along_axis(top, order, axis=1)
+
+    return nearest
+
+def train_kmeans(points, k, iterations=10, seed=0):
+
+    rng = np.random.default_rng(seed)
+    points = np.asarray(points, dtype=np.float32)
+
+    # Train on a sample - the quantizer does not need every point
+    sample_size = min(len(points), k * TRAIN_POINTS_PER_LIST)
+    sample = points[rng.choice(len(points), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = _nearest_centroids(sample, centroids)[:, 0]
+        counts = np.bincount(assignment, minlength=k)
+
+        # Per-list sums via one sort + reduceat instead of a scatter-add
+        order = np.argsort(assignment, kind='stable')
+        filled_lists = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts[filled_lists])[:-1]))
+        sums = np.zeros_like(centroids)
+        sums[filled_lists] = np.add.reduceat(sample[order], starts, axis=0)
+
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+
+        # Re-seed empty lists from random sample points
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+
+    return centroids
+
+def _save_npz(path, **arrays):
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # Write to a temporary file and swap it in so readers never see a partial index
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+class IVFFlatIndex:
+    # Inverted-file index: a k-means coarse quantizer splits the gallery into
+    # lists and each query scans only the nprobe lists nearest to it.
+    # Every list is a GalleryIndex, so the scan itself stays one BLAS call.
+
+    persistent = True
+
+    def __init__(self, nlist=0, nprobe=8):
+        self._lock = threading.RLock()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.loaded = False
+        self._reset(None)
+
+    def _reset(self, centroids):
+        self._centroids = centroids
+        list_count = 1 if centroids is None else len(centroids)
+        self._lists = [GalleryIndex(initial_capacity=16) for _ in range(list_count)]
+        # person_name -> {face_id: list_no} and face_id -> person_name
+        self._person_faces = {}
+        self._face_persons = {}
+
+    def __len__(self):
+        return sum(len(inverted_list) for inverted_list in self._lists)
+
+    @property
+    def trained(self):
+        return self._centroids is not None
+
+    def _assign(self, encodings):
+        if self._centroids is None:
+            return np.zeros(len(encodings), dtype=np.int64)
+        return _nearest_centroids(encodings, self._centroids)[:, 0]
+
+    def _insert(self, entries, assignment):
+        grouped = {}
+        for entry, list_no in zip(entries, assignment):
+            grouped.setdefault(int(list_no), []).append(entry)
+            person_name, face_id, _ = entry
+            self._person_faces.setdefault(person_name, {})[face_id] = int(list_no)
+            self._face_persons[face_id] = person_name
+
+        for list_no, list_entries in grouped.items():
+            self._lists[list_no].add_many(list_entries)
+
+    def _train_if_due(self):
+        # A gallery that started below MIN_TRAIN_SIZE is one exhaustive list.
+        # Train the quantizer once it has grown past that, whether through
+        # adds or a persisted untrained index, so it does not stay one list
+        if self._centroids is not None or len(self) < MIN_TRAIN_SIZE:
+            return
+
+        encodings, labels, face_ids = self._lists[0].export()
+        entries = list(zip(labels.tolist(), face_ids.tolist(), encodings))
+        nlist = self.nlist or _auto_nlist(len(entries))
+        centroids = train_kmeans(encodings, min(nlist, len(entries)))
+
+        self._reset(centroids)
+        self._insert(entries, self._assign(encodings))
+
+    def load(self, entries):
+        # Rebuild from (person_name, face_id, encoding) entries, retraining the quantizer
+        entries = list(entries)
+        encodings = np.asarray([encoding for _, _, encoding in entries], dtype=np.float32)
+        encodings = encodings.reshape(-1, ENCODING_SIZE)
+
+        with self._lock:
+            centroids = None
+            if len(entries) >= MIN_TRAIN_SIZE:
+                nlist = self.nlist or _auto_nlist(len(entries))
+                centroids = train_kmeans(encodings, min(nlist, len(entries)))
+
+            self._reset(centroids)
+            self._insert(entries, self._assign(encodings))
+            self.loaded = True
+
+    def add(self, person_name, face_id, face_encoding):
+
+        self.add_many([(person_name, face_id, face_encoding)])
+
+    def add_many(self, entries):
+
+        entries = list(entries)
+        if not entries:
+            return
+
+        encodings = np.asarray([encoding for _, _, encoding in entries], dtype=np.float32)
+        with self._lock:
+            self._insert(entries, self._assign(encodings.reshape(-1, ENCODING_SIZE)))
+            self._train_if_due()
+
+    def replace(self, face_id, entry):
+
+        # Overwrite a stored face in place when it stays in its inverted list,
+        # otherwise move it to the list nearest its new encoding
+        person_name, new_face_id, face_encoding = entry
+        encoding = np.asarray(face_encoding, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+
+        with self._lock:
+            old_person_name = self._face_persons.pop(face_id, None)
+            if old_person_name is None:
+                return 0
+
+            faces = self._person_faces[old_person_name]
+            list_no = faces.pop(face_id)
+            if not faces:
+                del self._person_faces[old_person_name]
+
+            new_list_no = int(self._assign(encoding)[0])
+            if new_list_no == list_no:
+                self._lists[list_no].replace(face_id, entry)
+                self._person_faces.setdefault(person_name, {})[new_face_id] = list_no
+                self._face_persons[new_face_id] = person_name
+            else:
+                self._lists[list_no].remove_face(face_id)
+                self._insert([entry], [new_list_no])
+            return 1
+
+    def remove_person(self, person_name):
+
+        with self._lock:
+            faces = self._person_faces.pop(person_name, {})
+            for face_id in faces:
+                self._face_persons.pop(face_id, None)
+
+            removed = 0
+            for list_no in set(faces.values()):
+                removed += self._lists[list_no].remove_person(person_name)
+            return removed
+
+    def remove_face(self, face_id):
+
+        with self._lock:
+            person_name = self._face_persons.pop(face_id, None)
+            if person_name is None:
+                return 0
+
+            faces = self._person_faces[person_name]
+            list_no = faces.pop(face_id)
+            if not faces:
+                del self._person_faces[person_name]
+            return self._lists[list_no].remove_face(face_id)
+
+    def clear(self):
+
+        with self._lock:
+            # Keep the trained quantizer - only the contents go away
+            self._reset(self._centroids)
+
+    def face_ids(self):
+
+        return set(self._face_persons)
+
+    def search_batch(self, face_encodings, threshold=0.6, top_k=None):
+
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        results = [[] for _ in range(len(queries))]
+
+        with self._lock:
+            centroids = self._centroids
+            lists = list(self._lists)
+
+        if centroids is None:
+            probes = np.zeros((len(queries), 1), dtype=np.int64)
+        else:
+            nprobe = min(self.nprobe, len(centroids))
+            probes = _nearest_centroids(queries, centroids, nprobe)
+
+        # Group queries by list so every probed list is scanned once per batch
+        by_list = {}
+        for query_no, query_probes in enumerate(probes):
+            for list_no in query_probes:
+                by_list.setdefault(int(list_no), []).append(query_no)
+
+        for list_no, query_nos in by_list.items():
+            list_results = lists[list_no].search_batch(queries[query_nos], threshold, top_k)
+            for query_no, matches in zip(query_nos, list_results):
+                results[query_no].extend(matches)
+
+        for query_no, matches in enumerate(results):
+            matches.sort(key=lambda match: match[2])
+            if top_k is not None:
+                del matches[top_k:]
+
+        return results
+
+    def search(self, face_encoding, threshold=0.6, top_k=None):
+
+        return self.search_batch([face_encoding], threshold, top_k)[0]
+
+    def save(self, path):
+
+        with self._lock:
+            exported = [inverted_list.export() for inverted_list in self._lists]
+            centroids = self._centroids
+
+        encodings = [encodings for encodings, _, _ in exported]
+        assignment = [np.full(len(labels), list_no, dtype=np.int64)
+                      for list_no, (_, labels, _) in enumerate(exported)]
+
+        _save_npz(
+            path,
+            kind=np.array('ivf'),
+            centroids=centroids if centroids is not None else np.zeros((0, ENCODING_SIZE), dtype=np.float32),
+            encodings=np.concatenate(encodings) if encodings else np.zeros((0, ENCODING_SIZE), dtype=np.float32),
+            labels=np.array([str(label) for _, labels, _ in exported for label in labels]),
+            face_ids=np.array([str(face_id) for _, _, face_ids in exported for face_id in face_ids]),
+            assignment=np.concatenate(assignment) if assignment else np.zeros(0, dtype=np.int64)
+        )
+
+    def load_file(self, path):
+
+        data = np.load(path, allow_pickle=False)
+        if str(data['kind']) != 'ivf':
+            raise ValueError(f"{path} does not hold an ivf index")
+        centroids = data['centroids'] if len(data['centroids']) else None
+        entries = list(zip(data['labels'].tolist(), data['face_ids'].tolist(), data['encodings']))
+
+        with self._lock:
+            # Reuse the stored quantizer and list assignment - no retraining,
+            # unless the index was saved untrained and has since grown
+            self._reset(centroids)
+            self._insert(entries, data['assignment'])
+            self._train_if_due()
+            self.loaded = True
+
+class HNSWIndex:
+    # Hierarchical navigable small-world graph backed by hnswlib.
+    # Deletes are tombstones that hnswlib reuses for later inserts.
+
+    persistent = True
+
+    def __init__(self, m=16, ef_construction=200, ef_search=64):
+        if hnswlib is None:
+            raise RuntimeError("The hnsw match index requires the hnswlib package")
+
+        self._lock = threading.RLock()
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.loaded = False
+        self._reset(1024)
+
+    def _reset(self, capacity):
+        self._index = hnswlib.Index(space='l2', dim=ENCODING_SIZE)
+        self._index.init_index(
+            max_elements=capacity,
+            ef_construction=self.ef_construction,
+            M=self.m,
+            allow_replace_deleted=True
+        )
+        self._index.set_ef(self.ef_search)
+        self._labels = {}
+        self._face_ids = {}
+        self._next_id = 0
+        self._free_ids = []
+
+    def __len__(self):
+        return len(self._face_ids)
+
+    def _insert(self, entries):
+        if not entries:
+            return
+
+        needed = len(self._face_ids) + len(entries)
+        if needed > self._index.get_max_elements():
+            self._index.resize_index(max(needed, 2 * self._index.get_max_elements()))
+
+        ids = []
+        for person_name, face_id, _ in entries:
+            if self._free_ids:
+                item_id = self._free_ids.pop()
+            else:
+                item_id = self._next_id
+                self._next_id += 1
+            ids.append(item_id)
+            self._labels[item_id] = (person_name, face_id)
+            self._face_ids[face_id] = item_id
+
+        encodings = np.asarray([encoding for _, _, encoding in entries], dtype=np.float32)
+        self._index.add_items(encodings.reshape(-1, ENCODING_SIZE), np.asarray(ids), replace_deleted=True)
+
+    def load(self, entries):
+
+        entries = list(entries)
+        with self._lock:
+            self._reset(max(1024, len(entries)))
+            self._insert(entries)
+            self.loaded = True
+
+    def add(self, person_name, face_id, face_encoding):
+
+        self.add_many([(person_name, face_id, face_encoding)])
+
+    def add_many(self, entries):
+
+        with self._lock:
+            self._insert(list(entries))
+
+    def _delete_ids(self, item_ids):
+        for item_id in item_ids:
+            _, face_id = self._labels.pop(item_id)
+            del self._face_ids[face_id]
+            self._index.mark_deleted(item_id)
+            self._free_ids.append(item_id)
+        return len(item_ids)
+
+    def replace(self, face_id, entry):
+
+        # hnswlib updates an element added again under its label in place
+        person_name, new_face_id, face_encoding = entry
+
+        with self._lock:
+            item_id = self._face_ids.pop(face_id, None)
+            if item_id is None:
+                return 0
+
+            self._labels[item_id] = (person_name, new_face_id)
+            self._face_ids[new_face_id] = item_id
+            encoding = np.asarray(face_encoding, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+            self._index.add_items(encoding, np.asarray([item_id]))
+            return 1
+
+    def remove_person(self, person_name):
+
+        with self._lock:
+            item_ids = [item_id for item_id, (name, _) in self._labels.items() if name == person_name]
+            return self._delete_ids(item_ids)
+
+    def remove_face(self, face_id):
+
+        with self._lock:
+            item_id = self._face_ids.get(face_id)
+            return self._delete_ids([item_id]) if item_id is not None else 0
+
+    def clear(self):
+
+        with self._lock:
+            self._reset(1024)
+
+    def face_ids(self):
+
+        return set(self._face_ids)
+
+    def search_batch(self, face_encodings, threshold=0.6, top_k=None):
+
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+
+        with self._lock:
+            k = min(top_k or HNSW_DEFAULT_K, len(self._face_ids))
+            if k == 0 or len(queries) == 0:
+                return [[] for _ in range(len(queries))]
+
+            item_ids, sq_distances = self._index.knn_query(queries, k=k)
+            labels = dict(self._labels)
+
+        results = []
+        for row_ids, row_distances in zip(item_ids, sq_distances):
+            matches = []
+            for item_id, sq_distance in zip(row_ids, row_distances):
+                distance = float(np.sqrt(max(sq_distance, 0.0)))
+                if distance < threshold and int(item_id) in labels:
+                    person_name, face_id = labels[int(item_id)]
+                    matches.append((person_name, face_id, distance))
+            results.append(matches)
+
+        return results
+
+    def search(self, face_encoding, threshold=0.6, top_k=None):
+
+        return self.search_batch([face_encoding], threshold, top_k)[0]
+
+    def save(self, path):
+
+        with self._lock:
+            graph_path = f"{path}.hnsw"
+            self._index.save_index(f"{graph_path}.tmp")
+            os.replace(f"{graph_path}.tmp", graph_path)
+
+            item_ids = sorted(self._labels)
+            _save_npz(
+                path,
+                kind=np.array('hnsw'),
+                item_ids=np.asarray(item_ids, dtype=np.int64),
+                labels=np.array([str(self._labels[i][0]) for i in item_ids]),
+                face_ids=np.array([str(self._labels[i][1]) for i in item_ids]),
+                free_ids=np.asarray(self._free_ids, dtype=np.int64),
+                next_id=np.array(self._next_id)
+            )
+
+    def load_file(self, path):
+
+        data = np.load(path, allow_pickle=False)
+        if str(data['kind']) != 'hnsw':
+            raise ValueError(f"{path} does not hold an hnsw index")
+
+        with self._lock:
+            self._reset(1024)
+            self._index.load_index(f"{path}.hnsw", allow_replace_deleted=True)
+            self._index.set_ef(self.ef_search)
+
+            for item_id, person_name, face_id in zip(data['item_ids'].tolist(),
+                                                    data['labels'].tolist(),
+                                                    data['face_ids'].tolist()):
+                self._labels[item_id] = (person_name, face_id)
+                self._face_ids[face_id] = item_id
+            self._free_ids = data['free_ids'].tolist()
+            self._next_id = int(data['next_id'])
+            self.loaded = True
+
+def create_gallery_index(kind=None, **options):
+
+    kind = kind or config.MATCH_INDEX
+
+    if kind == 'exact':
+        return GalleryIndex()
+    if kind == 'snapshot':
+        return SnapshotGallery(
+            options.get('directory', config.GALLERY_SNAPSHOT_DIR),
+            options.get('publish_delay', config.GALLERY_SNAPSHOT_DELAY)
+        )
+    if kind == 'ivf':
+        return IVFFlatIndex(
+            nlist=options.get('nlist', config.ANN_NLIST),
+            nprobe=options.get('nprobe', config.ANN_NPROBE)
+        )
+    if kind == 'hnsw':
+        return HNSWIndex(
+            m=options.get('m', config.ANN_HNSW_M),
+            ef_construction=options.get('ef_construction', config.ANN_HNSW_EF_CONSTRUCTION),
+            ef_search=options.get('ef_search', config.ANN_HNSW_EF_SEARCH)
+        )
+
+    raise ValueError(f"Unknown match index: {kind}")
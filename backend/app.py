@@ -1,180 +1,933 @@
+import time
 import uuid
+import atexit
+import logging
+import zipfile
 import face_recognition
 import numpy as np
 import os
-from flask import Flask, request, jsonify
+import tempfile
+from flask import Blueprint, Flask, Response, copy_current_request_context, current_app, g, request, jsonify, url_for
 from flask_cors import CORS
 from PIL import Image
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import config
 import database as db
+import detection
+import engine
+import metrics
+import near_duplicate
+import retention
+import video
+from debug_capture import debug_capture
+from jobs import JobFailed, JobQueueFull, jobs, upload_jobs
 from datetime import datetime
 
-# Initialize Flask application
-app = Flask(__name__)
-CORS(app)  # Enable Cross-Origin Resource Sharing
+logger = logging.getLogger(__name__)
 
-# API endpoint to get all persons
-@app.route('/api/persons', methods=['GET'])
+# All endpoints live on this blueprint; create_app() builds the application
+api = Blueprint('api', __name__)
+
+metrics.register_gauge('face_gallery_size', 'Encodings in the in-memory gallery index', lambda: len(db.gallery))
+metrics.register_gauge('face_gallery_generation', 'Last gallery change applied to this process',
+                       lambda: db.gallery_sync.generation)
+
+# Prometheus metrics: per-stage upload latency histograms, face counters and gauges
+@api.route('/metrics', methods=['GET'])
+def api_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+# API endpoint reporting this process's gallery index and how far it trails
+# the gallery change log
+@api.route('/api/gallery', methods=['GET'])
+def api_gallery_status():
+    
+    # ?sync=1 applies the pending changes first
+    if request.args.get('sync') and db.gallery.loaded:
+        db.gallery_sync.poll(force=True)
+    
+    latest = db.store.gallery_generation()
+    return jsonify({
+        "loaded": db.gallery.loaded,
+        "size": len(db.gallery) if db.gallery.loaded else 0,
+        "generation": db.gallery_sync.generation,
+        "latest_generation": latest,
+        "behind": db.gallery_sync.behind(latest) if db.gallery_sync.enabled else 0,
+        "sync_interval": db.gallery_sync.interval
+    })
+
+def conditional_listing(etag, build):
+    
+    # Answer If-None-Match with a 304 before the listing is read. Listings are
+    # marked no-cache, so browsers revalidate every fetch and a refetch after
+    # an action that changed nothing costs a round trip without a body
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# API endpoint to get all persons (and all unrecognized face ids) at once;
+# the paginated listings below scale to large galleries
+@api.route('/api/persons', methods=['GET'])
 def api_get_persons():
-    return jsonify(db.get_all_persons())
+    
+    _, unrecognized_etag = db.unrecognized_state()
+    return conditional_listing(f"{db.persons_etag()}-{unrecognized_etag}", db.get_all_persons)
+
+# API endpoint to get one page of persons by name, with their face counts.
+# ?prefix= keeps only names starting with it (case-sensitive)
+@api.route('/api/persons/page', methods=['GET'])
+def api_get_persons_page():
+    
+    prefix = request.args.get('prefix', '')
+    cursor = request.args.get('cursor') or None
+    limit = request.args.get('limit', db.LISTING_PAGE_SIZE, type=int)
+    
+    return conditional_listing(db.persons_etag(), lambda: db.get_persons_page(prefix, cursor, limit))
+
+# API endpoint to get one page of unrecognized faces, newest first
+@api.route('/api/unrecognized', methods=['GET'])
+def api_get_unrecognized():
+    
+    cursor = request.args.get('cursor') or None
+    if cursor and not db.valid_unrecognized_id(cursor):
+        return jsonify({"error": "Invalid cursor"}), 400
+    
+    limit = request.args.get('limit', db.LISTING_PAGE_SIZE, type=int)
+    total, etag = db.unrecognized_state()
+    
+    def build():
+        page = db.get_unrecognized_page(cursor, limit)
+        for face in page['faces']:
+            face['face_image_url'] = url_for('api.api_face_image', face_id=face['face_id'], _external=True)
+        page['total'] = total
+        return page
+    
+    return conditional_listing(etag, build)
+
+# API endpoint to list a person's faces as links to their images
+@api.route('/api/person/<person_name>/faces', methods=['GET'])
+def api_get_person_faces(person_name):
+    
+    if not db.person_exists(person_name):
+        return jsonify({"error": f"Person not found: {person_name}"}), 404
+    
+    return jsonify({
+        "person": person_name,
+        "faces": [
+            {"id": face_id, "face_image_url": url_for('api.api_face_image', face_id=face_id, _external=True)}
+            for face_id in db.get_person_faces(person_name)
+        ]
+    })
 
-# API endpoint to get history data
-@app.route('/api/history', methods=['GET'])
+# API endpoint to get one page of history events of a type, newest first
+@api.route('/api/history', methods=['GET'])
 def api_get_history():
-    return jsonify(db.get_history())
+    
+    event_type = request.args.get('type', 'upload')
+    if event_type not in db.HISTORY_EVENT_TYPES:
+        return jsonify({"error": f"Unknown history type: {event_type}"}), 400
+    
+    cursor = request.args.get('cursor')
+    if cursor and not db.valid_history_id(cursor):
+        return jsonify({"error": "Invalid cursor"}), 400
+    
+    limit = request.args.get('limit', db.HISTORY_PAGE_SIZE, type=int)
+    
+    return jsonify(db.get_history(event_type, cursor, limit))
 
-# API endpoint to save history data
-@app.route('/api/history', methods=['POST'])
-def api_save_history():
-    try:
-        data = request.json
-        if not data:
-            return jsonify({"error": "No data provided"}), 400
+# API endpoint to delete a single history event
+@api.route('/api/history/delete', methods=['POST'])
+def api_delete_history_event():
+    
+    data = request.json
+    
+    if not data or 'id' not in data:
+        return jsonify({"error": "Missing required fields"}), 400
+    
+    if not db.valid_history_id(data['id']):
+        return jsonify({"error": "Invalid history event id"}), 400
+    
+    if not db.delete_history_event(data['id']):
+        return jsonify({"error": "History event not found"}), 404
+    
+    return jsonify({"message": "History event deleted", "id": data['id']})
+
+# API endpoint to get the stored image of a face
+@api.route('/api/face/<face_id>/image', methods=['GET'])
+def api_face_image(face_id):
+    
+    image = db.get_face_image(face_id)
+    
+    if image is None:
+        return jsonify({"error": "Face not found"}), 404
+    
+    img_bytes, etag = image
+    
+    # A face id always names the same image, so browsers may keep it for long
+    # and revalidate with If-None-Match (answered with 304 and no body)
+    response = Response(img_bytes, mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"public, max-age={config.FACE_IMAGE_MAX_AGE}, immutable"
+    
+    return response.make_conditional(request)
+
+def response_images_as_urls():
+    
+    # ?images=url|base64 overrides FACE_RESPONSE_IMAGES for this request
+    return request.args.get('images', config.RESPONSE_IMAGES) == 'url'
+
+def face_image_fields(face_id, face_image_base64):
+    
+    # The crop inline as a data URI, or a link to the stored image of face_id
+    if face_image_base64 is None:
+        return {"face_image_url": url_for('api.api_face_image', face_id=face_id, _external=True)}
+    
+    return {"face_image": face_image_base64}
+
+def stored_dupe(stored_id, face_id, file_id):
+    
+    # add_face_to_person found the person's image stored by a concurrent
+    # request: drop the image just saved and refer to the stored copy
+    if stored_id == face_id:
+        return None
+    db.delete_files([file_id])
+    return stored_id
+
+def busy_response():
+    
+    # Backpressure: the detection workers are saturated, ask the client to retry
+    response = jsonify({"error": "Server is busy processing other images, please retry"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def start_stage_timer(endpoint):
+    
+    # Times the stages of this request; finish_stage_timer records them once it is answered
+    g.stage_timer = metrics.StageTimer(endpoint)
+    return g.stage_timer
+
+def record_engine_timings(timer, job, elapsed):
+    
+    # Worker time is split into detect and encode; the rest of the wait is
+    # queueing for a worker plus moving the image to and from it. Results
+    # from the detection cache only count the lookup
+    if job.get("cached"):
+        timer.record("cache", elapsed)
+        return
+    
+    timings = job.get("timings", {})
+    for stage, seconds in timings.items():
+        timer.record(stage, seconds)
+    timer.record("queue", max(0.0, elapsed - sum(timings.values())))
+
+@api.after_request
+def finish_stage_timer(response):
+    
+    timer = g.pop('stage_timer', None)
+    if timer is None:
+        return response
+    
+    total = timer.finish(response.status_code)
+    
+    # Per-request profiling: send 'X-Profile: 1' to get the stage breakdown back
+    if config.PROFILE_HEADER and request.headers.get('X-Profile') == '1':
+        response.headers['Server-Timing'] = f"{timer.server_timing()}, total;dur={total * 1000:.1f}"
+    
+    return response
+
+def process_upload(img, filename, timer, images_as_urls, block=False, progress=None, emit=None, cache_key=None):
+    
+    # Detects, matches and stores the faces of one image and returns the
+    # response body and status. block waits for a free detection worker
+    # instead of raising EngineBusy; emit(event, data) streams a 'detected'
+    # event and then each face's result as soon as it is stored. A repeated
+    # image with a cache_key reuses its earlier detections
+    
+    # Debug: Capture sampled uploads in the background (off by default)
+    debug_prefix = debug_capture.sample()
+    if debug_prefix:
+        debug_capture.save(img, [], f"original_{debug_prefix}.jpg")
+    
+    # Detect, filter and encode faces on the worker pool
+    submitted = time.perf_counter()
+    future = engine.get_engine().submit(img, block=block, timeout=config.ENGINE_TIMEOUT, cache_key=cache_key)
+    job = future.result(timeout=config.ENGINE_TIMEOUT)
+    record_engine_timings(timer, job, time.perf_counter() - submitted)
+    face_locations = job["face_locations"]
+    
+    filtered_face_locations = job["filtered_face_locations"]
+    
+    # Debug: Capture all detected faces and the faces kept after filtering
+    if debug_prefix:
+        debug_capture.save(img, face_locations, f"all_faces_{debug_prefix}.jpg")
+        debug_capture.save(img, filtered_face_locations, f"filtered_faces_{debug_prefix}.jpg")
+    
+    logger.debug("Original faces: %d, Filtered faces: %d", len(face_locations), len(filtered_face_locations))
+    metrics.faces_total.inc(len(face_locations), outcome='detected')
+    metrics.faces_total.inc(len(face_locations) - len(filtered_face_locations), outcome='filtered')
+    
+    if not filtered_face_locations:
+        return {"error": "No valid faces detected in the image"}, 400
+    
+    if progress:
+        progress(0, len(filtered_face_locations))
+    if emit:
+        emit("detected", {"faces": len(filtered_face_locations), "face_positions": filtered_face_locations})
+    
+    # Face encodings for the filtered faces
+    face_encodings = job["face_encodings"]
+    
+    results = []
+    # Faces not stored because the person already has the same or a near-identical image
+    suppressed = 0
+    # History records reference stored faces - a suppressed face refers to the stored copy
+    history_faces = []
+    history_events = []
+
+    # Match every face of the image in one batched distance query
+    with timer.stage('match'):
+        all_matches = db.find_person_matches_batch(face_encodings)
+    
+    # Process each detected face
+    for i, (face_encoding, face_location, matches) in enumerate(zip(face_encodings, filtered_face_locations, all_matches)):
+        # Sort matches by confidence (highest first)
+        matches = sorted(matches, key=lambda x: x["confidence"], reverse=True)
+        
+        with timer.stage('prepare'):
+            # Crop the face from the image
+            face_image = detection.crop_face(img, face_location)
             
-        success = db.save_history(data)
+            # Prepare image for storage
+            img_bytes, face_image_base64 = db.prepare_image_for_storage(face_image, not images_as_urls)
+            img_hash = db.image_hash(img_bytes)
+            phash = near_duplicate.dhash(face_image)
         
-        if success:
-            return jsonify({"message": "History saved successfully"})
+        # Generate a unique ID for this face
+        face_id = str(uuid.uuid4())
+        
+        # Process based on whether we have a good match
+        if matches and matches[0]["confidence"] > 60:  # Confidence threshold
+            # We have a match with good confidence
+            best_match = matches[0]
+            person_name = best_match["name"]
+            confidence = best_match["confidence"]
+            metrics.faces_total.inc(outcome='matched')
+            
+            # Check if this image, or a near-identical one, is already stored for the person
+            with timer.stage('duplicates'):
+                duplicate_of = (db.find_duplicate_image(person_name, img_hash)
+                                or db.find_near_duplicate(person_name, face_encoding, phash))
+            
+            if duplicate_of is None:
+                with timer.stage('store'):
+                    # Save face image to GridFS only if it's not a duplicate
+                    file_id = db.save_face_image(img_bytes, face_id, img_hash, phash)
+                    
+                    # Store face info in MongoDB
+                    stored_id = db.add_face_to_person(person_name, face_id, file_id, face_encoding.tolist(), img_hash, phash)
+                    duplicate_of = stored_dupe(stored_id, face_id, file_id)
+            
+            if duplicate_of is None:
+                history_events.append({"type": "recognized", "person_name": person_name,
+                                       "face_id": face_id, "confidence": confidence})
+            else:
+                suppressed += 1
+                metrics.faces_total.inc(outcome='suppressed')
+            
+            history_faces.append({"face_id": duplicate_of or face_id, "name": person_name,
+                                  "confidence": confidence})
+            
+            # Return the face in results (no indication of duplicate)
+            results.append({
+                "id": face_id,
+                "name": person_name,
+                "confidence": confidence,
+                **face_image_fields(duplicate_of or face_id, face_image_base64),
+                "face_position": face_location
+            })
         else:
-            return jsonify({"error": "Failed to save history"}), 500
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+            metrics.faces_total.inc(outcome='unrecognized')
+            with timer.stage('store'):
+                # No good match found - save as unrecognized face
+                file_id = db.save_face_image(img_bytes, face_id, img_hash, phash)
+                
+                # Store in MongoDB as unrecognized
+                db.save_unrecognized_face(face_id, file_id, face_encoding.tolist(), img_hash, phash)
+            history_events.append({"type": "unrecognized", "face_id": face_id, "face_position": face_location})
+            history_faces.append({"face_id": face_id, "name": "Person not found", "confidence": 0})
+            
+            results.append({
+                "id": face_id,
+                "name": "Person not found",
+                "confidence": 0,
+                **face_image_fields(face_id, face_image_base64),
+                "face_position": face_location,
+                "cluster_id": db.get_face_cluster(face_id)
+            })
+        
+        if progress:
+            progress(i + 1)
+        if emit:
+            emit("face", results[-1])
+    
+    # Record the upload, then the faces it added to each list
+    with timer.stage('history'):
+        history = db.append_history(
+            [{"type": "upload", "filename": filename, "faces": history_faces}] + history_events
+        )
+    
+    return {
+        "message": f"Processed {len(results)} faces",
+        "results": results,
+        "suppressed": suppressed,
+        "history": history
+    }, 200
 
-# API endpoint to upload and process an image for face recognition
-@app.route('/api/upload', methods=['POST'])
+# API endpoint to upload and process an image for face recognition;
+# ?async=1 answers right away and processes the image as a background job
+@api.route('/api/upload', methods=['POST'])
 def upload_image():
     
     # Check if image is provided
     if 'image' not in request.files:
         return jsonify({"error": "No image provided"}), 400
+    
+    if request.args.get('async'):
+        return submit_upload_job(request.files['image'])
 
+    timer = start_stage_timer('upload')
+    
     try:
         file = request.files['image']
         # Read image file
-        img = face_recognition.load_image_file(file)
+        with timer.stage('decode'):
+            img_bytes = file.read()
+            img = face_recognition.load_image_file(BytesIO(img_bytes))
+            cache_key = engine.get_engine().cache_key(img_bytes)
+        
+        body, status = process_upload(img, file.filename, timer, response_images_as_urls(), cache_key=cache_key)
+        return jsonify(body), status
+    except (engine.EngineBusy, FutureTimeoutError):
+        return busy_response()
+    except Exception as e:
+        logger.exception("Error processing image")
+        return jsonify({"error": f"Error processing image: {str(e)}"}), 500
 
-        # Debug: Save original image with timestamp for debugging
-        debug_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        orig_filename = f"original_{debug_timestamp}.jpg"
-        db.save_debug_image(img, [], orig_filename)
+def submit_upload_job(file):
+    
+    filename = file.filename
+    img_bytes = file.read()
+    images_as_urls = response_images_as_urls()
+    
+    # Runs on an upload job thread, in a copy of this request's context for the face image links
+    @copy_current_request_context
+    def run(progress, emit):
+        timer = metrics.StageTimer('upload_job')
+        try:
+            with timer.stage('decode'):
+                img = face_recognition.load_image_file(BytesIO(img_bytes))
+                cache_key = engine.get_engine().cache_key(img_bytes)
+            body, status = process_upload(img, filename, timer, images_as_urls,
+                                          block=True, progress=progress, emit=emit, cache_key=cache_key)
+        except (engine.EngineBusy, FutureTimeoutError):
+            body, status = {"error": "Timed out waiting for face detection"}, 503
+        except Exception as e:
+            logger.exception("Error processing image")
+            body, status = {"error": f"Error processing image: {str(e)}"}, 500
+        timer.finish(status)
         
-        face_locations = face_recognition.face_locations(
-            img, 
-            model='hog', 
-            number_of_times_to_upsample=0
-        )
+        if status != 200:
+            emit("error", body)
+            raise JobFailed(body["error"])
         
-        # Debug: Save image with all detected faces before filtering
-        all_faces_filename = f"all_faces_{debug_timestamp}.jpg"
-        db.save_debug_image(img, face_locations, all_faces_filename)
+        # The faces were streamed one by one, the last event carries the rest of the response
+        emit("done", {key: value for key, value in body.items() if key != "results"})
+        return body
+    
+    try:
+        return job_response(upload_jobs.submit('upload', run, stream=True))
+    except JobQueueFull:
+        return busy_response()
+
+def process_video(path, filename, timer, images_as_urls, progress=None, emit=None):
+    
+    # Samples frames of a video file, tracks the faces across them and
+    # matches each track once, on the mean of its few encodings. Every track
+    # is stored as one face (its largest encoded crop) for the matched person
+    # or as unrecognized, and emitted as a 'track' event with its time range
+    tracker = video.FaceTracker(
+        engine.get_engine(),
+        min_iou=config.VIDEO_TRACK_IOU,
+        max_gap=config.VIDEO_TRACK_MAX_GAP,
+        max_encodings=config.VIDEO_ENCODINGS_PER_TRACK,
+        encode_interval=config.VIDEO_ENCODE_INTERVAL,
+        timeout=config.ENGINE_TIMEOUT,
+        progress=progress
+    )
+    frames = video.sample_frames(path, config.VIDEO_SAMPLE_FPS, config.VIDEO_MAX_SECONDS)
+    
+    results = []
+    # Tracks not stored because the person already has the same or a near-identical image
+    suppressed = 0
+    short_tracks = 0
+    history_faces = []
+    history_events = []
+    
+    for track in tracker.run(frames):
+        # Faces seen in too few frames are usually false detections
+        if track.detections < config.VIDEO_MIN_TRACK_LENGTH:
+            short_tracks += 1
+            continue
+        
+        faces = track.faces(timeout=config.ENGINE_TIMEOUT)
+        face_encoding, face_location, face_image = faces[0]
+        
+        with timer.stage('match'):
+            matches = db.find_person_matches(track.mean_encoding(faces))
+            matches = sorted(matches, key=lambda x: x["confidence"], reverse=True)
         
-        filtered_face_locations = []
-        img_height, img_width = img.shape[:2]
-        # Increase minimum face size to 8% of image dimension to further reduce false positives
-        min_face_size = min(img_height, img_width) * 0.08
+        with timer.stage('prepare'):
+            img_bytes, face_image_base64 = db.prepare_image_for_storage(face_image, not images_as_urls)
+            img_hash = db.image_hash(img_bytes)
+            phash = near_duplicate.dhash(face_image)
         
-        print(f"Image dimensions: {img_width}x{img_height}, Min face size: {min_face_size}")
+        face_id = str(uuid.uuid4())
+        track_fields = {
+            "track_id": track.id,
+            "start": round(track.start, 3),
+            "end": round(track.end, 3),
+            "detections": track.detections,
+            "encodings": len(faces)
+        }
         
-        for face_loc in face_locations:
-            top, right, bottom, left = face_loc
-            face_height = bottom - top
-            face_width = right - left
+        if matches and matches[0]["confidence"] > 60:  # Confidence threshold
+            person_name = matches[0]["name"]
+            confidence = matches[0]["confidence"]
+            metrics.faces_total.inc(outcome='matched')
             
-            print(f"Detected face: {face_width}x{face_height}, Aspect ratio: {face_width/face_height:.2f}")
+            with timer.stage('duplicates'):
+                duplicate_of = (db.find_duplicate_image(person_name, img_hash)
+                                or db.find_near_duplicate(person_name, face_encoding, phash))
             
-            # Skip if face is too small (likely false positive)
-            if face_height < min_face_size or face_width < min_face_size:
-                print(f"Skipping face - too small: {face_width}x{face_height}")
-                continue
-                
-            # Skip if aspect ratio is too extreme (likely false positive)
-            aspect_ratio = face_width / face_height
-            if aspect_ratio < 0.6 or aspect_ratio > 1.7:
-                print(f"Skipping face - aspect ratio out of range: {aspect_ratio:.2f}")
-                continue
-                
-            filtered_face_locations.append(face_loc)
+            if duplicate_of is None:
+                with timer.stage('store'):
+                    file_id = db.save_face_image(img_bytes, face_id, img_hash, phash)
+                    stored_id = db.add_face_to_person(person_name, face_id, file_id, face_encoding.tolist(), img_hash, phash)
+                    duplicate_of = stored_dupe(stored_id, face_id, file_id)
+            
+            if duplicate_of is None:
+                history_events.append({"type": "recognized", "person_name": person_name,
+                                       "face_id": face_id, "confidence": confidence})
+            else:
+                suppressed += 1
+                metrics.faces_total.inc(outcome='suppressed')
+            
+            history_faces.append({"face_id": duplicate_of or face_id, "name": person_name,
+                                  "confidence": confidence})
+            results.append({
+                **track_fields,
+                "id": face_id,
+                "name": person_name,
+                "confidence": confidence,
+                **face_image_fields(duplicate_of or face_id, face_image_base64),
+                "face_position": face_location
+            })
+        else:
+            metrics.faces_total.inc(outcome='unrecognized')
+            with timer.stage('store'):
+                file_id = db.save_face_image(img_bytes, face_id, img_hash, phash)
+                db.save_unrecognized_face(face_id, file_id, face_encoding.tolist(), img_hash, phash)
+            history_events.append({"type": "unrecognized", "face_id": face_id, "face_position": face_location})
+            history_faces.append({"face_id": face_id, "name": "Person not found", "confidence": 0})
+            results.append({
+                **track_fields,
+                "id": face_id,
+                "name": "Person not found",
+                "confidence": 0,
+                **face_image_fields(face_id, face_image_base64),
+                "face_position": face_location,
+                "cluster_id": db.get_face_cluster(face_id)
+            })
         
-        # Debug: Save image with only filtered faces
-        filtered_filename = f"filtered_faces_{debug_timestamp}.jpg"
-        db.save_debug_image(img, filtered_face_locations, filtered_filename)
+        if emit:
+            emit("track", results[-1])
+    
+    timer.record('decode', tracker.timings["decode"])
+    timer.record('detect', tracker.timings["detect"])
+    timer.record('encode', tracker.encode_seconds())
+    metrics.faces_total.inc(tracker.detections, outcome='detected')
+    
+    if tracker.frames == 0:
+        return {"error": "No frames could be read from the video"}, 400
+    
+    if not results:
+        return {"error": "No faces tracked in the video"}, 400
+    
+    with timer.stage('history'):
+        history = db.append_history(
+            [{"type": "upload", "filename": filename, "faces": history_faces}] + history_events
+        )
+    
+    return {
+        "message": f"Processed {len(results)} face tracks in {tracker.frames} sampled frames",
+        "tracks": results,
+        "frames_sampled": tracker.frames,
+        "detections": tracker.detections,
+        "encoded": tracker.encoded,
+        "short_tracks": short_tracks,
+        "suppressed": suppressed,
+        "history": history
+    }, 200
+
+# API endpoint to ingest a video file: faces are tracked across sampled
+# frames and each track is matched and stored once. Always runs as a
+# background job; the tracks stream as they end
+@api.route('/api/upload/video', methods=['POST'])
+def upload_video():
+    
+    if 'video' not in request.files:
+        return jsonify({"error": "No video provided"}), 400
+    
+    file = request.files['video']
+    filename = file.filename
+    images_as_urls = response_images_as_urls()
+    
+    # OpenCV reads from a path, so the upload is spooled to a temporary file
+    # that the job removes when it is done
+    suffix = os.path.splitext(filename or '')[1]
+    fd, path = tempfile.mkstemp(suffix=suffix, prefix='face-video-')
+    with os.fdopen(fd, 'wb') as f:
+        file.save(f)
+    
+    @copy_current_request_context
+    def run(progress, emit):
+        timer = metrics.StageTimer('video')
+        try:
+            body, status = process_video(path, filename, timer, images_as_urls, progress=progress, emit=emit)
+        except video.VideoError as e:
+            body, status = {"error": str(e)}, 400
+        except (engine.EngineBusy, FutureTimeoutError):
+            body, status = {"error": "Timed out waiting for face detection"}, 503
+        except Exception as e:
+            logger.exception("Error processing video")
+            body, status = {"error": f"Error processing video: {str(e)}"}, 500
+        finally:
+            os.remove(path)
+        timer.finish(status)
         
-        print(f"Original faces: {len(face_locations)}, Filtered faces: {len(filtered_face_locations)}")
+        if status != 200:
+            emit("error", body)
+            raise JobFailed(body["error"])
         
-        if not filtered_face_locations:
-            return jsonify({"error": "No valid faces detected in the image"}), 400
+        emit("done", {key: value for key, value in body.items() if key != "tracks"})
+        return body
+    
+    try:
+        return job_response(upload_jobs.submit('video', run, stream=True))
+    except JobQueueFull:
+        os.remove(path)
+        return busy_response()
+
+# API endpoint for 1:1 verification: is the face in the image the person it
+# claims to be? Only the largest face is encoded and it is compared with that
+# person's faces alone; nothing is stored and no history is recorded
+@api.route('/api/verify', methods=['POST'])
+def verify_face():
+    
+    if 'image' not in request.files:
+        return jsonify({"error": "No image provided"}), 400
+    
+    person_name = request.form.get('personName')
+    if not person_name:
+        return jsonify({"error": "Missing required fields"}), 400
+    
+    # The caller may ask for a stricter threshold, never a looser one
+    threshold = config.VERIFY_THRESHOLD
+    if request.form.get('threshold'):
+        try:
+            threshold = min(threshold, float(request.form['threshold']))
+        except ValueError:
+            return jsonify({"error": "Invalid threshold"}), 400
+    
+    if not db.person_exists(person_name):
+        return jsonify({"error": f"Person not found: {person_name}"}), 404
+    
+    timer = start_stage_timer('verify')
+    
+    try:
+        with timer.stage('decode'):
+            img = face_recognition.load_image_file(BytesIO(request.files['image'].read()))
         
-        # Get face encodings for the filtered faces
-        face_encodings = face_recognition.face_encodings(img, filtered_face_locations)
+        submitted = time.perf_counter()
+        future = engine.get_engine().submit_largest(img, timeout=config.ENGINE_TIMEOUT)
+        job = future.result(timeout=config.ENGINE_TIMEOUT)
+        record_engine_timings(timer, job, time.perf_counter() - submitted)
         
-        results = []
+        if not job["face_encodings"]:
+            return jsonify({"error": "No valid faces detected in the image"}), 400
+        
+        with timer.stage('match'):
+            result = db.verify_person(person_name, job["face_encodings"][0], threshold)
+    except (engine.EngineBusy, FutureTimeoutError):
+        return busy_response()
+    except Exception as e:
+        logger.exception("Error verifying image")
+        return jsonify({"error": f"Error processing image: {str(e)}"}), 500
+    
+    # Deleted while the image was being processed
+    if result is None:
+        return jsonify({"error": f"Person not found: {person_name}"}), 404
+    
+    metrics.verifications_total.inc(decision='accepted' if result["verified"] else 'rejected')
+    
+    return jsonify({
+        "person": person_name,
+        **result,
+        "faces_detected": len(job["filtered_face_locations"]),
+        "face_position": job["largest_face_location"]
+    })
 
-        # Process each detected face
-        for i, (face_encoding, face_location) in enumerate(zip(face_encodings, filtered_face_locations)):
-            # Find matches for this face
-            matches = db.find_person_matches(face_encoding)
-            
-            # Sort matches by confidence (highest first)
-            matches = sorted(matches, key=lambda x: x["confidence"], reverse=True)
-            
-            # Crop the face from the image
-            top, right, bottom, left = face_location
-            face_image = img[top:bottom, left:right]
-            
-            # Prepare image for storage
-            img_bytes, face_image_base64 = db.prepare_image_for_storage(face_image)
+# Image types accepted inside a batch upload zip archive
+BATCH_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp')
+
+def read_batch_images():
+    
+    # Collect (filename, bytes) from repeated 'images' fields and/or an 'archive' zip
+    images = [(file.filename, file.read()) for file in request.files.getlist('images')]
+    
+    if 'archive' in request.files:
+        with zipfile.ZipFile(request.files['archive']) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(BATCH_IMAGE_EXTENSIONS):
+                    continue
+                images.append((info.filename, archive.read(info)))
+    
+    return images
+
+def decode_image(img_bytes):
+    
+    try:
+        return face_recognition.load_image_file(BytesIO(img_bytes)), None
+    except Exception as e:
+        return None, str(e)
+
+# API endpoint to upload and process many images in one request
+@api.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    
+    try:
+        images = read_batch_images()
+    except zipfile.BadZipFile:
+        return jsonify({"error": "Archive is not a valid zip file"}), 400
+    
+    if not images:
+        return jsonify({"error": "No images provided"}), 400
+    
+    if len(images) > config.BATCH_MAX_IMAGES:
+        return jsonify({"error": f"Too many images, at most {config.BATCH_MAX_IMAGES} per batch"}), 413
+    
+    # Detect and encode times are summed over the images, queueing is the
+    # wait for the last one
+    timer = start_stage_timer('batch')
+    
+    try:
+        # Decode and hash the images in parallel
+        face_engine = engine.get_engine()
+        with timer.stage('decode'):
+            with ThreadPoolExecutor(max_workers=config.BATCH_WORKERS) as executor:
+                decoded = list(executor.map(decode_image, [img_bytes for _, img_bytes in images]))
+                cache_keys = list(executor.map(face_engine.cache_key, [img_bytes for _, img_bytes in images]))
+        
+        # Detect and encode on the worker pool, unless the image was seen
+        # before. The first image fails fast when the engine is saturated, the
+        # rest wait for queue slots to free up
+        submitted = time.perf_counter()
+        futures = []
+        for (img, error), cache_key in zip(decoded, cache_keys):
+            if error:
+                futures.append(None)
+                continue
+            block = any(future is not None for future in futures)
+            futures.append(face_engine.submit(img, block=block, timeout=config.ENGINE_TIMEOUT, cache_key=cache_key))
+        
+        processed = []
+        engine_timings = {}
+        for (img, error), future in zip(decoded, futures):
+            if future is None:
+                processed.append((None, [], [], error))
+                continue
             
-            # Generate a unique ID for this face
+            try:
+                job = future.result(timeout=config.ENGINE_TIMEOUT)
+                processed.append((img, job["filtered_face_locations"], job["face_encodings"], None))
+                metrics.faces_total.inc(len(job["face_locations"]), outcome='detected')
+                metrics.faces_total.inc(len(job["face_locations"]) - len(job["filtered_face_locations"]),
+                                        outcome='filtered')
+                for stage, seconds in job.get("timings", {}).items():
+                    engine_timings[stage] = engine_timings.get(stage, 0.0) + seconds
+            except FutureTimeoutError:
+                processed.append((None, [], [], "Timed out waiting for face detection"))
+            except Exception as e:
+                processed.append((None, [], [], str(e)))
+        
+        if any(future is not None for future in futures):
+            record_engine_timings(timer, {"timings": engine_timings}, time.perf_counter() - submitted)
+        
+        # Match every face from every image in one batched query
+        faces = [
+            (image_index, face_location, face_encoding)
+            for image_index, (_, face_locations, face_encodings, _) in enumerate(processed)
+            for face_location, face_encoding in zip(face_locations, face_encodings)
+        ]
+        with timer.stage('match'):
+            all_matches = db.find_person_matches_batch([face_encoding for _, _, face_encoding in faces]) if faces else []
+        
+        image_results = [[] for _ in images]
+        image_suppressed = [0 for _ in images]
+        image_history_faces = [[] for _ in images]
+        history_events = []
+        new_images = []
+        person_faces = []
+        unrecognized_faces = []
+        # Face id queued in this batch for each (person_name, image_hash)
+        batch_hashes = {}
+        # Faces queued for each person in this batch, as (encoding, phash, face_id)
+        batch_person_faces = {}
+        images_as_urls = response_images_as_urls()
+        
+        for (image_index, face_location, face_encoding), matches in zip(faces, all_matches):
+            img = processed[image_index][0]
+            with timer.stage('prepare'):
+                face_image = detection.crop_face(img, face_location)
+                img_bytes, face_image_base64 = db.prepare_image_for_storage(face_image, not images_as_urls)
+                phash = near_duplicate.dhash(face_image)
             face_id = str(uuid.uuid4())
             
-            # Process based on whether we have a good match
             if matches and matches[0]["confidence"] > 60:  # Confidence threshold
-                # We have a match with good confidence
-                best_match = matches[0]
-                person_name = best_match["name"]
-                confidence = best_match["confidence"]
+                person_name = matches[0]["name"]
+                confidence = matches[0]["confidence"]
+                metrics.faces_total.inc(outcome='matched')
                 
-                # Check if this exact image is already in the database
-                is_duplicate = db.is_duplicate_image(person_name, img_bytes)
+                # Skip images already stored for this person, or repeated within the batch,
+                # whether exactly or as near-identical copies
+                with timer.stage('duplicates'):
+                    image_key = (person_name, db.image_hash(img_bytes))
+                    queued = batch_person_faces.setdefault(person_name, [])
+                    duplicate_of = (
+                        batch_hashes.get(image_key)
+                        or next((other_face_id for other_encoding, other_phash, other_face_id in queued
+                                 if config.NEAR_DUP_ENABLED and near_duplicate.is_near_duplicate(
+                                     face_encoding, phash, other_encoding, other_phash,
+                                     config.NEAR_DUP_HASH_DISTANCE, config.NEAR_DUP_ENCODING_DISTANCE)), None)
+                        or db.find_duplicate_image(person_name, image_key[1])
+                        or db.find_near_duplicate(person_name, face_encoding, phash)
+                    )
                 
-                if not is_duplicate:
-                    # Save face image to GridFS only if it's not a duplicate
-                    file_id = db.save_face_image(img_bytes, face_id)
-                    
-                    # Store face info in MongoDB
-                    db.add_face_to_person(person_name, face_id, file_id, face_encoding.tolist())
+                if duplicate_of is None:
+                    batch_hashes[image_key] = face_id
+                    queued.append((face_encoding, phash, face_id))
+                    new_images.append((img_bytes, face_id, phash))
+                    person_faces.append((person_name, face_id, len(new_images) - 1, face_encoding.tolist(), phash))
+                    history_events.append({"type": "recognized", "person_name": person_name,
+                                           "face_id": face_id, "confidence": confidence})
+                else:
+                    image_suppressed[image_index] += 1
+                    metrics.faces_total.inc(outcome='suppressed')
                 
-                # Return the face in results (no indication of duplicate)
-                results.append({
-                    "id": face_id,
-                    "name": person_name,
-                    "confidence": confidence,
-                    "face_image": face_image_base64,
-                    "face_position": face_location
-                })
+                image_history_faces[image_index].append({"face_id": duplicate_of or face_id, "name": person_name,
+                                                         "confidence": confidence})
             else:
-                # No good match found - save as unrecognized face
-                file_id = db.save_face_image(img_bytes, face_id)
-                
-                # Store in MongoDB as unrecognized
-                db.save_unrecognized_face(face_id, file_id, face_encoding.tolist())
-                
-                results.append({
-                    "id": face_id,
-                    "name": "Person not found",
-                    "confidence": 0,
-                    "face_image": face_image_base64,
-                    "face_position": face_location
+                person_name = "Person not found"
+                confidence = 0
+                metrics.faces_total.inc(outcome='unrecognized')
+                new_images.append((img_bytes, face_id, phash))
+                unrecognized_faces.append((face_id, len(new_images) - 1, face_encoding.tolist(), phash))
+                history_events.append({"type": "unrecognized", "face_id": face_id, "face_position": face_location})
+                image_history_faces[image_index].append({"face_id": face_id, "name": person_name, "confidence": 0})
+            
+            image_results[image_index].append({
+                "id": face_id,
+                "name": person_name,
+                "confidence": confidence,
+                **face_image_fields(image_history_faces[image_index][-1]["face_id"], face_image_base64),
+                "face_position": face_location
+            })
+        
+        # Bulk writes: all face images, then one write per collection
+        with timer.stage('store'):
+            file_ids = db.save_face_images(new_images)
+            duplicates = db.add_faces_to_persons([
+                (person_name, face_id, file_ids[image_no], face_encoding, phash)
+                for person_name, face_id, image_no, face_encoding, phash in person_faces
+            ])
+            
+            # Images a concurrent request stored for the person first: drop
+            # the copies just saved and refer to the stored ones
+            if duplicates:
+                db.delete_files([file_ids[image_no] for _, face_id, image_no, _, _ in person_faces if face_id in duplicates])
+                history_events = [event for event in history_events if event.get("face_id") not in duplicates]
+                for image_index, results in enumerate(image_results):
+                    for result, history_face in zip(results, image_history_faces[image_index]):
+                        stored_id = duplicates.get(result["id"])
+                        if stored_id is None:
+                            continue
+                        history_face["face_id"] = stored_id
+                        if "face_image_url" in result:
+                            result.update(face_image_fields(stored_id, None))
+                        image_suppressed[image_index] += 1
+                        metrics.faces_total.inc(outcome='suppressed')
+            db.save_unrecognized_faces([
+                (face_id, file_ids[image_no], face_encoding, phash)
+                for face_id, image_no, face_encoding, phash in unrecognized_faces
+            ])
+        
+        # Unrecognized faces come back with the cluster they joined
+        for results in image_results:
+            for result in results:
+                if result["name"] == "Person not found":
+                    result["cluster_id"] = db.get_face_cluster(result["id"])
+        
+        batch_results = []
+        for (filename, _), (_, _, _, error), results, suppressed in zip(images, processed, image_results, image_suppressed):
+            if error:
+                batch_results.append({"filename": filename, "error": f"Error processing image: {error}"})
+            elif not results:
+                batch_results.append({"filename": filename, "error": "No valid faces detected in the image"})
+            else:
+                batch_results.append({
+                    "filename": filename,
+                    "message": f"Processed {len(results)} faces",
+                    "results": results,
+                    "suppressed": suppressed
                 })
         
+        # Record every image that had faces, then the faces added to each list
+        with timer.stage('history'):
+            history = db.append_history([
+                {"type": "upload", "filename": filename, "faces": history_faces}
+                for (filename, _), history_faces in zip(images, image_history_faces) if history_faces
+            ] + history_events)
+        
         return jsonify({
-            "message": f"Processed {len(results)} faces",
-            "results": results
+            "message": f"Processed {len(faces)} faces in {len(images)} images",
+            "images": batch_results,
+            "suppressed": sum(image_suppressed),
+            "history": history
         })
+    except engine.EngineBusy:
+        return busy_response()
     except Exception as e:
-        return jsonify({"error": f"Error processing image: {str(e)}"}), 500
+        logger.exception("Error processing batch")
+        return jsonify({"error": f"Error processing batch: {str(e)}"}), 500
 
 # API endpoint to create a new person from an unrecognized face
-@app.route('/api/person/create', methods=['POST'])
+@api.route('/api/person/create', methods=['POST'])
 def create_person():
     
     try:
@@ -192,46 +945,58 @@ def create_person():
         if not unrecognized_face:
             return jsonify({"error": "Face ID not found in unrecognized faces"}), 404
         
-        # Get the file from GridFS to check for duplicates
+        # Check if this image is already in the database for this person,
+        # using the content hash stored with the face
         file_id = unrecognized_face['file_id']
-        try:
-            img_bytes = db.fs.get(file_id).read()
-            # Check if this image is already in the database for this person
-            is_duplicate = db.is_duplicate_image(person_name, img_bytes)
-            
-            if is_duplicate:
-                # Still mark as recognized
-                db.mark_face_as_recognized(face_id, person_name)
-                
-                return jsonify({
-                    "message": f"Added face to person: {person_name}",
-                    "person": person_name
-                })
-        except Exception as e:
-            # If we can't read the file or check for duplicates, just proceed with adding
-            print(f"Error checking for duplicate: {e}")
+        img_hash = unrecognized_face.get('image_hash') or db.get_file_hash(file_id)
         
         # Get encoding
         face_encoding = unrecognized_face['encoding']
         
-        # Add face to person (creates the person if it doesn't exist)
-        success = db.add_face_to_person(person_name, face_id, file_id, face_encoding)
+        # Near-identical images of the person are not stored again either
+        is_duplicate = (
+            (img_hash and db.is_duplicate_image(person_name, img_hash=img_hash))
+            or db.find_near_duplicate(person_name, face_encoding, unrecognized_face.get('phash')) is not None
+        )
         
-        if not success:
-            return jsonify({"error": "Failed to add face to person"}), 500
+        if not is_duplicate:
+            # Add face to person (creates the person if it doesn't exist)
+            stored_id = db.add_face_to_person(person_name, face_id, file_id, face_encoding, img_hash,
+                                              unrecognized_face.get('phash'))
+            
+            if not stored_id:
+                return jsonify({"error": "Failed to add face to person"}), 500
+            
+            # A concurrent request stored the same image for the person first
+            is_duplicate = stored_id != face_id
+        
+        if is_duplicate:
+            # Still mark as recognized
+            db.mark_face_as_recognized(face_id, person_name)
+            
+            return jsonify({
+                "message": f"Added face to person: {person_name}",
+                "person": person_name,
+                "suppressed": True
+            })
         
         # Mark the face as recognized
         db.mark_face_as_recognized(face_id, person_name)
+        history = db.append_history([
+            {"type": "recognized", "person_name": person_name, "face_id": face_id, "confidence": 100}
+        ])
         
         return jsonify({
             "message": f"Added face to person: {person_name}",
-            "person": person_name
+            "person": person_name,
+            "suppressed": False,
+            "history": history
         })
     except Exception as e:
         return jsonify({"error": f"Error creating person: {str(e)}"}), 500
 
 # API endpoint to add an unrecognized face to an existing person
-@app.route('/api/person/add', methods=['POST'])
+@api.route('/api/person/add', methods=['POST'])
 def add_to_person():
    
     try:
@@ -250,51 +1015,150 @@ def add_to_person():
             return jsonify({"error": "Face ID not found in unrecognized faces"}), 404
         
         # Check if person exists
-        person = db.persons_collection.find_one({'name': person_name})
-        
-        if not person:
+        if not db.person_exists(person_name):
             return jsonify({"error": "Person not found"}), 404
         
-        # Get the file from GridFS to check for duplicates
+        # Check if this image is already in the database for this person,
+        # using the content hash stored with the face
         file_id = unrecognized_face['file_id']
-        try:
-            img_bytes = db.fs.get(file_id).read()
-            # Check if this image is already in the database for this person
-            is_duplicate = db.is_duplicate_image(person_name, img_bytes)
-            
-            if is_duplicate:
-                # Still mark as recognized
-                db.mark_face_as_recognized(face_id, person_name)
-                
-                return jsonify({
-                    "message": f"Added face to person: {person_name}",
-                    "person": person_name
-                })
-        except Exception as e:
-            # If we can't read the file or check for duplicates, just proceed with adding
-            print(f"Error checking for duplicate: {e}")
+        img_hash = unrecognized_face.get('image_hash') or db.get_file_hash(file_id)
         
         # Get encoding
         face_encoding = unrecognized_face['encoding']
         
-        # Add face to existing person
-        success = db.add_face_to_person(person_name, face_id, file_id, face_encoding)
+        # Near-identical images of the person are not stored again either
+        is_duplicate = (
+            (img_hash and db.is_duplicate_image(person_name, img_hash=img_hash))
+            or db.find_near_duplicate(person_name, face_encoding, unrecognized_face.get('phash')) is not None
+        )
         
-        if not success:
-            return jsonify({"error": "Failed to add face to person"}), 500
+        if not is_duplicate:
+            # Add face to existing person
+            stored_id = db.add_face_to_person(person_name, face_id, file_id, face_encoding, img_hash,
+                                              unrecognized_face.get('phash'))
+            
+            if not stored_id:
+                return jsonify({"error": "Failed to add face to person"}), 500
+            
+            # A concurrent request stored the same image for the person first
+            is_duplicate = stored_id != face_id
+        
+        if is_duplicate:
+            # Still mark as recognized
+            db.mark_face_as_recognized(face_id, person_name)
+            
+            return jsonify({
+                "message": f"Added face to person: {person_name}",
+                "person": person_name,
+                "suppressed": True
+            })
         
         # Mark the face as recognized
         db.mark_face_as_recognized(face_id, person_name)
+        history = db.append_history([
+            {"type": "recognized", "person_name": person_name, "face_id": face_id, "confidence": 100}
+        ])
         
         return jsonify({
             "message": f"Added face to person: {person_name}",
-            "person": person_name
+            "person": person_name,
+            "suppressed": False,
+            "history": history
         })
     except Exception as e:
         return jsonify({"error": f"Error adding face to person: {str(e)}"}), 500
 
+def cluster_fields(cluster_id, face_ids):
+    
+    return {
+        "id": cluster_id,
+        "size": len(face_ids),
+        "face_ids": face_ids,
+        "face_image_url": url_for('api.api_face_image', face_id=face_ids[0], _external=True)
+    }
+
+# API endpoint to list clusters of similar unrecognized faces, largest first;
+# ?min_size=2 leaves out faces that are not like any other
+@api.route('/api/clusters', methods=['GET'])
+def api_get_clusters():
+    
+    if not config.CLUSTER_ENABLED:
+        return jsonify({"error": "Clustering of unrecognized faces is disabled"}), 404
+    
+    min_size = max(1, request.args.get('min_size', 1, type=int))
+    
+    return jsonify({
+        "clusters": [
+            cluster_fields(cluster_id, face_ids) for cluster_id, face_ids in db.get_unrecognized_clusters(min_size)
+        ]
+    })
+
+# API endpoint to get the faces of one cluster
+@api.route('/api/clusters/<cluster_id>', methods=['GET'])
+def api_get_cluster(cluster_id):
+    
+    face_ids = db.get_cluster_faces(cluster_id) if config.CLUSTER_ENABLED else []
+    
+    if not face_ids:
+        return jsonify({"error": f"Cluster not found: {cluster_id}"}), 404
+    
+    return jsonify({
+        **cluster_fields(cluster_id, face_ids),
+        "faces": [
+            {"id": face_id, "face_image_url": url_for('api.api_face_image', face_id=face_id, _external=True)}
+            for face_id in face_ids
+        ]
+    })
+
+# API endpoint to name all faces of a cluster at once, creating the person
+# if needed. 'faceIds' names exactly the faces the client reviewed, even if
+# the cluster has changed since; faces listed in 'exclude' stay unrecognized
+@api.route('/api/clusters/<cluster_id>/assign', methods=['POST'])
+def api_assign_cluster(cluster_id):
+    
+    try:
+        data = request.json
+        
+        if not data or 'personName' not in data:
+            return jsonify({"error": "Missing required fields"}), 400
+        
+        person_name = data['personName']
+        exclude = set(data.get('exclude') or [])
+        
+        if data.get('faceIds') is not None:
+            if not isinstance(data['faceIds'], list):
+                return jsonify({"error": "faceIds must be a list of face ids"}), 400
+            face_ids = list(dict.fromkeys(data['faceIds']))
+        else:
+            face_ids = db.get_cluster_faces(cluster_id) if config.CLUSTER_ENABLED else []
+        face_ids = [face_id for face_id in face_ids if face_id not in exclude]
+        
+        if not face_ids:
+            return jsonify({"error": f"Cluster not found: {cluster_id}"}), 404
+        
+        stored, suppressed = db.assign_faces_to_person(face_ids, person_name)
+        
+        if not stored and not suppressed:
+            return jsonify({"error": "Faces of the cluster not found in unrecognized faces"}), 404
+        
+        history = db.append_history([
+            {"type": "recognized", "person_name": person_name, "face_id": face['face_id'], "confidence": 100}
+            for face in stored
+        ])
+        
+        return jsonify({
+            "message": f"Added {len(stored) + len(suppressed)} faces to person: {person_name}",
+            "person": person_name,
+            "added": [face['face_id'] for face in stored],
+            "suppressed": [face['face_id'] for face in suppressed],
+            "history": history
+        })
+    except Exception as e:
+        logger.exception("Error assigning cluster")
+        return jsonify({"error": f"Error assigning cluster: {str(e)}"}), 500
+
 # API endpoint to delete a person and all their face images
-@app.route('/api/person/delete', methods=['POST'])
+@api.route('/api/person/delete', methods=['POST'])
 def delete_person():
     
     try:
@@ -317,7 +1181,7 @@ def delete_person():
         return jsonify({"error": f"Error deleting person: {str(e)}"}), 500
 
 # API endpoint to delete an unrecognized face
-@app.route('/api/face/delete', methods=['POST'])
+@api.route('/api/face/delete', methods=['POST'])
 def delete_face():
     
     try:
@@ -339,10 +1203,101 @@ def delete_face():
     except Exception as e:
         return jsonify({"error": f"Error deleting face: {str(e)}"}), 500
 
+def job_response(job):
+    
+    # 202 with the job and where to poll its progress, and follow its events
+    body = {"message": f"Started {job.kind} job", "job": job.to_dict()}
+    if job.events is not None:
+        body["events_url"] = url_for('api.api_job_events', job_id=job.id)
+    response = jsonify(body)
+    response.headers['Location'] = url_for('api.api_get_job', job_id=job.id)
+    return response, 202
+
+def find_job(job_id):
+    
+    return jobs.get(job_id) or upload_jobs.get(job_id)
+
+# API endpoint to get the status and progress of a background job; a
+# streaming job also returns its events after ?after=<event id>
+@api.route('/api/jobs/<job_id>', methods=['GET'])
+def api_get_job(job_id):
+    
+    job = find_job(job_id)
+    
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    
+    body = job.to_dict()
+    if job.events is not None:
+        body["events"] = job.events[request.args.get('after', 0, type=int):]
+    
+    return jsonify(body)
+
+# API endpoint to follow the events of a streaming job as they happen, as
+# Server-Sent Events or as NDJSON (?format=ndjson or Accept: application/x-ndjson).
+# The stream ends after the job's last event
+@api.route('/api/jobs/<job_id>/events', methods=['GET'])
+def api_job_events(job_id):
+    
+    job = find_job(job_id)
+    
+    if job is None or job.events is None:
+        return jsonify({"error": "Job not found"}), 404
+    
+    ndjson = (request.args.get('format') == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
+    # A reconnecting EventSource resumes after the last event it received
+    after = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', 0, type=int)
+    
+    dumps = current_app.json.dumps
+    
+    def stream():
+        sent = after
+        while True:
+            events = job.wait_events(sent, timeout=config.UPLOAD_STREAM_KEEPALIVE)
+            for event in events:
+                if ndjson:
+                    yield dumps(event) + "\n"
+                else:
+                    yield f"id: {event['id']}\nevent: {event['event']}\ndata: {dumps(event['data'])}\n\n"
+            sent += len(events)
+            
+            if job.finished and sent >= len(job.events):
+                return
+            if not events and not ndjson:
+                # Comment line so proxies do not close an idle stream
+                yield ": keep-alive\n\n"
+    
+    response = Response(stream(), mimetype='application/x-ndjson' if ndjson else 'text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# API endpoint to list recent background jobs
+@api.route('/api/jobs', methods=['GET'])
+def api_list_jobs():
+    
+    recent = sorted(jobs.list() + upload_jobs.list(), key=lambda job: job.created_at)
+    return jsonify({"jobs": [job.to_dict() for job in recent]})
+
+# API endpoint to expire old unrecognized faces and collect orphaned images
+# in the background; ?dry_run=1 only reports what would be reclaimed
+@api.route('/api/maintenance/retention', methods=['POST'])
+def api_run_retention():
+    
+    dry_run = bool(request.args.get('dry_run'))
+    max_batches = request.args.get('max_batches', 0, type=int)
+    
+    return job_response(retention.submit_retention_job(dry_run, max_batches))
+
 # API endpoint to delete all persons and their face images
-@app.route('/api/persons/delete-all', methods=['POST'])
+@api.route('/api/persons/delete-all', methods=['POST'])
 def delete_all_persons():
    
+    # ?background=1 runs the wipe as a job and answers right away
+    if request.args.get('background'):
+        return job_response(jobs.submit('delete_all_persons', lambda progress: db.delete_all_persons(progress)))
+    
     try:
         count = db.delete_all_persons()
         return jsonify({
@@ -353,9 +1308,13 @@ def delete_all_persons():
         return jsonify({"error": f"Error deleting persons: {str(e)}"}), 500
 
 # API endpoint to delete all unrecognized faces
-@app.route('/api/faces/delete-all', methods=['POST'])
+@api.route('/api/faces/delete-all', methods=['POST'])
 def delete_all_faces():
     
+    # ?background=1 runs the wipe as a job and answers right away
+    if request.args.get('background'):
+        return job_response(jobs.submit('delete_all_faces', lambda progress: db.delete_all_unrecognized_faces(progress)))
+    
     try:
         count = db.delete_all_unrecognized_faces()
         return jsonify({
@@ -366,7 +1325,7 @@ def delete_all_faces():
         return jsonify({"error": f"Error deleting faces: {str(e)}"}), 500
 
 # API endpoint to delete all history data
-@app.route('/api/history/delete-all', methods=['POST'])
+@api.route('/api/history/delete-all', methods=['POST'])
 def delete_all_history():
     
     try:
@@ -379,7 +1338,7 @@ def delete_all_history():
         return jsonify({"error": f"Error deleting history: {str(e)}"}), 500
 
 # API endpoint to delete a specific face image from a person
-@app.route('/api/face/delete-from-person', methods=['POST'])
+@api.route('/api/face/delete-from-person', methods=['POST'])
 def delete_face_from_person():
     
     try:
@@ -391,63 +1350,17 @@ def delete_face_from_person():
         person_name = data['personName']
         face_id = data['faceId']
         
-        # Find the person document
-        person = db.persons_collection.find_one({'name': person_name})
-        
-        if not person:
+        if not db.person_exists(person_name):
             return jsonify({"error": f"Person not found: {person_name}"}), 404
         
-        # Check if the face ID exists in the person's face_ids
-        if 'face_ids' not in person or face_id not in person['face_ids']:
+        # Check if the face ID belongs to the person
+        if not db.person_has_face(person_name, face_id):
             return jsonify({"error": f"Face ID not found for this person: {face_id}"}), 404
         
-        # Get the index of the face ID
-        face_index = person['face_ids'].index(face_id)
-        
-        # Get the file ID for this face
-        file_id = None
-        if 'file_ids' in person and len(person['file_ids']) > face_index:
-            file_id = person['file_ids'][face_index]
-        
-        # Remove the face ID, file ID, and encoding from the person document
-        update_result = db.persons_collection.update_one(
-            {'name': person_name},
-            {
-                '$pull': {
-                    'face_ids': face_id
-                }
-            }
-        )
+        # Remove the face, its file and its encoding from the person
+        success = db.delete_face_from_person(person_name, face_id)
         
-        # Also remove the file ID and encoding separately since they might not be in the same order
-        if file_id:
-            db.persons_collection.update_one(
-                {'name': person_name},
-                {
-                    '$pull': {
-                        'file_ids': file_id
-                    }
-                }
-            )
-            
-            # Delete the file from GridFS
-            try:
-                db.fs.delete(file_id)
-            except Exception as e:
-                print(f"Error deleting file {file_id}: {e}")
-        
-        # Remove the encoding if it exists
-        if 'encodings' in person and len(person['encodings']) > face_index:
-            db.persons_collection.update_one(
-                {'name': person_name},
-                {
-                    '$pull': {
-                        'encodings': person['encodings'][face_index]
-                    }
-                }
-            )
-        
-        if update_result.modified_count > 0:
+        if success:
             return jsonify({
                 "message": f"Successfully deleted face from person: {person_name}",
                 "person": person_name,
@@ -458,9 +1371,36 @@ def delete_face_from_person():
     except Exception as e:
         return jsonify({"error": f"Error deleting face: {str(e)}"}), 500
 
+def create_app(load_gallery=True):
+    
+    # Application factory. WSGI servers call it once per worker process (see
+    # wsgi.py); with FACE_MATCH_INDEX=snapshot the workers share one mapped
+    # copy of the gallery instead of loading their own
+    app = Flask(__name__)
+    CORS(app)  # Enable Cross-Origin Resource Sharing
+    app.register_blueprint(api)
+    
+    # Create indexes and build (or map) the gallery index before serving requests
+    db.ensure_indexes()
+    if load_gallery:
+        db.load_gallery_index()
+    
+    # Persist an approximate index on shutdown so the next start skips
+    # retraining, or publish the snapshot changes still pending
+    atexit.register(db.save_gallery_index)
+    atexit.register(engine.shutdown_engine)
+    
+    # Periodic expiry and garbage collection when FACE_RETENTION_INTERVAL is set
+    retention.start_retention_scheduler()
+    
+    return app
+
 # Run the application if this script is executed directly
 if __name__ == '__main__':
 
     debug_mode = True
     port = 5000
-    app.run(debug=debug_mode, port=port)
+    
+    logging.basicConfig(level=config.LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    
+    create_app().run(debug=debug_mode, port=port)
@@ -0,0 +1,101 @@
+import argparse
+import json
+import time
+import synthetic
+from ann_index import create_gallery_index, hnswlib
+
+# Recall-vs-latency report comparing the exact and approximate match indexes
+# on a synthetic gallery. Run from the backend directory:
+#   python benchmarks/ann_report.py --persons 20000 --per-person 10
+
+TOP_K = 10
+
+def time_queries(index, queries, threshold):
+
+    results = []
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(index.search(query, threshold, TOP_K))
+        timings.append(time.perf_counter() - start)
+
+    return results, timings
+
+def recall(exact_results, approx_results):
+
+    # Fraction of the exact top-k neighbours the approximate index also returned
+    found = 0
+    total = 0
+    for exact, approx in zip(exact_results, approx_results):
+        expected = {face_id for _, face_id, _ in exact}
+        found += len(expected & {face_id for _, face_id, _ in approx})
+        total += len(expected)
+
+    return found / total if total else 1.0
+
+def top1_agreement(exact_results, approx_results):
+
+    agree = sum(
+        1 for exact, approx in zip(exact_results, approx_results)
+        if (exact[0][0] if exact else None) == (approx[0][0] if approx else None)
+    )
+    return agree / len(exact_results) if exact_results else 1.0
+
+def run_report(persons, per_person, queries_count, threshold, nprobes):
+    entries, centres = synthetic.make_gallery(persons, per_person)
+    queries, _ = synthetic.make_queries(centres, queries_count)
+
+    configurations = [('exact', {})]
+    configurations += [('ivf', {'nprobe': nprobe}) for nprobe in nprobes]
+    if hnswlib is not None:
+        configurations += [('hnsw', {})]
+
+    exact_results = None
+    rows = []
+
+    for kind, options in configurations:
+        index = create_gallery_index(kind, **options)
+
+        start = time.perf_counter()
+        index.load(entries)
+        build_seconds = time.perf_counter() - start
+
+        results, timings = time_queries(index, queries, threshold)
+        if exact_results is None:
+            exact_results = results
+
+        rows.append({
+            'index': kind,
+            'options': options,
+            'gallery_size': len(entries),
+            'build_seconds': round(build_seconds, 3),
+            'recall_at_k': round(recall(exact_results, results), 4),
+            'top1_agreement': round(top1_agreement(exact_results, results), 4),
+            'p50_ms': round(synthetic.percentile_ms(timings, 50), 3),
+            'p95_ms': round(synthetic.percentile_ms(timings, 95), 3),
+            'p99_ms': round(synthetic.percentile_ms(timings, 99), 3),
+        })
+
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare exact and approximate face matching")
+    parser.add_argument('--persons', type=int, default=10000)
+    parser.add_argument('--per-person', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--threshold', type=float, default=0.6)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--json', help="also write the rows to this file")
+    args = parser.parse_args()
+
+    rows = run_report(args.persons, args.per_person, args.queries, args.threshold, args.nprobe)
+
+    print(f"{'index':<8}{'options':<16}{'recall@k':>10}{'top1':>8}{'p50 ms':>10}{'p95 ms':>10}{'build s':>10}")
+    for row in rows:
+        options = ','.join(f"{key}={value}" for key, value in row['options'].items())
+        print(f"{row['index']:<8}{options:<16}{row['recall_at_k']:>10.4f}{row['top1_agreement']:>8.4f}"
+              f"{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}{row['build_seconds']:>10.3f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,89 @@
+import argparse
+import json
+import time
+import numpy as np
+import cv2
+import synthetic
+import face_recognition
+import config
+import detection
+
+# Before/after latency of face detection at full resolution versus the
+# downscale-then-detect pipeline. Run from the backend directory:
+#   python benchmarks/detection_latency.py photos/*.jpg --resize-mp 12
+
+def load_image(path, resize_mp):
+
+    img = face_recognition.load_image_file(path)
+    if resize_mp:
+        # Resample to the requested megapixels, e.g. 12 for a typical phone photo
+        height, width = img.shape[:2]
+        factor = np.sqrt(resize_mp * 1e6 / (height * width))
+        img = cv2.resize(img, (round(width * factor), round(height * factor)), interpolation=cv2.INTER_CUBIC)
+    return img
+
+def time_detection(img, downscale, repeats):
+
+    config.DETECT_DOWNSCALE = downscale
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        face_locations = detection.detect_faces(img)
+        timings.append(time.perf_counter() - start)
+
+    kept = detection.filter_face_locations(img, face_locations)
+    return kept, timings
+
+def iou(a, b):
+
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    area = lambda box: (box[1] - box[3]) * (box[2] - box[0])
+    union = area(a) + area(b) - intersection
+    return intersection / union if union else 0.0
+
+def run_report(paths, resize_mp, repeats):
+    rows = []
+
+    for path in paths:
+        img = load_image(path, resize_mp)
+        full_faces, full_timings = time_detection(img, False, repeats)
+        fast_faces, fast_timings = time_detection(img, True, repeats)
+
+        # How well the remapped boxes line up with full-resolution detection
+        overlaps = [max((iou(face, other) for other in fast_faces), default=0.0) for face in full_faces]
+
+        rows.append({
+            'image': path,
+            'size': f"{img.shape[1]}x{img.shape[0]}",
+            'scale': round(detection.detection_scale(img.shape), 3),
+            'full_ms': round(synthetic.percentile_ms(full_timings, 50), 1),
+            'downscaled_ms': round(synthetic.percentile_ms(fast_timings, 50), 1),
+            'full_faces': len(full_faces),
+            'downscaled_faces': len(fast_faces),
+            'mean_iou': round(float(np.mean(overlaps)), 3) if overlaps else None
+        })
+
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full-resolution and downscaled face detection")
+    parser.add_argument('images', nargs='+', help="photos to detect faces in")
+    parser.add_argument('--resize-mp', type=float, help="resample every photo to this many megapixels first")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--json', help="also write the rows to this file")
+    args = parser.parse_args()
+
+    rows = run_report(args.images, args.resize_mp, args.repeats)
+
+    print(f"{'image':<32}{'size':>12}{'scale':>8}{'full ms':>10}{'down ms':>10}{'faces':>8}{'iou':>7}")
+    for row in rows:
+        faces = f"{row['full_faces']}/{row['downscaled_faces']}"
+        mean_iou = f"{row['mean_iou']:.3f}" if row['mean_iou'] is not None else '-'
+        print(f"{row['image'][-32:]:<32}{row['size']:>12}{row['scale']:>8}{row['full_ms']:>10}"
+              f"{row['downscaled_ms']:>10}{faces:>8}{mean_iou:>7}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,113 @@
+import argparse
+import json
+import time
+import numpy as np
+import synthetic
+from gallery_index import GalleryIndex, ENCODING_SIZE
+from prototypes import PrototypeIndex
+
+# Accuracy/latency report: matching against every stored encoding versus
+# per-person prototypes (centroid + k medoids). Run from the backend directory:
+#   python benchmarks/prototype_report.py --persons 2000 --per-person 50
+
+THRESHOLD = 0.6
+
+# Photos of one person are drawn around a few "conditions" (pose, lighting,
+# age) rather than a single blob, which is what a lone centroid struggles with
+CONDITIONS = 3
+CONDITION_SCALE = 0.35 / 16
+
+def make_person_photos(persons, per_person, queries_count, condition_scale=CONDITION_SCALE, seed=0):
+
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0.0, synthetic.PERSON_SCALE, (persons, ENCODING_SIZE)).astype(np.float32)
+    conditions = centres[:, None, :] + rng.normal(
+        0.0, condition_scale, (persons, CONDITIONS, ENCODING_SIZE)
+    ).astype(np.float32)
+
+    def photo(person_no):
+        condition = conditions[person_no, rng.integers(0, CONDITIONS)]
+        return condition + rng.normal(0.0, synthetic.PHOTO_SCALE, ENCODING_SIZE).astype(np.float32)
+
+    entries = []
+    for person_no in range(persons):
+        for photo_no in range(per_person):
+            entries.append((f"person_{person_no}", f"face_{person_no}_{photo_no}", photo(person_no)))
+
+    person_nos = rng.integers(0, persons, queries_count)
+    queries = np.asarray([photo(person_no) for person_no in person_nos], dtype=np.float32)
+    return entries, queries, [f"person_{person_no}" for person_no in person_nos]
+
+def evaluate(index, queries, expected, impostors):
+
+    timings = []
+    correct = 0
+    for query, name in zip(queries, expected):
+        start = time.perf_counter()
+        matches = index.search(query, THRESHOLD, 1)
+        timings.append(time.perf_counter() - start)
+        correct += bool(matches) and matches[0][0] == name
+
+    # Impostors are people who were never enrolled - any match is a false accept
+    false_accepts = sum(1 for query in impostors if index.search(query, THRESHOLD, 1))
+
+    return correct / len(queries), false_accepts / len(impostors), timings
+
+def run_report(persons, per_person, queries_count, prototype_sizes, condition_scale=CONDITION_SCALE):
+    entries, queries, expected = make_person_photos(persons, per_person, queries_count, condition_scale)
+
+    rng = np.random.default_rng(2)
+    impostor_centres = rng.normal(0.0, synthetic.PERSON_SCALE, (queries_count, ENCODING_SIZE)).astype(np.float32)
+    impostors, _ = synthetic.make_queries(impostor_centres, queries_count, seed=3)
+
+    by_person = {}
+    for entry in entries:
+        by_person.setdefault(entry[0], []).append(entry)
+
+    configurations = [('full', None)] + [(f"prototypes k={k}", k) for k in prototype_sizes]
+    rows = []
+
+    for label, k in configurations:
+        if k is None:
+            index = GalleryIndex()
+        else:
+            index = PrototypeIndex(GalleryIndex(), k, lambda person_name: by_person.get(person_name, []))
+
+        start = time.perf_counter()
+        index.load(entries)
+        build_seconds = time.perf_counter() - start
+
+        accuracy, false_accept_rate, timings = evaluate(index, queries, expected, impostors)
+        rows.append({
+            'mode': label,
+            'index_rows': index.prototype_count() if k else len(index),
+            'build_seconds': round(build_seconds, 3),
+            'identification_accuracy': round(accuracy, 4),
+            'false_accept_rate': round(false_accept_rate, 4),
+            'p50_ms': round(synthetic.percentile_ms(timings, 50), 3),
+            'p95_ms': round(synthetic.percentile_ms(timings, 95), 3),
+        })
+
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full-set and prototype face matching")
+    parser.add_argument('--persons', type=int, default=2000)
+    parser.add_argument('--per-person', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, nargs='+', default=[1, 3, 5])
+    parser.add_argument('--condition-spread', type=float, default=CONDITION_SCALE * 16,
+                        help="distance scale between a person's conditions (0.7 makes a lone centroid miss)")
+    parser.add_argument('--json', help="also write the rows to this file")
+    args = parser.parse_args()
+
+    rows = run_report(args.persons, args.per_person, args.queries, args.k, args.condition_spread / 16)
+
+    print(f"{'mode':<18}{'rows':>10}{'accuracy':>10}{'FAR':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    for row in rows:
+        print(f"{row['mode']:<18}{row['index_rows']:>10}{row['identification_accuracy']:>10.4f}"
+              f"{row['false_accept_rate']:>8.4f}{row['p50_ms']:>10.3f}{row['p95_ms']:>10.3f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+
+# Make the backend modules importable when a benchmark is run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery_index import ENCODING_SIZE
+
+# Spread of person centres and of a person's photos around their centre,
+# chosen so different people sit ~1.0 apart and photos of one person
+# ~0.4 apart, roughly like real dlib face descriptors
+PERSON_SCALE = 1.0 / 16
+PHOTO_SCALE = 0.4 / 16
+
+def make_gallery(persons, per_person, seed=0):
+    # Returns (person_name, face_id, encoding) entries and the person centres
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0.0, PERSON_SCALE, (persons, ENCODING_SIZE)).astype(np.float32)
+
+    entries = []
+    for person_no, centre in enumerate(centres):
+        photos = centre + rng.normal(0.0, PHOTO_SCALE, (per_person, ENCODING_SIZE)).astype(np.float32)
+        for photo_no, encoding in enumerate(photos):
+            entries.append((f"person_{person_no}", f"face_{person_no}_{photo_no}", encoding))
+
+    return entries, centres
+
+def make_queries(centres, count, seed=1):
+    # New photos of enrolled people, returned with the expected person names
+    rng = np.random.default_rng(seed)
+    person_nos = rng.integers(0, len(centres), count)
+    queries = centres[person_nos] + rng.normal(0.0, PHOTO_SCALE, (count, ENCODING_SIZE)).astype(np.float32)
+
+    return queries.astype(np.float32), [f"person_{person_no}" for person_no in person_nos]
+
+def percentile_ms(samples, q):
+
+    return float(np.percentile(np.asarray(samples) * 1000.0, q)) if samples else 0.0
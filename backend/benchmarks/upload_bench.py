@@ -0,0 +1,313 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from io import BytesIO
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import synthetic
+import face_recognition
+
+# End-to-end upload benchmark. For each gallery size it seeds a scratch
+# database with synthetic persons through the database module, then replays
+# a corpus of images against /api/upload with concurrent clients and reports
+# requests/sec plus p50/p95/p99 of the total latency and of every pipeline
+# stage (from the Server-Timing breakdown). Runs offline against an
+# in-process Mongo stand-in (mongomock), a local mongod or the embedded
+# SQLite backend. Run from the backend directory:
+#   python benchmarks/upload_bench.py photos/*.jpg --persons 100 1000 10000 --json before.json
+#   python benchmarks/upload_bench.py photos/*.jpg --persons 100 1000 10000 --json after.json --baseline before.json
+
+# Faces written per insert_many while seeding
+SEED_BATCH_SIZE = 5000
+
+PERCENTILES = (50, 95, 99)
+
+def use_in_process_mongo():
+
+    # Swap pymongo's client for mongomock's before database.py connects
+    try:
+        import mongomock
+        import mongomock.gridfs
+        import mongomock.collection
+    except ImportError:
+        sys.exit("The in-process Mongo stand-in needs mongomock (pip install mongomock), or pass --mongo URI")
+
+    import pymongo
+    mongomock.gridfs.enable_gridfs_integration()
+    pymongo.MongoClient = mongomock.MongoClient
+
+    # pymongo 4.9+ hands bulk operations sort/namespace arguments mongomock does not take
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ('add_update', 'add_replace', 'add_delete'):
+        method = getattr(builder, name, None)
+        if method is None:
+            continue
+        def compatible(self, *args, _method=method, **kwargs):
+            kwargs.pop('sort', None)
+            kwargs.pop('namespace', None)
+            return _method(self, *args, **kwargs)
+        setattr(builder, name, compatible)
+
+def configure(storage, mongo, db_name, detection_cache=False):
+
+    # Settings are read when the backend modules are imported, so this runs first
+    os.environ['FACE_STORAGE'] = storage
+    os.environ['FACE_DEBUG_CAPTURE'] = '0'
+    os.environ['FACE_PROFILE_HEADER'] = '1'
+    if not detection_cache:
+        # The corpus is replayed over and over, which would only measure cache hits
+        os.environ['FACE_DETECTION_CACHE_ENTRIES'] = '0'
+        os.environ['FACE_DETECTION_CACHE_DIR'] = ''
+    if storage == 'sqlite':
+        directory = tempfile.mkdtemp(prefix='upload_bench_')
+        os.environ['FACE_SQLITE_PATH'] = os.path.join(directory, f"{db_name}.db")
+        os.environ['FACE_BLOB_DIR'] = os.path.join(directory, 'blobs')
+        return
+
+    os.environ['FACE_MONGO_DB'] = db_name
+    if mongo == 'memory':
+        use_in_process_mongo()
+    else:
+        os.environ['FACE_MONGO_URI'] = mongo
+
+def git_commit():
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def reset_database(db):
+
+    db.store.drop()
+    db.ensure_indexes()
+    db.face_image_cache.clear()
+    db.gallery.load([])
+
+def seed_gallery(db, persons, per_person, seed):
+
+    entries, _ = synthetic.make_gallery(persons, per_person, seed)
+    for start in range(0, len(entries), SEED_BATCH_SIZE):
+        # Synthetic faces have no stored image
+        db.add_faces_to_persons([
+            (person_name, face_id, None, encoding, None)
+            for person_name, face_id, encoding in entries[start:start + SEED_BATCH_SIZE]
+        ])
+    return len(entries)
+
+def enroll_corpus(db, engine, corpus):
+
+    # Store the corpus faces as known persons so uploads go through matching,
+    # duplicate checks and suppression instead of all ending up unrecognized
+    faces = []
+    for image_no, (filename, img_bytes) in enumerate(corpus):
+        img = face_recognition.load_image_file(BytesIO(img_bytes))
+        job = engine.get_engine().detect_and_encode(img)
+        for face_no, encoding in enumerate(job["face_encodings"]):
+            faces.append((f"corpus_{image_no}_{face_no}", f"corpus_face_{image_no}_{face_no}", None, encoding, None))
+    db.add_faces_to_persons(faces)
+    return len(faces)
+
+def parse_server_timing(header):
+
+    # "decode;dur=4.5, detect;dur=39.7, ..." -> {stage: seconds}
+    stages = {}
+    for part in (header or '').split(','):
+        name, _, duration = part.strip().partition(';dur=')
+        if name and duration:
+            stages[name] = float(duration) / 1000.0
+    return stages
+
+def replay(app, corpus, requests_count, concurrency):
+
+    def upload(request_no):
+        filename, img_bytes = corpus[request_no % len(corpus)]
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.post(
+            '/api/upload',
+            data={'image': (BytesIO(img_bytes), filename)},
+            headers={'X-Profile': '1'},
+            content_type='multipart/form-data'
+        )
+        elapsed = time.perf_counter() - start
+        return response.status_code, elapsed, parse_server_timing(response.headers.get('Server-Timing'))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(upload, range(requests_count)))
+    wall = time.perf_counter() - start
+
+    return samples, wall
+
+def percentiles_ms(samples):
+
+    row = {f"p{q}": round(synthetic.percentile_ms(samples, q), 3) for q in PERCENTILES}
+    row["mean"] = round(float(np.mean(samples)) * 1000.0, 3) if samples else 0.0
+    return row
+
+def summarize(samples, wall):
+
+    statuses = {}
+    stage_samples = {}
+    for status, _, stages in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        for stage, seconds in stages.items():
+            if stage != 'total':
+                stage_samples.setdefault(stage, []).append(seconds)
+
+    return {
+        'requests': len(samples),
+        'statuses': dict(sorted(statuses.items())),
+        'wall_seconds': round(wall, 3),
+        'requests_per_second': round(len(samples) / wall, 3) if wall else 0.0,
+        'latency_ms': percentiles_ms([elapsed for _, elapsed, _ in samples]),
+        'stages_ms': {stage: percentiles_ms(values) for stage, values in sorted(stage_samples.items())},
+    }
+
+def run_benchmark(args, corpus):
+
+    configure(args.storage, args.mongo, args.db_name, args.detection_cache)
+
+    # Imported only now so they pick up the settings above
+    import config
+    import database as db
+    import engine
+    from app import create_app
+    app = create_app(load_gallery=False)
+
+    rows = []
+    for persons in args.persons:
+        reset_database(db)
+
+        start = time.perf_counter()
+        seeded = seed_gallery(db, persons, args.per_person, args.seed)
+        seed_seconds = time.perf_counter() - start
+
+        enrolled = enroll_corpus(db, engine, corpus) if args.enroll else 0
+
+        start = time.perf_counter()
+        db.gallery.load(db.iter_gallery_entries())
+        load_seconds = time.perf_counter() - start
+
+        # Warm-up requests start the detection workers and are not counted
+        replay(app, corpus, args.warmup, args.concurrency)
+        samples, wall = replay(app, corpus, args.requests, args.concurrency)
+
+        row = {
+            'persons': persons,
+            'per_person': args.per_person,
+            'gallery_size': seeded + enrolled,
+            'seed_seconds': round(seed_seconds, 3),
+            'load_seconds': round(load_seconds, 3),
+            'concurrency': args.concurrency,
+        }
+        row.update(summarize(samples, wall))
+        rows.append(row)
+        print_row(row)
+
+    db.store.drop()
+    engine.shutdown_engine()
+
+    meta = {
+        'benchmark': 'upload',
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'storage': args.storage,
+        'mongo': 'memory' if args.mongo == 'memory' else 'server',
+        'corpus': [filename for filename, _ in corpus],
+        'enroll': args.enroll,
+        'seed': args.seed,
+        'settings': {
+            'engine_workers': config.ENGINE_WORKERS,
+            'detection_cache': bool(config.DETECTION_CACHE_ENTRIES or config.DETECTION_CACHE_DIR),
+            'match_index': config.MATCH_INDEX,
+            'match_prototypes': config.MATCH_PROTOTYPES,
+            'detect_downscale': config.DETECT_DOWNSCALE,
+            'near_dup_enabled': config.NEAR_DUP_ENABLED,
+            'response_images': config.RESPONSE_IMAGES,
+        },
+    }
+    return {'meta': meta, 'rows': rows}
+
+def print_row(row):
+
+    latency = row['latency_ms']
+    print(f"\ngallery {row['gallery_size']}: {row['requests_per_second']:.2f} req/s, "
+          f"p50 {latency['p50']:.1f} ms, p95 {latency['p95']:.1f} ms, p99 {latency['p99']:.1f} ms, "
+          f"statuses {row['statuses']}")
+    print(f"  {'stage':<12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, timing in row['stages_ms'].items():
+        print(f"  {stage:<12}{timing['p50']:>10.2f}{timing['p95']:>10.2f}{timing['p99']:>10.2f}")
+
+def compare(baseline, results):
+
+    # p50/p95 changes against an earlier run, matched by gallery size
+    previous = {(row['persons'], row['per_person']): row for row in baseline['rows']}
+    print(f"\nAgainst baseline {baseline['meta'].get('git_commit')} ({baseline['meta'].get('created_at')}):")
+
+    for row in results['rows']:
+        old = previous.get((row['persons'], row['per_person']))
+        if old is None:
+            print(f"  gallery {row['gallery_size']}: not in baseline")
+            continue
+
+        print(f"  gallery {row['gallery_size']}: req/s {old['requests_per_second']:.2f} -> {row['requests_per_second']:.2f}")
+        timings = [('total', old['latency_ms'], row['latency_ms'])]
+        timings += [(stage, old['stages_ms'][stage], timing)
+                    for stage, timing in row['stages_ms'].items() if stage in old['stages_ms']]
+        for stage, old_timing, timing in timings:
+            changes = []
+            for key in ('p50', 'p95'):
+                change = (timing[key] - old_timing[key]) / old_timing[key] * 100 if old_timing[key] else 0.0
+                changes.append(f"{key} {old_timing[key]:.2f} -> {timing[key]:.2f} ms ({change:+.1f}%)")
+            print(f"    {stage:<12}{', '.join(changes)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark /api/upload latency per stage as the gallery grows")
+    parser.add_argument('images', nargs='+', help="corpus of images to upload, replayed round-robin")
+    parser.add_argument('--persons', type=int, nargs='+', default=[100, 1000, 10000],
+                        help="gallery sizes to test, in persons")
+    parser.add_argument('--per-person', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=100, help="uploads measured per gallery size")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=4)
+    parser.add_argument('--enroll', action='store_true', help="store the corpus faces as known persons first")
+    parser.add_argument('--detection-cache', action='store_true',
+                        help="keep the detection cache on, so repeated uploads of the corpus are cache hits")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage', choices=('mongo', 'sqlite'), default='mongo')
+    parser.add_argument('--mongo', default='memory', help="'memory' for mongomock or a MongoDB URI")
+    parser.add_argument('--db-name', default='face_recognition_bench', help="scratch database, dropped between runs")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if args.db_name == 'face_recognition_db':
+        sys.exit("Refusing to benchmark against the application database, pick another --db-name")
+
+    corpus = []
+    for path in args.images:
+        with open(path, 'rb') as f:
+            corpus.append((os.path.basename(path), f.read()))
+
+    results = run_benchmark(args, corpus)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,45 @@
+import argparse
+import time
+import config
+import database as db
+from ann_index import create_gallery_index
+
+# Rebuilds the approximate match index from the stored person encodings
+# and writes it to FACE_ANN_INDEX_PATH (or --output)
+
+def build_index(kind, output, nlist=None, nprobe=None):
+    print("Loading encodings from the database...")
+    entries = list(db.iter_gallery_entries())
+    print(f"Found {len(entries)} encodings")
+    
+    options = {}
+    if nlist is not None:
+        options['nlist'] = nlist
+    if nprobe is not None:
+        options['nprobe'] = nprobe
+    index = create_gallery_index(kind, **options)
+    
+    if not index.persistent:
+        print(f"The '{kind}' index is rebuilt in memory at startup - nothing to write")
+        return
+    
+    print(f"Building {kind} index...")
+    start = time.perf_counter()
+    index.load(entries)
+    print(f"Built index over {len(index)} encodings in {time.perf_counter() - start:.2f}s")
+    
+    index.save(output)
+    print(f"Index written to {output}")
+    
+    print("\nDone! Restart the application to pick up the new index.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the approximate face match index")
+    parser.add_argument('--kind', default=config.MATCH_INDEX if config.MATCH_INDEX != 'exact' else 'ivf',
+                        choices=['ivf', 'hnsw'], help="index type to build")
+    parser.add_argument('--output', default=config.ANN_INDEX_PATH, help="index file to write")
+    parser.add_argument('--nlist', type=int, help="IVF inverted lists (default: from gallery size)")
+    parser.add_argument('--nprobe', type=int, help="IVF lists probed per query")
+    args = parser.parse_args()
+    
+    build_index(args.kind, args.output, args.nlist, args.nprobe)
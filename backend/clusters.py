@@ -0,0 +1,209 @@
+import threading
+import numpy as np
+from gallery_index import GalleryIndex, ENCODING_SIZE
+
+# Incremental Chinese-whispers clustering of unrecognized faces.
+# Faces closer than the threshold are linked in a graph. A new face joins the
+# cluster most of its linked faces belong to (ties go to the closest face),
+# or starts its own - the Chinese-whispers label update applied to the new
+# node only, so inserting stays one matrix-vector product. recluster() runs
+# full whispers passes over the graph to merge clusters that new faces have
+# bridged, and splits clusters a removed face held together. A cluster is
+# named after the face it started from, so ids stay stable as faces join, and
+# replaying the faces in insertion order rebuilds the same clusters after a
+# restart.
+
+# Faces clustered per distance block when many are added at once
+ADD_BLOCK_SIZE = 1024
+
+class UnknownClusters:
+
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self._lock = threading.RLock()
+        self.loaded = False
+        self._reset()
+
+    def _reset(self):
+        # Neighbour search over all clustered faces; labels are the face ids
+        self._index = GalleryIndex(initial_capacity=256)
+        # face_id -> cluster id, cluster id -> {face_id: None} (an ordered set),
+        # face_id -> {linked face_id: distance}
+        self._labels = {}
+        self._members = {}
+        self._edges = {}
+        # Insertion order, for deterministic whispers passes
+        self._order = {}
+        self._next = 0
+        # Faces were added or removed since the last recluster()
+        self._added = False
+        self._removed = False
+
+    def __len__(self):
+        return len(self._labels)
+
+    def load(self, entries):
+
+        # Rebuild from (face_id, encoding) entries in insertion order
+        with self._lock:
+            self._reset()
+            self.add_many(entries)
+            self.recluster()
+            self.loaded = True
+
+    def add_many(self, entries):
+
+        # Cluster new (face_id, encoding) entries; returns their cluster ids
+        entries = [(face_id, encoding) for face_id, encoding in entries]
+        labels = {}
+
+        with self._lock:
+            for start in range(0, len(entries), ADD_BLOCK_SIZE):
+                block = [(face_id, encoding) for face_id, encoding in entries[start:start + ADD_BLOCK_SIZE]
+                         if face_id not in self._labels]
+                if block:
+                    self._add_block(block)
+            for face_id, _ in entries:
+                labels[face_id] = self._labels.get(face_id)
+
+        return labels
+
+    def _add_block(self, block):
+        encodings = np.asarray([encoding for _, encoding in block], dtype=np.float32).reshape(-1, ENCODING_SIZE)
+
+        # Links to faces clustered before this block, then within it
+        earlier = self._index.search_batch(encodings, self.threshold)
+        norms = np.einsum('ij,ij->i', encodings, encodings)
+        within = np.sqrt(np.maximum(norms[:, None] + norms[None, :] - 2.0 * (encodings @ encodings.T), 0.0))
+
+        for i, (face_id, _) in enumerate(block):
+            links = {other_id: distance for _, other_id, distance in earlier[i]}
+            for j in np.flatnonzero(within[i, :i] < self.threshold):
+                links[block[j][0]] = float(within[i, j])
+
+            self._edges[face_id] = links
+            for other_id, distance in links.items():
+                self._edges[other_id][face_id] = distance
+            self._order[face_id] = self._next
+            self._next += 1
+
+            self._set_label(face_id, self._vote(face_id) or face_id)
+
+        self._added = True
+        self._index.add_many((face_id, face_id, encoding) for face_id, encoding in block)
+
+    def _vote(self, face_id):
+        # The label most linked faces carry, the closest one breaking ties
+        votes = {}
+        for other_id, distance in self._edges[face_id].items():
+            label = self._labels.get(other_id)
+            if label is None:
+                continue
+            count, closest = votes.get(label, (0, float('inf')))
+            votes[label] = (count + 1, min(closest, distance))
+
+        if not votes:
+            return None
+        return min(votes, key=lambda label: (-votes[label][0], votes[label][1], label))
+
+    def _set_label(self, face_id, label):
+        old = self._labels.get(face_id)
+        if old == label:
+            return
+        if old is not None:
+            del self._members[old][face_id]
+            if not self._members[old]:
+                del self._members[old]
+        self._labels[face_id] = label
+        self._members.setdefault(label, {})[face_id] = None
+
+    def _split_disconnected(self):
+        # Each connected part of a cluster but the one holding its oldest face
+        # becomes a cluster of its own, named after its oldest face
+        for label, members in list(self._members.items()):
+            if len(members) < 2:
+                continue
+
+            unvisited = set(members)
+            parts = []
+            for start in sorted(members, key=self._order.get):
+                if start not in unvisited:
+                    continue
+                unvisited.discard(start)
+                part, stack = [start], [start]
+                while stack:
+                    for other_id in self._edges[stack.pop()]:
+                        if other_id in unvisited:
+                            unvisited.discard(other_id)
+                            part.append(other_id)
+                            stack.append(other_id)
+                parts.append(part)
+
+            for part in parts[1:]:
+                new_label = min(part, key=self._order.get)
+                for face_id in part:
+                    self._set_label(face_id, new_label)
+
+    def recluster(self, iterations=5):
+
+        # Full whispers passes in insertion order until no label changes,
+        # if anything changed since the last one; returns the number of
+        # faces that moved
+        moved = 0
+        with self._lock:
+            if self._removed:
+                self._split_disconnected()
+            if not (self._added or self._removed):
+                return 0
+            self._added = self._removed = False
+
+            faces = sorted(self._labels, key=self._order.get)
+            for _ in range(iterations):
+                changed = 0
+                for face_id in faces:
+                    label = self._vote(face_id)
+                    if label is not None and label != self._labels[face_id]:
+                        self._set_label(face_id, label)
+                        changed += 1
+                moved += changed
+                if not changed:
+                    break
+        return moved
+
+    def remove(self, face_ids):
+
+        with self._lock:
+            for face_id in face_ids:
+                label = self._labels.pop(face_id, None)
+                if label is None:
+                    continue
+                del self._members[label][face_id]
+                if not self._members[label]:
+                    del self._members[label]
+                for other_id in self._edges.pop(face_id, {}):
+                    self._edges[other_id].pop(face_id, None)
+                del self._order[face_id]
+                self._index.remove_face(face_id)
+                self._removed = True
+
+    def clear(self):
+
+        with self._lock:
+            self._reset()
+            self.loaded = False
+
+    def cluster_of(self, face_id):
+
+        return self._labels.get(face_id)
+
+    def members(self, cluster_id):
+
+        with self._lock:
+            return list(self._members.get(cluster_id, []))
+
+    def clusters(self, min_size=1):
+
+        # (cluster id, face ids) of every cluster, largest first
+        with self._lock:
+            clusters = [(label, list(members)) for label, members in self._members.items() if len(members) >= min_size]
+        return sorted(clusters, key=lambda cluster: (-len(cluster[1]), self._order.get(cluster[1][0], 0)))
@@ -0,0 +1,180 @@
+import os
+
+# Application settings, overridable through environment variables
+
+def _env_int(name, default):
+
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+def _env_bool(name, default):
+
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def _env_str(name, default):
+
+    value = os.environ.get(name)
+    return value if value not in (None, '') else default
+
+# Storage backend: 'mongo' (MongoDB + GridFS) or 'sqlite' (embedded SQLite
+# database with images in a content-addressed directory)
+STORAGE = _env_str('FACE_STORAGE', 'mongo')
+
+# MongoDB server and database, connection pool bounds, connect/server
+# selection timeout in milliseconds and write concern ('' = server default,
+# e.g. '1' or 'majority')
+MONGO_URI = _env_str('FACE_MONGO_URI', 'mongodb://localhost:27017/')
+MONGO_DB = _env_str('FACE_MONGO_DB', 'face_recognition_db')
+MONGO_MAX_POOL_SIZE = _env_int('FACE_MONGO_MAX_POOL_SIZE', 100)
+MONGO_MIN_POOL_SIZE = _env_int('FACE_MONGO_MIN_POOL_SIZE', 0)
+MONGO_TIMEOUT_MS = _env_int('FACE_MONGO_TIMEOUT_MS', 30000)
+MONGO_WRITE_CONCERN = _env_str('FACE_MONGO_WRITE_CONCERN', '')
+
+# SQLite backend: database file and image blob directory
+SQLITE_PATH = _env_str('FACE_SQLITE_PATH', os.path.join(os.path.dirname(__file__), 'data', 'faces.db'))
+BLOB_DIR = _env_str('FACE_BLOB_DIR', os.path.join(os.path.dirname(__file__), 'data', 'blobs'))
+
+# Matching index: 'exact' (brute force), 'ivf' (NumPy IVF-flat), 'hnsw' (needs
+# hnswlib) or 'snapshot' (brute force over a memory-mapped snapshot shared by
+# the worker processes of a host)
+MATCH_INDEX = _env_str('FACE_MATCH_INDEX', 'exact')
+
+# Snapshot index: directory of the published snapshots, and seconds a process
+# collects changes before publishing them as a new snapshot (0 = at once)
+GALLERY_SNAPSHOT_DIR = _env_str(
+    'FACE_GALLERY_SNAPSHOT_DIR',
+    os.path.join(os.path.dirname(__file__), 'data', 'gallery_snapshot')
+)
+GALLERY_SNAPSHOT_DELAY = float(_env_str('FACE_GALLERY_SNAPSHOT_DELAY', '0.5'))
+
+# Gallery change log: seconds a process may match against its index before
+# applying the changes other processes logged (0 = before every match, -1 =
+# never), changes behind beyond which it reloads the whole gallery instead,
+# and seconds logged changes are kept before retention prunes them
+GALLERY_SYNC_INTERVAL = float(_env_str('FACE_GALLERY_SYNC_INTERVAL', '1'))
+GALLERY_SYNC_MAX_CHANGES = _env_int('FACE_GALLERY_SYNC_MAX_CHANGES', 10000)
+GALLERY_CHANGES_TTL = _env_int('FACE_GALLERY_CHANGES_TTL', 24 * 3600)
+
+# Prototype mode: when > 0, each person is matched through their centroid and
+# at most this many medoid encodings instead of every stored encoding
+MATCH_PROTOTYPES = _env_int('FACE_MATCH_PROTOTYPES', 0)
+
+# Where the approximate index is persisted between runs
+ANN_INDEX_PATH = _env_str(
+    'FACE_ANN_INDEX_PATH',
+    os.path.join(os.path.dirname(__file__), 'data', 'gallery_index.npz')
+)
+
+# IVF: number of inverted lists (0 picks one from the gallery size) and lists probed per query
+ANN_NLIST = _env_int('FACE_ANN_NLIST', 0)
+ANN_NPROBE = _env_int('FACE_ANN_NPROBE', 8)
+
+# HNSW: graph degree, build and query beam widths
+ANN_HNSW_M = _env_int('FACE_ANN_HNSW_M', 16)
+ANN_HNSW_EF_CONSTRUCTION = _env_int('FACE_ANN_HNSW_EF_CONSTRUCTION', 200)
+ANN_HNSW_EF_SEARCH = _env_int('FACE_ANN_HNSW_EF_SEARCH', 64)
+
+# Batch upload: threads decoding images and the most images per request
+BATCH_WORKERS = _env_int('FACE_BATCH_WORKERS', 4)
+BATCH_MAX_IMAGES = _env_int('FACE_BATCH_MAX_IMAGES', 200)
+
+# Detection/encoding worker pool: processes (-1 = one per CPU, 0 = run inline),
+# queued + running jobs before uploads get a 503 (0 = twice the workers),
+# seconds a request waits for its job, and how worker processes are started
+ENGINE_WORKERS = _env_int('FACE_ENGINE_WORKERS', -1)
+ENGINE_QUEUE_DEPTH = _env_int('FACE_ENGINE_QUEUE_DEPTH', 0)
+ENGINE_TIMEOUT = _env_int('FACE_ENGINE_TIMEOUT', 60)
+ENGINE_START_METHOD = _env_str('FACE_ENGINE_START_METHOD', 'spawn')
+
+# Detection cache for repeated images: results kept in memory (0 = off), and
+# an optional directory persisting them across restarts, pruned to
+# DETECTION_CACHE_MAX_BYTES
+DETECTION_CACHE_ENTRIES = _env_int('FACE_DETECTION_CACHE_ENTRIES', 256)
+DETECTION_CACHE_DIR = _env_str('FACE_DETECTION_CACHE_DIR', '')
+DETECTION_CACHE_MAX_BYTES = _env_int('FACE_DETECTION_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+
+# Asynchronous uploads (?async=1): threads running upload jobs, queued plus
+# running jobs before uploads get a 503, how many finished jobs are kept and
+# for how many seconds, and the keep-alive interval of result streams
+UPLOAD_JOB_WORKERS = _env_int('FACE_UPLOAD_JOB_WORKERS', 2)
+UPLOAD_JOB_QUEUE = _env_int('FACE_UPLOAD_JOB_QUEUE', 32)
+UPLOAD_JOB_MAX_FINISHED = _env_int('FACE_UPLOAD_JOB_MAX_FINISHED', 100)
+UPLOAD_JOB_TTL = _env_int('FACE_UPLOAD_JOB_TTL', 600)
+UPLOAD_STREAM_KEEPALIVE = _env_int('FACE_UPLOAD_STREAM_KEEPALIVE', 15)
+
+# Video ingestion (/api/upload/video): frames sampled per second of video, the
+# box overlap linking a detection to a track, sampled frames a track may go
+# unseen before it ends, encodings per track and sampled frames between them,
+# detections a track needs to be kept, and the longest video processed in
+# seconds (0 = no limit)
+VIDEO_SAMPLE_FPS = float(_env_str('FACE_VIDEO_SAMPLE_FPS', '2'))
+VIDEO_TRACK_IOU = float(_env_str('FACE_VIDEO_TRACK_IOU', '0.3'))
+VIDEO_TRACK_MAX_GAP = _env_int('FACE_VIDEO_TRACK_MAX_GAP', 2)
+VIDEO_ENCODINGS_PER_TRACK = _env_int('FACE_VIDEO_ENCODINGS_PER_TRACK', 3)
+VIDEO_ENCODE_INTERVAL = _env_int('FACE_VIDEO_ENCODE_INTERVAL', 4)
+VIDEO_MIN_TRACK_LENGTH = _env_int('FACE_VIDEO_MIN_TRACK_LENGTH', 2)
+VIDEO_MAX_SECONDS = _env_int('FACE_VIDEO_MAX_SECONDS', 3600)
+
+# 1:1 verification (/api/verify): a face is accepted as the claimed person
+# when its distance to the closest of their encodings is below this. The
+# default corresponds to the confidence of 60 uploads need to match;
+# requests may only lower it
+VERIFY_THRESHOLD = float(_env_str('FACE_VERIFY_THRESHOLD', '0.4'))
+
+# Debug captures of uploads with face boxes drawn: off by default; when on,
+# 1 in DEBUG_SAMPLE_RATE uploads is written by a background thread and the
+# directory is pruned to DEBUG_MAX_BYTES / files older than DEBUG_MAX_AGE seconds
+DEBUG_CAPTURE = _env_bool('FACE_DEBUG_CAPTURE', False)
+DEBUG_SAMPLE_RATE = _env_int('FACE_DEBUG_SAMPLE_RATE', 1)
+DEBUG_QUEUE_SIZE = _env_int('FACE_DEBUG_QUEUE_SIZE', 16)
+DEBUG_DIR = _env_str('FACE_DEBUG_DIR', os.path.join(os.path.dirname(__file__), 'debug'))
+DEBUG_MAX_BYTES = _env_int('FACE_DEBUG_MAX_BYTES', 200 * 1024 * 1024)
+DEBUG_MAX_AGE = _env_int('FACE_DEBUG_MAX_AGE', 7 * 24 * 3600)
+
+# Detect faces on a downscaled copy sized so the smallest face kept by the
+# size filter is still DETECT_MIN_FACE_PX wide; boxes are mapped back and
+# encodings are computed from the full-resolution image
+DETECT_DOWNSCALE = _env_bool('FACE_DETECT_DOWNSCALE', True)
+DETECT_MIN_FACE_PX = _env_int('FACE_DETECT_MIN_FACE_PX', 100)
+
+# Near-duplicate suppression: a face is not stored again for a person when an
+# existing face of theirs is within NEAR_DUP_ENCODING_DISTANCE and its
+# perceptual hash differs in at most NEAR_DUP_HASH_DISTANCE of 64 bits
+NEAR_DUP_ENABLED = _env_bool('FACE_NEAR_DUP_ENABLED', True)
+NEAR_DUP_ENCODING_DISTANCE = float(_env_str('FACE_NEAR_DUP_ENCODING_DISTANCE', '0.3'))
+NEAR_DUP_HASH_DISTANCE = _env_int('FACE_NEAR_DUP_HASH_DISTANCE', 10)
+
+# Clustering of unrecognized faces: faces closer than CLUSTER_DISTANCE are
+# linked, and each new unknown face joins the cluster of most faces it is
+# linked to
+CLUSTER_ENABLED = _env_bool('FACE_CLUSTER_ENABLED', True)
+CLUSTER_DISTANCE = float(_env_str('FACE_CLUSTER_DISTANCE', '0.5'))
+
+# Face images: how upload responses carry the crops ('base64' inline data
+# URIs or 'url' links to /api/face/<face_id>/image; ?images= overrides it),
+# the browser cache lifetime of served images, and the byte budget of the
+# in-process cache of recently served images
+RESPONSE_IMAGES = _env_str('FACE_RESPONSE_IMAGES', 'base64')
+FACE_IMAGE_MAX_AGE = _env_int('FACE_IMAGE_MAX_AGE', 365 * 24 * 3600)
+FACE_IMAGE_CACHE_BYTES = _env_int('FACE_IMAGE_CACHE_BYTES', 32 * 1024 * 1024)
+
+# Retention: unrecognized faces older than UNRECOGNIZED_TTL seconds are
+# deleted (0 keeps them forever). The GridFS garbage collector removes files
+# no face or encoding record references, once they are older than GC_GRACE
+# seconds; it works through GC_BATCH_SIZE files at a time, sleeping
+# GC_BATCH_PAUSE seconds between batches. With RETENTION_INTERVAL > 0 both
+# run in the background every that many seconds
+UNRECOGNIZED_TTL = _env_int('FACE_UNRECOGNIZED_TTL', 0)
+GC_GRACE = _env_int('FACE_GC_GRACE', 3600)
+GC_BATCH_SIZE = _env_int('FACE_GC_BATCH_SIZE', 500)
+GC_BATCH_PAUSE = float(_env_str('FACE_GC_BATCH_PAUSE', '0.2'))
+RETENTION_INTERVAL = _env_int('FACE_RETENTION_INTERVAL', 0)
+
+# Logging level of the backend ('DEBUG' also logs every detected face and
+# why it was filtered out), and whether a request sending 'X-Profile: 1' gets
+# its per-stage timings back in a Server-Timing header
+LOG_LEVEL = _env_str('FACE_LOG_LEVEL', 'INFO').upper()
+PROFILE_HEADER = _env_bool('FACE_PROFILE_HEADER', True)
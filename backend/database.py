@@ -1,334 +1,783 @@
-import json
 import uuid
 import base64
 import numpy as np
-import gridfs
 import face_recognition
 import os
-import cv2
-from pymongo import MongoClient
-from bson.objectid import ObjectId
 from datetime import datetime
 from PIL import Image
 from io import BytesIO
 import hashlib
+import logging
+import threading
+import config
+import near_duplicate
+from storage import create_storage
+from ann_index import create_gallery_index
+from prototypes import PrototypeIndex
+from image_cache import ImageCache
+from clusters import UnknownClusters
+from gallery_sync import GallerySync
 
-# MongoDB connection setup - Creates the connection to MongoDB database
-# Use direct connection string without dotenv
-mongo_uri = 'mongodb://localhost:27017/'
-db_name = 'face_recognition_db'
+logger = logging.getLogger(__name__)
 
-client = MongoClient(mongo_uri)
-db = client[db_name]
-fs = gridfs.GridFS(db)
+# Persons, faces, images and history live in the configured storage backend
+# (MongoDB/GridFS or embedded SQLite, see storage.py); this module holds the
+# matching and duplicate logic and the in-process gallery index and caches
+store = create_storage()
 
-# Collections used in the application
-persons_collection = db['persons']
-encodings_collection = db['encodings']
-history_collection = db['history']
+# Distance below which a stored encoding counts as a match
+MATCH_THRESHOLD = 0.6
+
+# History event types: an uploaded image, a face stored for a person, and an
+# unrecognized face waiting to be named
+HISTORY_EVENT_TYPES = ('upload', 'recognized', 'unrecognized')
+
+# Default and largest page of history events returned by get_history
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+# Default and largest page of the person and unrecognized face listings
+LISTING_PAGE_SIZE = 100
+LISTING_MAX_PAGE_SIZE = 1000
+
+# Process-resident index of all person encodings used for matching.
+# Exact brute force by default; IVF or HNSW when FACE_MATCH_INDEX says so
+gallery = create_gallery_index(config.MATCH_INDEX)
+
+# Prototype mode: match against each person's centroid and k medoids only
+if config.MATCH_PROTOTYPES > 0:
+    gallery = PrototypeIndex(
+        gallery,
+        config.MATCH_PROTOTYPES,
+        lambda person_name: list(iter_gallery_entries(person_name=person_name))
+    )
+
+# Recently served face images, as (img_bytes, etag) by face id
+face_image_cache = ImageCache(config.FACE_IMAGE_CACHE_BYTES)
+
+# Clusters of similar unrecognized faces, so they can be named together.
+# Built from the stored faces on first use, kept up to date with this
+# process's changes and synced with the other processes' before being read
+unknown_clusters = UnknownClusters(config.CLUSTER_DISTANCE)
+
+# Stored (count, newest id, version) of the unrecognized faces the clusters
+# last caught up with. Other worker processes store, name and delete
+# unrecognized faces too; a different version means the clusters have to
+# read their changes
+unknown_clusters_state = None
+unknown_clusters_lock = threading.Lock()
+
+# Applies the gallery changes other processes make to this one's index, at
+# most FACE_GALLERY_SYNC_INTERVAL seconds after they happen
+gallery_sync = GallerySync(
+    store, gallery, lambda: load_gallery_index(),
+    interval=config.GALLERY_SYNC_INTERVAL,
+    max_changes=config.GALLERY_SYNC_MAX_CHANGES
+)
+
+def iter_gallery_entries(person_name=None, face_ids=None):
+    
+    # (person_name, face_id, encoding) of all stored faces, one person's or the given ones
+    return store.iter_faces(person_name, face_ids)
+
+def load_gallery_index():
+    
+    loaded_from_file = False
+    
+    # Changes logged from here on are replayed on top of what gets loaded
+    generation = store.gallery_generation()
+    
+    if getattr(gallery, 'shared', False):
+        # Map the snapshot the worker processes share (the first one builds it)
+        # and catch up with changes stored while nothing was running
+        gallery.open(iter_gallery_entries)
+        reconcile_gallery_index()
+        loaded_from_file = True
+    elif gallery.persistent and os.path.exists(config.ANN_INDEX_PATH):
+        # Start from the persisted index and catch up with changes made since
+        try:
+            gallery.load_file(config.ANN_INDEX_PATH)
+            reconcile_gallery_index()
+            loaded_from_file = True
+        except Exception as e:
+            logger.warning("Error loading gallery index from %s, rebuilding: %s", config.ANN_INDEX_PATH, e)
+    
+    if not loaded_from_file:
+        gallery.load(iter_gallery_entries())
+    
+    gallery_sync.reset(generation)
+    logger.info("Loaded %d encodings into the gallery index", len(gallery))
+    
+    return len(gallery)
+
+def reconcile_gallery_index():
+    
+    indexed_ids = gallery.face_ids()
+    stored_ids = store.face_ids()
+    
+    # Drop faces deleted since the index was saved
+    for face_id in indexed_ids - stored_ids:
+        gallery.remove_face(face_id)
+    
+    # Add faces stored since the index was saved
+    missing_ids = list(stored_ids - indexed_ids)
+    for start in range(0, len(missing_ids), store.batch_size):
+        gallery.add_many(iter_gallery_entries(face_ids=missing_ids[start:start + store.batch_size]))
+
+def save_gallery_index(path=None):
+    
+    # A shared snapshot only needs this process's unpublished changes written
+    if getattr(gallery, 'shared', False):
+        if gallery.loaded:
+            gallery.flush()
+        return gallery.loaded
+    
+    if not gallery.persistent or not gallery.loaded:
+        return False
+    
+    gallery.save(path or config.ANN_INDEX_PATH)
+    
+    return True
+
+def load_unknown_clusters():
+    
+    global unknown_clusters_state
+    
+    # Faces stored while loading show up as a state change on the next sync
+    state = store.unrecognized_state()
+    unknown_clusters.load(store.iter_unrecognized())
+    unknown_clusters_state = state
+    logger.info("Clustered %d unrecognized faces", len(unknown_clusters))
+    
+    return len(unknown_clusters)
+
+def sync_unknown_clusters():
+    
+    global unknown_clusters_state
+    
+    # Bring the clusters up to date with the stored unrecognized faces before
+    # they are read, so every worker process serves the same clusters
+    with unknown_clusters_lock:
+        if not unknown_clusters.loaded:
+            load_unknown_clusters()
+            return
+        
+        state = store.unrecognized_state()
+        count, newest, version = unknown_clusters_state
+        if state[2] == version:
+            return
+        
+        # The version moves one step per face changed. When the faces stored
+        # after the newest one seen account for every step, faces were only
+        # added since, and the clusters (which hold this process's own
+        # already) just take them in
+        added = list(store.iter_unrecognized(after=newest))
+        if state[2] - version == len(added) and state[0] - count == len(added):
+            unknown_clusters.add_many(added)
+            unknown_clusters_state = state
+            return
+        
+        # Faces were named, deleted or put back: rebuild
+        load_unknown_clusters()
+
+def cluster_unrecognized_faces(faces):
+    
+    # Cluster new (face_id, encoding) unrecognized faces, {face_id: cluster id}
+    if not config.CLUSTER_ENABLED:
+        return {}
+    
+    # Loading reads the new faces as well
+    if not unknown_clusters.loaded:
+        load_unknown_clusters()
+    
+    return unknown_clusters.add_many(faces)
+
+def get_unrecognized_clusters(min_size=1):
+    
+    # (cluster id, face ids) of the clusters, largest first
+    sync_unknown_clusters()
+    unknown_clusters.recluster()
+    
+    return unknown_clusters.clusters(min_size)
+
+def get_cluster_faces(cluster_id):
+    
+    sync_unknown_clusters()
+    unknown_clusters.recluster()
+    
+    return unknown_clusters.members(cluster_id)
+
+def get_face_cluster(face_id):
+    
+    return unknown_clusters.cluster_of(face_id)
+
+def ensure_indexes():
+    
+    # Indexes (MongoDB) or tables and indexes (SQLite) the application relies on
+    store.ensure_schema()
+
+def person_exists(person_name):
+    
+    return store.person_exists(person_name)
+
+def person_has_face(person_name, face_id):
+    
+    return store.has_face(person_name, face_id)
+
+def get_person_faces(person_name):
+    
+    # Face ids of a person, newest first - no images or encodings
+    return store.person_face_ids(person_name)
 
 def get_all_persons():
     
-    persons = list(persons_collection.find({}, {'name': 1}))
-    unrecognized = list(encodings_collection.find({'recognized': False}, {'_id': 1}))
+    return {
+        "persons": store.person_names(),
+        "unrecognized": store.unrecognized_ids()
+    }
+
+def persons_etag():
+    
+    # Every change to the persons and their faces is logged in the gallery
+    # change log, so its latest generation versions the person listings
+    return f"persons-{store.gallery_generation()}"
+
+def unrecognized_state():
+    
+    # (count, etag) of the faces waiting to be named. Every face added,
+    # named, put back or deleted moves the stored version, so it versions
+    # the listing
+    count, _, version = store.unrecognized_state()
+    return count, f"unrecognized-{version}"
+
+def get_persons_page(prefix=None, cursor=None, limit=LISTING_PAGE_SIZE):
+    
+    # One page of persons by name, optionally only those whose names start
+    # with prefix. cursor is the last name of the previous page; next_cursor
+    # is None on the last page
+    limit = max(1, min(limit, LISTING_MAX_PAGE_SIZE))
+    persons = store.person_page(prefix or None, cursor, limit + 1)
     
     return {
-        "persons": [person['name'] for person in persons],
-        "unrecognized": [str(face['_id']) for face in unrecognized]
+        "persons": persons[:limit],
+        "total": store.count_persons(prefix or None),
+        "next_cursor": persons[limit - 1]['name'] if len(persons) > limit else None
     }
 
-def get_history():
+def valid_unrecognized_id(face_record_id):
     
-    history = history_collection.find_one({'type': 'history'}) or {
-        'image_history': [],
-        'recognized_persons': [],
-        'unrecognized_persons': []
+    # Unrecognized faces use the same id scheme as history events
+    return store.valid_event_id(face_record_id)
+
+def get_unrecognized_page(cursor=None, limit=LISTING_PAGE_SIZE):
+    
+    # One page of the faces waiting to be named, newest first, without
+    # their encodings. cursor is the id of the last face of the previous page
+    limit = max(1, min(limit, LISTING_MAX_PAGE_SIZE))
+    faces = store.unrecognized_page(cursor, limit + 1)
+    
+    return {
+        "faces": [
+            dict(face, timestamp=face['timestamp'].isoformat() if face['timestamp'] else None)
+            for face in faces[:limit]
+        ],
+        "next_cursor": faces[limit - 1]['id'] if len(faces) > limit else None
     }
+
+def serialize_history_event(event):
     
-    # Remove MongoDB _id from the response
-    if '_id' in history:
-        del history['_id']
-        
-    return history
+    event = dict(event)
+    event['timestamp'] = event['timestamp'].isoformat()
+    
+    return event
 
-def save_history(data):
+def append_history(events):
     
-    if not data:
-        return False
-        
-    history = {
-        'type': 'history',
-        'image_history': data.get('image_history', []),
-        'recognized_persons': data.get('recognized_persons', []),
-        'unrecognized_persons': data.get('unrecognized_persons', [])
+    # Events are dicts with a 'type' and their payload; faces are referenced
+    # by face_id, never embedded. Returns the stored events in API form
+    if not events:
+        return []
+    
+    now = datetime.now()
+    stored = store.append_history([dict(event, timestamp=now) for event in events])
+    
+    return [serialize_history_event(event) for event in stored]
+
+def valid_history_id(event_id):
+    
+    return store.valid_event_id(event_id)
+
+def get_history(event_type, cursor=None, limit=HISTORY_PAGE_SIZE):
+    
+    # One page of events, newest first. cursor is the id of the last event of
+    # the previous page; next_cursor is None on the last page
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    events = store.history_page(event_type, cursor, limit + 1)
+    
+    next_cursor = events[limit - 1]['id'] if len(events) > limit else None
+    
+    return {
+        "events": [serialize_history_event(event) for event in events[:limit]],
+        "next_cursor": next_cursor
     }
+
+def delete_history_event(event_id):
     
-    # Update or insert history document
-    result = history_collection.update_one(
-        {'type': 'history'}, 
-        {'$set': history}, 
-        upsert=True
-    )
+    return bool(store.delete_history_event(event_id))
+
+def delete_face_history(face_ids, event_type):
     
-    return bool(result.acknowledged)
+    store.delete_history(event_type, face_ids=list(face_ids))
 
-def save_face_image(img_bytes, face_id):
+def save_face_image(img_bytes, face_id, img_hash=None, phash=None):
     
-    return fs.put(img_bytes, filename=f"{face_id}.jpg", content_type="image/jpeg")
+    # The content and perceptual hashes are stored with the image so duplicate
+    # checks never re-read it
+    return store.put_blob(img_bytes, f"{face_id}.jpg", img_hash or image_hash(img_bytes), phash)
+
+def save_face_images(images):
+    
+    # Bulk version of save_face_image for (img_bytes, face_id, phash) tuples
+    if not images:
+        return []
+    
+    return store.put_blobs([
+        (img_bytes, f"{face_id}.jpg", image_hash(img_bytes), phash)
+        for img_bytes, face_id, phash in images
+    ])
 
 def find_person_matches(face_encoding):
     
-    matches = []
+    return find_person_matches_batch([face_encoding])[0]
+
+def find_person_matches_batch(face_encodings):
+    
+    if not gallery.loaded:
+        load_gallery_index()
+    gallery_sync.poll()
+    
+    all_matches = []
     
-    # Check if the face matches any known person
-    for person in persons_collection.find():
-        person_name = person['name']
-        person_encodings = person.get('encodings', [])
+    # One batched distance query for all faces against every stored encoding
+    for results in gallery.search_batch(face_encodings, MATCH_THRESHOLD):
+        matches = []
+        for person_name, _, distance in results:
+            confidence = int((1 - distance) * 100)
+            matches.append({"name": person_name, "confidence": confidence})
         
-        for stored_encoding in person_encodings:
-            # Convert stored encoding from list to numpy array
-            stored_encoding_array = np.array(stored_encoding)
-            
-            # Calculate distance (lower means more similar)
-            distance = face_recognition.face_distance([stored_encoding_array], face_encoding)[0]
-            
-            # If distance is below threshold, consider it a match
-            if distance < 0.6:  # Adjust threshold as needed
-                confidence = int((1 - distance) * 100)
-                matches.append({"name": person_name, "confidence": confidence})
-    
-    # Sort matches by confidence (highest first)
-    return sorted(matches, key=lambda x: x["confidence"], reverse=True)
+        # Results come back ordered by distance, i.e. highest confidence first
+        all_matches.append(matches)
+    
+    return all_matches
+
+def verify_person(person_name, face_encoding, threshold):
+    
+    # 1:1 verification against the claimed person only, with nothing stored.
+    # In prototype mode their centroid and medoids come from memory, otherwise
+    # their encodings are read with one query on the person_name index, so the
+    # cost follows the person's face count, not the gallery size. Returns None
+    # when the person has no faces
+    prototypes = None
+    if isinstance(gallery, PrototypeIndex) and gallery.loaded:
+        gallery_sync.poll()
+        prototypes = gallery.prototypes(person_name)
+    
+    if prototypes is not None:
+        encodings = prototypes
+    else:
+        encodings = [encoding for _, _, encoding in store.iter_faces(person_name)]
+    
+    if not encodings:
+        return None
+    
+    distances = np.linalg.norm(np.asarray(encodings, dtype=np.float32) - np.asarray(face_encoding, dtype=np.float32), axis=1)
+    distance = float(distances.min())
+    
+    return {
+        "verified": distance < threshold,
+        "distance": round(distance, 4),
+        "confidence": max(0, int((1 - distance) * 100)),
+        "threshold": threshold,
+        "compared": len(encodings),
+        "prototypes": prototypes is not None
+    }
 
 def image_hash(img_bytes):
     
     return hashlib.md5(img_bytes).hexdigest()
 
-def is_duplicate_image(person_name, img_bytes):
+def get_file_hashes(file_ids):
     
-    # Generate hash of the new image
-    new_hash = image_hash(img_bytes)
+    # Content hashes recorded with the stored images
+    return store.blob_hashes(file_ids)
+
+def get_file_hash(file_id):
     
-    # Get the person from the database
-    person = persons_collection.find_one({'name': person_name})
+    return get_file_hashes([file_id]).get(file_id)
+
+def get_file_phashes(file_ids):
     
-    if not person or 'file_ids' not in person:
-        return False
+    # Perceptual hashes recorded with the stored images (None for older ones)
+    return store.blob_phashes(file_ids)
+
+def find_duplicate_image(person_name, img_hash):
     
-    # Check against all existing images
-    for file_id in person['file_ids']:
-        try:
-            # Get the image from GridFS
-            existing_img_bytes = fs.get(file_id).read()
-            existing_hash = image_hash(existing_img_bytes)
-            
-            # Compare hashes
-            if existing_hash == new_hash:
-                return True
-        except Exception as e:
-            print(f"Error comparing image: {e}")
+    # Face id of the person's face with exactly this image, or None.
+    # Single indexed lookup on (person_name, image_hash)
+    return store.find_face_by_hash(person_name, img_hash)
+
+def is_duplicate_image(person_name, img_bytes=None, img_hash=None):
     
-    return False
+    return find_duplicate_image(person_name, img_hash or image_hash(img_bytes)) is not None
 
-def add_face_to_person(person_name, face_id, file_id, face_encoding):
+def find_near_duplicate(person_name, face_encoding, phash):
+    
+    # A face is a near duplicate of one already stored for the person when
+    # their encodings are very close and their perceptual hashes nearly match.
+    # The gallery index finds the close encodings, then one indexed query
+    # fetches the perceptual hashes of just those faces
+    if not config.NEAR_DUP_ENABLED or phash is None:
+        return None
+    
+    if isinstance(gallery, PrototypeIndex):
+        # The prototype index holds only centroids and medoids, so compare
+        # with every stored face of the person (one person_name index query)
+        faces = [(face_id, encoding) for _, face_id, encoding in store.iter_faces(person_name)]
+        if not faces:
+            return None
+        encodings = np.asarray([encoding for _, encoding in faces], dtype=np.float32)
+        distances = np.linalg.norm(encodings - np.asarray(face_encoding, dtype=np.float32), axis=1)
+        close_face_ids = [face_id for (face_id, _), distance in zip(faces, distances)
+                          if distance < config.NEAR_DUP_ENCODING_DISTANCE]
+    else:
+        if not gallery.loaded:
+            load_gallery_index()
+        gallery_sync.poll()
+        
+        close_face_ids = [
+            face_id for name, face_id, _ in gallery.search(face_encoding, config.NEAR_DUP_ENCODING_DISTANCE)
+            if name == person_name
+        ]
     
-    # Check if person exists
-    person = persons_collection.find_one({'name': person_name})
+    if not close_face_ids:
+        return None
     
-    if person:
-        # Add face to existing person
-        result = persons_collection.update_one(
-            {'name': person_name},
-            {'$push': {
-                'face_ids': face_id,
-                'file_ids': file_id,
-                'encodings': face_encoding
-            }}
-        )
-    else:
-        # Create new person
-        result = persons_collection.insert_one({
-            'name': person_name,
-            'face_ids': [face_id],
-            'file_ids': [file_id],
-            'encodings': [face_encoding],
-            'created_at': datetime.now()
-        })
+    for face_id, stored_phash in store.face_phashes(person_name, close_face_ids).items():
+        if stored_phash is not None and near_duplicate.hamming_distance(stored_phash, phash) <= config.NEAR_DUP_HASH_DISTANCE:
+            return face_id
     
-    return bool(result.acknowledged)
+    return None
 
-def save_unrecognized_face(face_id, file_id, face_encoding):
+def face_record(person_name, face_id, file_id, face_encoding, img_hash, phash):
     
-    result = encodings_collection.insert_one({
-        '_id': ObjectId(),
+    return {
         'face_id': face_id,
+        'person_name': person_name,
         'file_id': file_id,
         'encoding': face_encoding,
-        'recognized': False,
-        'timestamp': datetime.now()
-    })
+        'image_hash': img_hash,
+        'phash': phash
+    }
+
+def add_face_to_person(person_name, face_id, file_id, face_encoding, img_hash=None, phash=None):
     
-    return bool(result.acknowledged)
+    if phash is None:
+        phash = get_file_phashes([file_id]).get(file_id)
+    
+    # Creates the person on their first face. Returns the id of the face the
+    # image is stored under: face_id, or the person's face with the same
+    # image when a concurrent request stored it first
+    duplicates = store.add_faces([
+        face_record(person_name, face_id, file_id, face_encoding, img_hash or get_file_hash(file_id), phash)
+    ])
+    if face_id in duplicates:
+        return duplicates[face_id]
+    
+    if gallery.loaded:
+        gallery.add(person_name, face_id, face_encoding)
+    gallery_sync.record([{'op': 'add', 'person_name': person_name, 'face_id': face_id}])
+    
+    return face_id
+
+def add_faces_to_persons(faces):
+    
+    # Bulk version of add_face_to_person for (person_name, face_id, file_id, encoding, phash)
+    # tuples - one write for the faces and one for the persons. Returns
+    # {face_id: face_id of the stored copy} for the faces whose image a
+    # concurrent request stored first
+    if not faces:
+        return {}
+    
+    file_hashes = get_file_hashes(file_id for _, _, file_id, _, _ in faces)
+    duplicates = store.add_faces([
+        face_record(person_name, face_id, file_id, face_encoding, file_hashes.get(file_id), phash)
+        for person_name, face_id, file_id, face_encoding, phash in faces
+    ])
+    added = [face for face in faces if face[1] not in duplicates]
+    
+    if gallery.loaded:
+        gallery.add_many(
+            (person_name, face_id, face_encoding)
+            for person_name, face_id, _, face_encoding, _ in added
+        )
+    if added:
+        gallery_sync.record([
+            {'op': 'add', 'person_name': person_name, 'face_id': face_id}
+            for person_name, face_id, _, _, _ in added
+        ])
+    
+    return duplicates
+
+def save_unrecognized_faces(faces):
+    
+    # Bulk version of save_unrecognized_face for (face_id, file_id, encoding, phash) tuples
+    if not faces:
+        return True
+    
+    file_hashes = get_file_hashes(file_id for _, file_id, _, _ in faces)
+    
+    success = store.add_unrecognized([
+        {'face_id': face_id, 'file_id': file_id, 'encoding': face_encoding,
+         'image_hash': file_hashes.get(file_id), 'phash': phash}
+        for face_id, file_id, face_encoding, phash in faces
+    ])
+    cluster_unrecognized_faces((face_id, face_encoding) for face_id, _, face_encoding, _ in faces)
+    
+    return bool(success)
+
+def save_unrecognized_face(face_id, file_id, face_encoding, img_hash=None, phash=None):
+    
+    success = store.add_unrecognized([
+        {'face_id': face_id, 'file_id': file_id, 'encoding': face_encoding,
+         'image_hash': img_hash or get_file_hash(file_id), 'phash': phash}
+    ])
+    cluster_unrecognized_faces([(face_id, face_encoding)])
+    
+    return bool(success)
+
+def get_face_image(face_id):
+    
+    # Stored image of a person's face or of an unrecognized face as
+    # (img_bytes, etag), None if gone. The etag is the image's content hash
+    cached = face_image_cache.get(face_id)
+    if cached is not None:
+        return cached
+    
+    file_id = store.face_file_id(face_id)
+    if file_id is None:
+        return None
+    
+    blob = store.get_blob(file_id)
+    if blob is None:
+        return None
+    
+    img_bytes, img_hash = blob
+    etag = img_hash or image_hash(img_bytes)
+    face_image_cache.put(face_id, img_bytes, etag)
+    
+    return img_bytes, etag
 
 def get_unrecognized_face(face_id):
     
-    return encodings_collection.find_one({'face_id': face_id, 'recognized': False})
+    return store.get_unrecognized(face_id)
 
 def mark_face_as_recognized(face_id, person_name):
     
-    result = encodings_collection.update_one(
-        {'face_id': face_id},
-        {'$set': {'recognized': True, 'person_name': person_name}}
-    )
+    success = store.mark_recognized(face_id, person_name)
     
-    return bool(result.acknowledged)
+    # The face leaves the unrecognized list
+    delete_face_history([face_id], 'unrecognized')
+    unknown_clusters.remove([face_id])
+    
+    return bool(success)
+
+def assign_faces_to_person(face_ids, person_name):
+    
+    # Names many unrecognized faces at once, e.g. a whole cluster: one read of
+    # their records, one lookup of the person's images by hash, one write for
+    # the new faces and one to take them off the unrecognized list. Images
+    # the person already has, exactly or nearly, or that repeat among the
+    # faces, are only marked recognized. Creates the person on their first
+    # face. Returns the (stored, suppressed) unrecognized records
+    faces = store.get_unrecognized_many(face_ids)
+    position = {face_id: i for i, face_id in enumerate(face_ids)}
+    faces.sort(key=lambda face: position[face['face_id']])
+    
+    if not faces:
+        return [], []
+    
+    # Records written by older versions may lack the image hash
+    missing = [face['file_id'] for face in faces if not face.get('image_hash')]
+    file_hashes = get_file_hashes(missing) if missing else {}
+    for face in faces:
+        face['image_hash'] = face.get('image_hash') or file_hashes.get(face['file_id'])
+    
+    known_hashes = set(store.find_faces_by_hashes(
+        person_name, [face['image_hash'] for face in faces if face['image_hash']]
+    ))
+    
+    stored = []
+    suppressed = []
+    for face in faces:
+        img_hash, phash, face_encoding = face['image_hash'], face.get('phash'), face['encoding']
+        is_duplicate = (
+            (img_hash is not None and img_hash in known_hashes)
+            or (config.NEAR_DUP_ENABLED and any(
+                near_duplicate.is_near_duplicate(face_encoding, phash, other['encoding'], other.get('phash'),
+                                                 config.NEAR_DUP_HASH_DISTANCE, config.NEAR_DUP_ENCODING_DISTANCE)
+                for other in stored))
+            or find_near_duplicate(person_name, face_encoding, phash) is not None
+        )
+        
+        if img_hash is not None:
+            known_hashes.add(img_hash)
+        (suppressed if is_duplicate else stored).append(face)
+    
+    if stored:
+        duplicates = store.add_faces([
+            face_record(person_name, face['face_id'], face['file_id'], face['encoding'], face['image_hash'],
+                        face.get('phash'))
+            for face in stored
+        ])
+        # Images a concurrent request stored for the person first
+        suppressed += [face for face in stored if face['face_id'] in duplicates]
+        stored = [face for face in stored if face['face_id'] not in duplicates]
+    
+    if stored:
+        if gallery.loaded:
+            gallery.add_many((person_name, face['face_id'], face['encoding']) for face in stored)
+        gallery_sync.record([{'op': 'add', 'person_name': person_name, 'face_id': face['face_id']} for face in stored])
+    
+    named_ids = [face['face_id'] for face in faces]
+    store.mark_recognized_many(named_ids, person_name)
+    delete_face_history(named_ids, 'unrecognized')
+    unknown_clusters.remove(named_ids)
+    
+    return stored, suppressed
 
-def prepare_image_for_storage(face_image):
+def prepare_image_for_storage(face_image, with_base64=True):
     
     pil_image = Image.fromarray(face_image)
     
-    # Convert to bytes for MongoDB
+    # Convert to JPEG bytes for storage
     buffered = BytesIO()
     pil_image.save(buffered, format="JPEG")
     img_bytes = buffered.getvalue()
     
-    # Prepare base64 for response
+    # Prepare base64 for response, unless the response links to the image instead
+    if not with_base64:
+        return img_bytes, None
+    
     img_str = base64.b64encode(img_bytes).decode("utf-8")
     face_image_base64 = f"data:image/jpeg;base64,{img_str}"
     
     return img_bytes, face_image_base64
 
+def delete_files(file_ids, progress=None):
+    
+    # Bulk delete of stored images. progress(done) is called after every
+    # batch. Returns the number of images removed
+    return store.delete_blobs(file_ids, progress)
+
 def delete_person(person_name):
     
-    # Get the person's document to retrieve file IDs
-    person = persons_collection.find_one({'name': person_name})
+    # Delete the person and their faces
+    faces = store.delete_person(person_name)
     
-    if not person:
+    if faces is None:
         return False
     
-    # Delete all files from GridFS
-    if 'file_ids' in person:
-        for file_id in person['file_ids']:
-            try:
-                fs.delete(file_id)
-            except Exception as e:
-                print(f"Error deleting file {file_id}: {e}")
+    # Delete all their images
+    delete_files([face['file_id'] for face in faces])
     
-    # Delete the person document
-    result = persons_collection.delete_one({'name': person_name})
+    face_ids = [face['face_id'] for face in faces]
+    store.delete_history('recognized', person_name=person_name)
+    face_image_cache.discard(face_ids)
+    gallery.remove_person(person_name)
+    gallery_sync.record([{'op': 'remove_person', 'person_name': person_name}])
     
     # Update encodings to mark as unrecognized for this person
-    if 'face_ids' in person:
-        for face_id in person['face_ids']:
-            try:
-                encodings_collection.update_one(
-                    {'face_id': face_id, 'person_name': person_name},
-                    {'$set': {'recognized': False, 'person_name': None}}
-                )
-            except Exception as e:
-                print(f"Error updating encoding for face {face_id}: {e}")
-    
-    return bool(result.deleted_count > 0)
+    if faces:
+        store.unmark_recognized(face_ids, person_name)
+        if unknown_clusters.loaded:
+            unknown_clusters.add_many(
+                (face['face_id'], face['encoding']) for face in store.get_unrecognized_many(face_ids)
+            )
+    
+    return True
 
-def delete_unrecognized_face(face_id):
+def delete_face_from_person(person_name, face_id):
     
-    # Get the face document to retrieve file ID
-    face = encodings_collection.find_one({'face_id': face_id, 'recognized': False})
+    # Remove the face record and get its file back
+    face = store.delete_face(person_name, face_id)
     
     if not face:
         return False
     
-    # Delete the file from GridFS
-    if 'file_id' in face:
-        try:
-            fs.delete(face['file_id'])
-        except Exception as e:
-            print(f"Error deleting file for face {face_id}: {e}")
+    # Delete the image
+    delete_files([face['file_id']])
     
-    # Delete the face document
-    result = encodings_collection.delete_one({'face_id': face_id, 'recognized': False})
+    delete_face_history([face_id], 'recognized')
+    face_image_cache.discard([face_id])
+    gallery.remove_face(face_id)
+    gallery_sync.record([{'op': 'remove_face', 'person_name': person_name, 'face_id': face_id}])
     
-    return bool(result.deleted_count > 0)
+    return True
 
-def delete_all_persons():
-    
-    # Get all persons to retrieve file IDs
-    persons = list(persons_collection.find({}, {'file_ids': 1}))
+def delete_unrecognized_face(face_id):
     
-    # Delete all files from GridFS
-    for person in persons:
-        if 'file_ids' in person:
-            for file_id in person['file_ids']:
-                try:
-                    fs.delete(file_id)
-                except Exception as e:
-                    print(f"Error deleting file {file_id}: {e}")
+    # Remove the face record and get its file back
+    face = store.delete_unrecognized(face_id)
     
-    # Delete all person documents
-    result = persons_collection.delete_many({})
+    if not face:
+        return False
     
-    # Update all encodings to mark as unrecognized
-    encodings_collection.update_many(
-        {'recognized': True},
-        {'$set': {'recognized': False, 'person_name': None}}
-    )
+    # Delete the image
+    delete_files([face.get('file_id')])
+    delete_face_history([face_id], 'unrecognized')
+    face_image_cache.discard([face_id])
+    unknown_clusters.remove([face_id])
     
-    return result.deleted_count
+    return True
 
-def delete_all_unrecognized_faces():
-    
-    # Get all unrecognized faces to retrieve file IDs
-    faces = list(encodings_collection.find({'recognized': False}, {'file_id': 1}))
-    
-    # Delete all files from GridFS
-    for face in faces:
-        if 'file_id' in face:
-            try:
-                fs.delete(face['file_id'])
-            except Exception as e:
-                print(f"Error deleting file for face: {e}")
-    
-    # Delete all unrecognized face documents
-    result = encodings_collection.delete_many({'recognized': False})
-    
-    return result.deleted_count
+def delete_all_persons(progress=None):
+    
+    # Delete the images of every person's faces.
+    # progress(done, total) reports images deleted so far
+    file_ids = store.face_file_ids()
+    delete_files(file_ids, progress and (lambda done: progress(done, len(file_ids))))
+    
+    # Delete all person and face records
+    deleted = store.delete_all_persons()
+    store.delete_history('recognized')
+    face_image_cache.clear()
+    gallery.clear()
+    gallery_sync.record([{'op': 'clear'}])
+    
+    # Update all encodings to mark as unrecognized; the clusters are rebuilt
+    # with them on next use
+    store.unmark_recognized()
+    unknown_clusters.clear()
+    
+    return deleted
 
-def delete_all_history():
+def delete_all_unrecognized_faces(progress=None):
     
-    result = history_collection.delete_one({'type': 'history'})
+    # Delete the images of all unrecognized faces.
+    # progress(done, total) reports images deleted so far
+    file_ids = store.unrecognized_file_ids()
+    delete_files(file_ids, progress and (lambda done: progress(done, len(file_ids))))
     
-    # Create an empty history document
-    history_collection.insert_one({
-        'type': 'history',
-        'image_history': [],
-        'recognized_persons': [],
-        'unrecognized_persons': []
-    })
+    # Delete all unrecognized face records
+    deleted = store.delete_all_unrecognized()
+    store.delete_history('unrecognized')
+    face_image_cache.clear()
+    unknown_clusters.clear()
     
-    return bool(result.deleted_count > 0)
+    return deleted
 
-def save_debug_image(img, face_locations, filename="debug_faces.jpg"):
-    
-    # Make a copy to avoid modifying the original
-    debug_img = np.copy(img)
-    
-    # Convert from RGB to BGR (for OpenCV)
-    if debug_img.shape[2] == 3:
-        debug_img = cv2.cvtColor(debug_img, cv2.COLOR_RGB2BGR)
-    
-    # Draw rectangles around each face
-    for face_loc in face_locations:
-        top, right, bottom, left = face_loc
-        # Draw rectangle (green)
-        cv2.rectangle(debug_img, (left, top), (right, bottom), (0, 255, 0), 2)
-    
-    # Create debug directory if it doesn't exist
-    debug_dir = os.path.join(os.path.dirname(__file__), "debug")
-    if not os.path.exists(debug_dir):
-        os.makedirs(debug_dir)
-    
-    # Save the image
-    output_path = os.path.join(debug_dir, filename)
-    cv2.imwrite(output_path, debug_img)
+def delete_all_history():
     
-    return output_path 
\ No newline at end of file
+    # Clears the upload history; the person and unrecognized lists follow the
+    # faces themselves and are cleared with them
+    return bool(store.delete_history('upload') > 0)
@@ -0,0 +1,153 @@
+import os
+import time
+import queue
+import logging
+import threading
+import numpy as np
+import cv2
+import config
+
+logger = logging.getLogger(__name__)
+
+# Optional capture of upload images with the detected face boxes drawn on,
+# for tuning the detector. Off by default. When enabled, 1 in every
+# sample_rate uploads is captured; drawing, encoding and writing happen on a
+# background thread fed by a bounded queue (captures are dropped when it is
+# full), and old files are pruned to stay within the size/age limits.
+
+# Writes between retention passes over the debug directory
+PRUNE_EVERY = 50
+
+class DebugCapture:
+
+    def __init__(self, enabled, sample_rate, queue_size, directory, max_bytes, max_age):
+        self.enabled = enabled
+        self.sample_rate = max(1, sample_rate)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._writes = 0
+        self._thread = None
+
+    def sample(self):
+
+        # Returns a filename prefix when this request should be captured, else None
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            self._requests += 1
+            request_no = self._requests
+
+        if request_no % self.sample_rate != 0:
+            return None
+
+        return f"{time.strftime('%Y%m%d_%H%M%S')}_{request_no}"
+
+    def save(self, img, face_locations, filename):
+
+        # Hand the image to the writer thread; the image is not copied here,
+        # callers must not modify it afterwards
+        self._ensure_writer()
+
+        try:
+            self._queue.put_nowait((img, list(face_locations), filename))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="debug-capture", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        self.enforce_retention()
+
+        while True:
+            img, face_locations, filename = self._queue.get()
+            try:
+                write_debug_image(img, face_locations, os.path.join(self.directory, filename))
+                self._writes += 1
+                if self._writes % PRUNE_EVERY == 0:
+                    self.enforce_retention()
+            except Exception as e:
+                logger.error("Error writing debug image %s: %s", filename, e)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+
+        self._queue.join()
+
+    def enforce_retention(self):
+
+        if not os.path.isdir(self.directory):
+            return 0
+
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        # Oldest first: drop anything past the age limit, then trim to the size limit
+        files.sort()
+        total_bytes = sum(size for _, size, _ in files)
+        removed = 0
+
+        for mtime, size, path in files:
+            too_old = self.max_age and now - mtime > self.max_age
+            too_big = self.max_bytes and total_bytes > self.max_bytes
+            if not (too_old or too_big):
+                break
+
+            try:
+                os.remove(path)
+                total_bytes -= size
+                removed += 1
+            except OSError as e:
+                logger.error("Error removing debug image %s: %s", path, e)
+
+        return removed
+
+def write_debug_image(img, face_locations, output_path):
+
+    # Make a copy to avoid modifying the original
+    debug_img = np.copy(img)
+
+    # Convert from RGB to BGR (for OpenCV)
+    if debug_img.shape[2] == 3:
+        debug_img = cv2.cvtColor(debug_img, cv2.COLOR_RGB2BGR)
+
+    # Draw rectangles around each face
+    for face_loc in face_locations:
+        top, right, bottom, left = face_loc
+        # Draw rectangle (green)
+        cv2.rectangle(debug_img, (left, top), (right, bottom), (0, 255, 0), 2)
+
+    # Create debug directory if it doesn't exist
+    debug_dir = os.path.dirname(output_path)
+    if not os.path.exists(debug_dir):
+        os.makedirs(debug_dir)
+
+    # Save the image
+    cv2.imwrite(output_path, debug_img)
+
+    return output_path
+
+debug_capture = DebugCapture(
+    enabled=config.DEBUG_CAPTURE,
+    sample_rate=config.DEBUG_SAMPLE_RATE,
+    queue_size=config.DEBUG_QUEUE_SIZE,
+    directory=config.DEBUG_DIR,
+    max_bytes=config.DEBUG_MAX_BYTES,
+    max_age=config.DEBUG_MAX_AGE
+)
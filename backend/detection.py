@@ -0,0 +1,106 @@
+import cv2
+import logging
+import face_recognition
+import config
+
+logger = logging.getLogger(__name__)
+
+# Minimum face size as a fraction of the smaller image dimension.
+# 8% keeps false positives out of the results
+MIN_FACE_RATIO = 0.08
+
+# Accepted face width / height range, anything outside is likely a false positive
+MIN_ASPECT_RATIO = 0.6
+MAX_ASPECT_RATIO = 1.7
+
+def detection_settings():
+    
+    # Everything that decides which faces are found and how they are encoded:
+    # detector, upsampling, downscaling, the size/aspect filters and the models
+    return ('hog', 0, config.DETECT_DOWNSCALE, config.DETECT_MIN_FACE_PX,
+            MIN_FACE_RATIO, MIN_ASPECT_RATIO, MAX_ASPECT_RATIO, face_recognition.__version__)
+
+def detection_scale(img_shape):
+    
+    # Faces under MIN_FACE_RATIO of the smaller dimension are filtered out anyway,
+    # so detect on a copy just large enough that the smallest face we keep is
+    # still DETECT_MIN_FACE_PX wide - about what HOG needs without upsampling
+    if not config.DETECT_DOWNSCALE:
+        return 1.0
+    
+    min_face_size = min(img_shape[:2]) * MIN_FACE_RATIO
+    if min_face_size <= 0:
+        return 1.0
+    
+    return min(1.0, config.DETECT_MIN_FACE_PX / min_face_size)
+
+def detect_faces(img):
+    
+    img_height, img_width = img.shape[:2]
+    scale = detection_scale(img.shape)
+    
+    if scale >= 1.0:
+        return face_recognition.face_locations(
+            img, 
+            model='hog', 
+            number_of_times_to_upsample=0
+        )
+    
+    small_width = max(1, round(img_width * scale))
+    small_height = max(1, round(img_height * scale))
+    small_img = cv2.resize(img, (small_width, small_height), interpolation=cv2.INTER_AREA)
+    
+    small_locations = face_recognition.face_locations(
+        small_img, 
+        model='hog', 
+        number_of_times_to_upsample=0
+    )
+    
+    # Map the boxes back to full-resolution coordinates
+    scale_x = img_width / small_width
+    scale_y = img_height / small_height
+    face_locations = []
+    for top, right, bottom, left in small_locations:
+        face_locations.append((
+            max(0, int(round(top * scale_y))),
+            min(img_width, int(round(right * scale_x))),
+            min(img_height, int(round(bottom * scale_y))),
+            max(0, int(round(left * scale_x)))
+        ))
+    
+    return face_locations
+
+def filter_face_locations(img, face_locations):
+    
+    filtered_face_locations = []
+    img_height, img_width = img.shape[:2]
+    min_face_size = min(img_height, img_width) * MIN_FACE_RATIO
+    
+    logger.debug("Image dimensions: %dx%d, min face size: %.1f", img_width, img_height, min_face_size)
+    
+    for face_loc in face_locations:
+        top, right, bottom, left = face_loc
+        face_height = bottom - top
+        face_width = right - left
+        
+        logger.debug("Detected face: %dx%d, aspect ratio: %.2f", face_width, face_height, face_width / face_height)
+        
+        # Skip if face is too small (likely false positive)
+        if face_height < min_face_size or face_width < min_face_size:
+            logger.debug("Skipping face - too small: %dx%d", face_width, face_height)
+            continue
+            
+        # Skip if aspect ratio is too extreme (likely false positive)
+        aspect_ratio = face_width / face_height
+        if aspect_ratio < MIN_ASPECT_RATIO or aspect_ratio > MAX_ASPECT_RATIO:
+            logger.debug("Skipping face - aspect ratio out of range: %.2f", aspect_ratio)
+            continue
+            
+        filtered_face_locations.append(face_loc)
+    
+    return filtered_face_locations
+
+def crop_face(img, face_location):
+    
+    top, right, bottom, left = face_location
+    return img[top:bottom, left:right]
@@ -0,0 +1,163 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+import detection
+
+logger = logging.getLogger(__name__)
+
+# Cache of detection and encoding results for repeated images - retries,
+# shared photos, clients re-submitting. Entries are keyed by the hash of the
+# raw uploaded bytes plus the detection settings, so a change of settings
+# never serves stale boxes, and hold the face locations and encodings only:
+# matching always runs against the current gallery. A bounded in-memory LRU
+# sits in front of an optional directory of .npz files that survives restarts
+# and is shared by the processes of one host; the directory is pruned to
+# max_bytes, least recently used files first.
+
+# Writes between size checks of the cache directory
+PRUNE_EVERY = 100
+
+def cache_key(img_bytes):
+
+    settings = repr(detection.detection_settings()).encode()
+    return hashlib.sha256(img_bytes).hexdigest() + hashlib.sha256(settings).hexdigest()[:16]
+
+class DetectionCache:
+
+    def __init__(self, max_entries, directory=None, max_bytes=0):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+
+        # Returns the engine result without timings, or None
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+
+        result = self._load(key) if self.directory else None
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+
+        result = {
+            "face_locations": [tuple(location) for location in result["face_locations"]],
+            "filtered_face_locations": [tuple(location) for location in result["filtered_face_locations"]],
+            "face_encodings": [np.asarray(encoding) for encoding in result["face_encodings"]],
+        }
+        self._remember(key, result)
+        if self.directory:
+            self._store(key, result)
+
+    def _remember(self, key, result):
+
+        if not self.max_entries:
+            return
+
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _load(self, key):
+
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                result = {
+                    "face_locations": [tuple(int(v) for v in row) for row in data["face_locations"]],
+                    "filtered_face_locations": [tuple(int(v) for v in row) for row in data["filtered_face_locations"]],
+                    "face_encodings": list(data["face_encodings"]),
+                }
+            # Touch the file so pruning drops the least recently used ones
+            os.utime(path)
+            return result
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Ignoring unreadable detection cache entry %s: %s", path, e)
+            return None
+
+    def _store(self, key, result):
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    face_locations=np.array(result["face_locations"], dtype=np.int64).reshape(-1, 4),
+                    filtered_face_locations=np.array(result["filtered_face_locations"], dtype=np.int64).reshape(-1, 4),
+                    face_encodings=np.array(result["face_encodings"], dtype=np.float64).reshape(-1, 128)
+                )
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error("Error writing detection cache entry %s: %s", path, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        with self._lock:
+            self._writes += 1
+            prune = self.max_bytes and self._writes % PRUNE_EVERY == 0
+        if prune:
+            self.enforce_size()
+
+    def enforce_size(self):
+
+        if not self.directory or not os.path.isdir(self.directory):
+            return 0
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.npz'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        # Least recently used first
+        files.sort()
+        total_bytes = sum(size for _, size, _ in files)
+        removed = 0
+
+        for _, size, path in files:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= size
+                removed += 1
+            except OSError as e:
+                logger.error("Error removing detection cache entry %s: %s", path, e)
+
+        return removed
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,192 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+import config
+import metrics
+import detection_cache
+
+# Worker-pool engine for face detection and encoding.
+# Each worker process imports face_recognition once, which loads the dlib
+# models, and then serves detect/encode jobs. Request threads submit decoded
+# images and wait on the returned future. The number of queued + running jobs
+# is bounded; past that, submit raises EngineBusy so the caller can answer 503.
+# Images submitted with a cache key are answered from the detection cache
+# when they were seen before, without taking a queue slot.
+
+class EngineBusy(Exception):
+    pass
+
+def _init_worker():
+
+    # Importing face_recognition loads the HOG detector, landmark and encoder models
+    global face_recognition, detection
+    import face_recognition
+    import detection
+
+def _detect_and_encode(img, encode=True):
+
+    started = time.perf_counter()
+    face_locations = detection.detect_faces(img)
+    filtered_face_locations = detection.filter_face_locations(img, face_locations)
+    detected = time.perf_counter()
+
+    face_encodings = []
+    if encode and filtered_face_locations:
+        face_encodings = face_recognition.face_encodings(img, filtered_face_locations)
+
+    # Time spent in the worker, so callers can tell it apart from queueing
+    return {
+        "face_locations": face_locations,
+        "filtered_face_locations": filtered_face_locations,
+        "face_encodings": face_encodings,
+        "timings": {"detect": detected - started, "encode": time.perf_counter() - detected}
+    }
+
+def _detect_and_encode_largest(img):
+
+    # Detects every face but encodes only the largest one kept by the filter,
+    # for callers that expect a single subject in front of the camera
+    started = time.perf_counter()
+    face_locations = detection.detect_faces(img)
+    filtered_face_locations = detection.filter_face_locations(img, face_locations)
+    detected = time.perf_counter()
+
+    largest = sorted(filtered_face_locations, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]), reverse=True)[:1]
+    face_encodings = face_recognition.face_encodings(img, largest) if largest else []
+
+    return {
+        "face_locations": face_locations,
+        "filtered_face_locations": filtered_face_locations,
+        "largest_face_location": largest[0] if largest else None,
+        "face_encodings": face_encodings,
+        "timings": {"detect": detected - started, "encode": time.perf_counter() - detected}
+    }
+
+def _encode(img, face_locations):
+
+    started = time.perf_counter()
+    face_encodings = face_recognition.face_encodings(img, face_locations)
+
+    return {"face_encodings": face_encodings, "timings": {"encode": time.perf_counter() - started}}
+
+class FaceEngine:
+
+    def __init__(self, workers, queue_depth, start_method='spawn', cache=None):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.cache = cache
+        self._slots = threading.BoundedSemaphore(queue_depth)
+        self._inline_lock = threading.Lock()
+
+        if workers > 0:
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context(start_method),
+                initializer=_init_worker
+            )
+        else:
+            # No worker processes: run jobs on the calling thread, one at a time
+            # since the dlib models are not thread-safe
+            self._executor = None
+            _init_worker()
+
+    def _run_inline(self, fn, *args):
+        future = Future()
+        try:
+            with self._inline_lock:
+                future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _submit(self, block, timeout, fn, *args):
+        # Reserve a queue slot, or fail fast when the engine is saturated
+        if not self._slots.acquire(blocking=block, timeout=timeout if block else None):
+            raise EngineBusy(f"Face engine queue is full ({self.queue_depth} jobs)")
+
+        try:
+            if self._executor is None:
+                future = self._run_inline(fn, *args)
+            else:
+                future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def cache_key(self, img_bytes):
+
+        # Detection cache key of the raw image bytes, None when caching is off
+        return detection_cache.cache_key(img_bytes) if self.cache is not None else None
+
+    def submit(self, img, block=False, timeout=None, cache_key=None, encode=True):
+
+        # encode=False only detects, e.g. for video frames whose faces are
+        # encoded selectively with submit_encode
+        if encode and cache_key is not None and self.cache is not None:
+            cached = self.cache.get(cache_key)
+            metrics.detection_cache_total.inc(result='hit' if cached is not None else 'miss')
+            if cached is not None:
+                future = Future()
+                future.set_result({**cached, "timings": {}, "cached": True})
+                return future
+
+        future = self._submit(block, timeout, _detect_and_encode, img, encode)
+        if encode and cache_key is not None and self.cache is not None:
+            future.add_done_callback(lambda done: self._remember(cache_key, done))
+        return future
+
+    def submit_encode(self, img, face_locations, block=False, timeout=None):
+
+        # Encodings of faces at known locations, without detecting again
+        return self._submit(block, timeout, _encode, img, face_locations)
+
+    def submit_largest(self, img, block=False, timeout=None):
+
+        # Detection with only the largest face encoded; never cached
+        return self._submit(block, timeout, _detect_and_encode_largest, img)
+
+    def _remember(self, cache_key, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.cache.put(cache_key, future.result())
+
+    def detect_and_encode(self, img, timeout=None):
+
+        return self.submit(img).result(timeout=timeout)
+
+    def shutdown(self):
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+
+    global _engine
+
+    with _engine_lock:
+        if _engine is None:
+            workers = config.ENGINE_WORKERS if config.ENGINE_WORKERS >= 0 else (os.cpu_count() or 1)
+            queue_depth = config.ENGINE_QUEUE_DEPTH or max(1, 2 * workers)
+            cache = None
+            if config.DETECTION_CACHE_ENTRIES or config.DETECTION_CACHE_DIR:
+                cache = detection_cache.DetectionCache(config.DETECTION_CACHE_ENTRIES, config.DETECTION_CACHE_DIR or None,
+                                                       config.DETECTION_CACHE_MAX_BYTES)
+            _engine = FaceEngine(workers, queue_depth, config.ENGINE_START_METHOD, cache)
+        return _engine
+
+def shutdown_engine():
+
+    global _engine
+
+    with _engine_lock:
+        if _engine is not None:
+            _engine.shutdown()
+            _engine = None
@@ -0,0 +1,223 @@
+import threading
+import numpy as np
+
+# Size of the face_recognition (dlib) face descriptor
+ENCODING_SIZE = 128
+
+# Initial row capacity of the index, doubled whenever it fills up
+INITIAL_CAPACITY = 1024
+
+def nearest_rows(queries, encodings, sq_norms, threshold, top_k=None, hidden=None):
+
+    # For each query, the (row indices, distances) of the encodings closer
+    # than threshold, nearest first; rows where hidden is True are skipped
+    if len(encodings) == 0 or len(queries) == 0:
+        return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in range(len(queries))]
+
+    # ||a - b||^2 = ||a||^2 + ||b||^2 - 2 a.b, with a.b as one BLAS call
+    query_norms = np.einsum('ij,ij->i', queries, queries)
+    sq_distances = sq_norms[None, :] + query_norms[:, None] - 2.0 * (queries @ encodings.T)
+    distances = np.sqrt(np.maximum(sq_distances, 0.0))
+
+    results = []
+    for row in distances:
+        within = row < threshold
+        if hidden is not None:
+            within &= ~hidden
+        candidates = np.flatnonzero(within)
+
+        if top_k is not None and len(candidates) > top_k:
+            nearest = np.argpartition(row[candidates], top_k - 1)[:top_k]
+            candidates = candidates[nearest]
+
+        candidates = candidates[np.argsort(row[candidates], kind='stable')]
+        results.append((candidates, row[candidates]))
+
+    return results
+
+class GalleryIndex:
+    # Exact (brute-force) in-memory index of every stored person encoding.
+    # Encodings live in one contiguous float32 (N x 128) matrix with parallel
+    # label / face id arrays, so a query is a single matrix-vector product
+    # instead of one face_distance call per stored encoding.
+
+    persistent = False
+
+    def __init__(self, initial_capacity=INITIAL_CAPACITY):
+        self._lock = threading.RLock()
+        self._initial_capacity = initial_capacity
+        self.loaded = False
+        self._reset()
+
+    def _reset(self, capacity=None):
+        capacity = capacity or self._initial_capacity
+        self._encodings = np.zeros((capacity, ENCODING_SIZE), dtype=np.float32)
+        self._sq_norms = np.zeros(capacity, dtype=np.float32)
+        self._labels = np.empty(capacity, dtype=object)
+        self._face_ids = np.empty(capacity, dtype=object)
+        self._size = 0
+        # face_id -> row, built on the first replace() and dropped whenever
+        # rows move, so indexes that never replace rows pay nothing for it
+        self._rows = None
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self, needed):
+        capacity = len(self._encodings)
+        if needed <= capacity:
+            return
+
+        while capacity < needed:
+            capacity *= 2
+
+        # Allocate new buffers so readers holding the old ones stay valid
+        encodings = np.zeros((capacity, ENCODING_SIZE), dtype=np.float32)
+        sq_norms = np.zeros(capacity, dtype=np.float32)
+        labels = np.empty(capacity, dtype=object)
+        face_ids = np.empty(capacity, dtype=object)
+
+        n = self._size
+        encodings[:n] = self._encodings[:n]
+        sq_norms[:n] = self._sq_norms[:n]
+        labels[:n] = self._labels[:n]
+        face_ids[:n] = self._face_ids[:n]
+
+        self._encodings = encodings
+        self._sq_norms = sq_norms
+        self._labels = labels
+        self._face_ids = face_ids
+
+    def load(self, entries):
+        # Replace the whole index with (person_name, face_id, encoding) entries
+        entries = list(entries)
+
+        with self._lock:
+            self._reset(max(self._initial_capacity, len(entries)))
+            self._append(entries)
+            self.loaded = True
+
+    def _append(self, entries):
+        if not entries:
+            return
+
+        start = self._size
+        end = start + len(entries)
+        self._grow(end)
+
+        block = np.asarray([encoding for _, _, encoding in entries], dtype=np.float32)
+        self._encodings[start:end] = block
+        self._sq_norms[start:end] = np.einsum('ij,ij->i', block, block)
+        for i, (person_name, face_id, _) in enumerate(entries):
+            self._labels[start + i] = person_name
+            self._face_ids[start + i] = face_id
+            if self._rows is not None:
+                self._rows[face_id] = start + i
+
+        self._size = end
+
+    def add(self, person_name, face_id, face_encoding):
+
+        with self._lock:
+            self._append([(person_name, face_id, face_encoding)])
+
+    def add_many(self, entries):
+
+        with self._lock:
+            self._append(list(entries))
+
+    def _remove_where(self, mask):
+        # Compact the index, dropping rows where mask is True
+        n = self._size
+        keep = np.flatnonzero(~mask)
+        if len(keep) == n:
+            return 0
+
+        capacity = max(self._initial_capacity, len(self._encodings))
+        encodings = np.zeros((capacity, ENCODING_SIZE), dtype=np.float32)
+        sq_norms = np.zeros(capacity, dtype=np.float32)
+        labels = np.empty(capacity, dtype=object)
+        face_ids = np.empty(capacity, dtype=object)
+
+        m = len(keep)
+        encodings[:m] = self._encodings[keep]
+        sq_norms[:m] = self._sq_norms[keep]
+        labels[:m] = self._labels[keep]
+        face_ids[:m] = self._face_ids[keep]
+
+        self._encodings = encodings
+        self._sq_norms = sq_norms
+        self._labels = labels
+        self._face_ids = face_ids
+        self._size = m
+        self._rows = None
+
+        return n - m
+
+    def replace(self, face_id, entry):
+
+        # Overwrite the row of face_id with a (person_name, face_id, encoding)
+        # entry, in place; returns 0 when face_id is not indexed
+        person_name, new_face_id, face_encoding = entry
+        encoding = np.asarray(face_encoding, dtype=np.float32)
+
+        with self._lock:
+            if self._rows is None:
+                self._rows = {row_face_id: row for row, row_face_id in enumerate(self._face_ids[:self._size])}
+            row = self._rows.pop(face_id, None)
+            if row is None:
+                return 0
+
+            self._encodings[row] = encoding
+            self._sq_norms[row] = np.dot(encoding, encoding)
+            self._labels[row] = person_name
+            self._face_ids[row] = new_face_id
+            self._rows[new_face_id] = row
+            return 1
+
+    def remove_person(self, person_name):
+
+        with self._lock:
+            return self._remove_where(self._labels[:self._size] == person_name)
+
+    def remove_face(self, face_id):
+
+        with self._lock:
+            return self._remove_where(self._face_ids[:self._size] == face_id)
+
+    def clear(self):
+
+        with self._lock:
+            self._reset()
+
+    def face_ids(self):
+
+        return set(self._snapshot()[3])
+
+    def export(self):
+        # Copies of the filled rows as (encodings, labels, face_ids)
+        encodings, _, labels, face_ids = self._snapshot()
+        return encodings.copy(), labels.copy(), face_ids.copy()
+
+    def _snapshot(self):
+        # Views over the filled rows. Only replace() writes into these rows,
+        # so a search running meanwhile may see that one row half-updated
+        with self._lock:
+            n = self._size
+            return (self._encodings[:n], self._sq_norms[:n],
+                    self._labels[:n], self._face_ids[:n])
+
+    def search_batch(self, face_encodings, threshold=0.6, top_k=None):
+        # Returns, for each query, a list of (person_name, face_id, distance)
+        # sorted by distance, limited to distances below the threshold
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        encodings, sq_norms, labels, face_ids = self._snapshot()
+
+        return [
+            [(labels[i], face_ids[i], float(distance)) for i, distance in zip(candidates, distances)]
+            for candidates, distances in nearest_rows(queries, encodings, sq_norms, threshold, top_k)
+        ]
+
+    def search(self, face_encoding, threshold=0.6, top_k=None):
+
+        return self.search_batch([face_encoding], threshold, top_k)[0]
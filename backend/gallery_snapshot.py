@@ -0,0 +1,439 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import logging
+import threading
+import numpy as np
+from gallery_index import GalleryIndex, ENCODING_SIZE, nearest_rows
+
+logger = logging.getLogger(__name__)
+
+# Gallery snapshots shared by the worker processes of one host.
+# A snapshot is a directory of flat .npy files - the float32 (N x 128)
+# encodings, their squared norms, an int32 person label per row and the face
+# ids - plus persons.json naming the labels. Every process maps the files of
+# the current snapshot read-only, so the encodings sit in the page cache once
+# however many workers serve requests. Changes a process makes are kept as a
+# small private overlay (added rows, hidden rows) and published shortly after
+# as a new snapshot: under a file lock, the latest snapshot plus the pending
+# changes is written to a new version directory and the CURRENT pointer file
+# is swapped atomically. Other processes notice the new pointer on their next
+# search and map the new version; old versions are removed once replaced, and
+# processes still mapping them keep reading the unlinked files until they move.
+
+# Rows copied per chunk when writing a snapshot
+WRITE_CHUNK_SIZE = 65536
+
+# Published versions kept on disk besides the current one
+KEEP_VERSIONS = 1
+
+class _Snapshot:
+    # One mapped snapshot version
+
+    def __init__(self, directory, version):
+        self.version = version
+        if version:
+            path = os.path.join(directory, version)
+            self.encodings = np.load(os.path.join(path, 'encodings.npy'), mmap_mode='r')
+            self.sq_norms = np.load(os.path.join(path, 'sq_norms.npy'), mmap_mode='r')
+            self.labels = np.load(os.path.join(path, 'labels.npy'), mmap_mode='r')
+            self.face_ids = np.load(os.path.join(path, 'face_ids.npy'), mmap_mode='r')
+            with open(os.path.join(path, 'persons.json')) as f:
+                self.persons = json.load(f)
+        else:
+            # Nothing published yet
+            self.encodings = np.zeros((0, ENCODING_SIZE), dtype=np.float32)
+            self.sq_norms = np.zeros(0, dtype=np.float32)
+            self.labels = np.zeros(0, dtype=np.int32)
+            self.face_ids = np.zeros(0, dtype='S1')
+            self.persons = []
+        self.person_index = {person_name: i for i, person_name in enumerate(self.persons)}
+
+    def __len__(self):
+        return len(self.encodings)
+
+    def rows_of_face(self, face_id):
+        return self.face_ids == face_id.encode()
+
+    def rows_of_person(self, person_name):
+        label = self.person_index.get(person_name)
+        if label is None:
+            return np.zeros(len(self), dtype=bool)
+        return self.labels == label
+
+class SnapshotGallery:
+    # Exact gallery index over a shared snapshot, with the same interface as
+    # GalleryIndex
+
+    persistent = False
+    shared = True
+
+    def __init__(self, directory, publish_delay=0.5):
+        self.directory = directory
+        self.publish_delay = publish_delay
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._publish_lock = threading.Lock()
+        self._pending = threading.Event()
+        self._publisher = None
+        self._pointer = None
+        self._base = _Snapshot(directory, None)
+        # Changes not published yet, as (op, argument), and their effect on
+        # this process's view: rows added and rows of the snapshot hidden
+        self._ops = []
+        self._overlay = GalleryIndex(initial_capacity=256)
+        self._hidden = None
+
+    @property
+    def version(self):
+        return self._base.version
+
+    def __len__(self):
+        self._refresh()
+        base, hidden, overlay = self._view()
+        hidden_count = int(hidden.sum()) if hidden is not None else 0
+        return len(base) - hidden_count + len(overlay)
+
+    # Snapshot files
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def _locked(self):
+        # Exclusive lock held by the one process writing a snapshot
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(self._path('lock'), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _read_pointer(self):
+        try:
+            with open(self._path('CURRENT')) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _pointer_stat(self):
+        try:
+            stat = os.stat(self._path('CURRENT'))
+            return stat.st_ino, stat.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _write_version(self, version, total, id_width, chunks):
+        # chunks yields (encodings, person names, face ids) blocks totalling
+        # total rows; the files are written under a temporary name and the
+        # directory renamed into place once complete
+        tmp_path = self._path(f"{version}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        open_memmap = np.lib.format.open_memmap
+        encodings = open_memmap(os.path.join(tmp_path, 'encodings.npy'), mode='w+', dtype=np.float32,
+                                shape=(total, ENCODING_SIZE))
+        sq_norms = open_memmap(os.path.join(tmp_path, 'sq_norms.npy'), mode='w+', dtype=np.float32, shape=(total,))
+        labels = open_memmap(os.path.join(tmp_path, 'labels.npy'), mode='w+', dtype=np.int32, shape=(total,))
+        face_ids = open_memmap(os.path.join(tmp_path, 'face_ids.npy'), mode='w+', dtype=f'S{max(1, id_width)}',
+                               shape=(total,))
+
+        persons = {}
+        start = 0
+        for block, names, ids in chunks:
+            end = start + len(block)
+            encodings[start:end] = block
+            sq_norms[start:end] = np.einsum('ij,ij->i', block, block)
+            labels[start:end] = [persons.setdefault(name, len(persons)) for name in names]
+            face_ids[start:end] = ids
+            start = end
+
+        for array in (encodings, sq_norms, labels, face_ids):
+            array.flush()
+        del encodings, sq_norms, labels, face_ids
+
+        with open(os.path.join(tmp_path, 'persons.json'), 'w') as f:
+            json.dump(list(persons), f)
+
+        os.rename(tmp_path, self._path(version))
+
+        # Swap the pointer, then drop the versions nobody should open anymore
+        pointer_tmp = self._path(f"CURRENT.{os.getpid()}.tmp")
+        with open(pointer_tmp, 'w') as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer_tmp, self._path('CURRENT'))
+        self._prune(version)
+
+    def _prune(self, current):
+        versions = sorted(name for name in os.listdir(self.directory) if name.isdigit() and name != current)
+        for name in versions[:max(0, len(versions) - KEEP_VERSIONS)]:
+            shutil.rmtree(self._path(name), ignore_errors=True)
+
+    def _next_version(self, latest):
+        return f"{int(latest or 0) + 1:012d}"
+
+    def _write_entries(self, latest, entries):
+        entries = list(entries)
+        id_width = max((len(face_id.encode()) for _, face_id, _ in entries), default=1)
+
+        def chunks():
+            for start in range(0, len(entries), WRITE_CHUNK_SIZE):
+                block = entries[start:start + WRITE_CHUNK_SIZE]
+                yield (np.asarray([encoding for _, _, encoding in block], dtype=np.float32).reshape(-1, ENCODING_SIZE),
+                       [person_name for person_name, _, _ in block],
+                       [face_id.encode() for _, face_id, _ in block])
+
+        version = self._next_version(latest)
+        self._write_version(version, len(entries), id_width, chunks())
+        return version
+
+    # This process's view
+
+    def _refresh(self):
+        # Map the current snapshot if another process published a new one
+        pointer = self._pointer_stat()
+        if pointer == self._pointer:
+            return
+        version = self._read_pointer()
+        try:
+            base = _Snapshot(self.directory, version) if version != self._base.version else None
+        except FileNotFoundError:
+            # Replaced again while mapping it; the next search picks up the newest
+            return
+        with self._lock:
+            self._pointer = pointer
+            if base is not None:
+                self._rebase(base, self._ops)
+
+    def _rebase(self, base, ops):
+        # Replay the unpublished changes on top of another snapshot
+        self._base = base
+        self._ops = list(ops)
+        self._overlay = GalleryIndex(initial_capacity=256)
+        self._hidden = None
+        for op, argument in self._ops:
+            self._apply(op, argument)
+
+    def _apply(self, op, argument):
+        if op == 'add':
+            self._overlay.add_many(argument)
+            return
+
+        if op == 'remove_face':
+            self._overlay.remove_face(argument)
+            rows = self._base.rows_of_face(argument)
+        elif op == 'remove_person':
+            self._overlay.remove_person(argument)
+            rows = self._base.rows_of_person(argument)
+        else:
+            self._overlay.clear()
+            rows = np.ones(len(self._base), dtype=bool)
+
+        if rows.any():
+            # A new mask, so searches holding the old one stay consistent
+            hidden = self._hidden.copy() if self._hidden is not None else np.zeros(len(self._base), dtype=bool)
+            hidden |= rows
+            self._hidden = hidden
+
+    def _view(self):
+        with self._lock:
+            return self._base, self._hidden, self._overlay
+
+    def _change(self, op, argument=None):
+        with self._lock:
+            self._ops.append((op, argument))
+            self._apply(op, argument)
+        self._schedule_publish()
+
+    # Publishing
+
+    def _schedule_publish(self):
+        if self.publish_delay <= 0:
+            self.flush()
+            return
+
+        with self._lock:
+            if self._publisher is None:
+                self._publisher = threading.Thread(target=self._publish_loop, name="gallery-snapshot", daemon=True)
+                self._publisher.start()
+        self._pending.set()
+
+    def _publish_loop(self):
+        while True:
+            self._pending.wait()
+            # Let changes arriving close together go out as one snapshot
+            time.sleep(self.publish_delay)
+            self._pending.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error publishing gallery snapshot")
+
+    def flush(self):
+
+        # Publish the changes made in this process; returns the current version
+        with self._publish_lock:
+            with self._lock:
+                ops = list(self._ops)
+            if not ops:
+                return self._base.version
+
+            lock_file = self._locked()
+            try:
+                latest = self._read_pointer()
+                base = self._base if latest == self._base.version else _Snapshot(self.directory, latest)
+                version = self._publish(base, ops)
+            finally:
+                lock_file.close()
+
+            with self._lock:
+                self._pointer = self._pointer_stat()
+                self._rebase(_Snapshot(self.directory, version), self._ops[len(ops):])
+            logger.debug("Published gallery snapshot %s (%d encodings)", version, len(self._base))
+            return version
+
+    def _publish(self, base, ops):
+        # The latest snapshot with the changes applied in order
+        keep = np.ones(len(base), dtype=bool)
+        added = {}
+        for op, argument in ops:
+            if op == 'add':
+                for person_name, face_id, encoding in argument:
+                    added[face_id] = (person_name, face_id, encoding)
+            elif op == 'remove_face':
+                keep &= ~base.rows_of_face(argument)
+                added.pop(argument, None)
+            elif op == 'remove_person':
+                keep &= ~base.rows_of_person(argument)
+                added = {face_id: entry for face_id, entry in added.items() if entry[0] != argument}
+            else:
+                keep[:] = False
+                added = {}
+
+        # A face another process already published is not added twice
+        kept_rows = np.flatnonzero(keep)
+        if added and len(kept_rows):
+            already = np.isin(np.array([face_id.encode() for face_id in added]), base.face_ids[kept_rows])
+            added = {face_id: entry for (face_id, entry), known in zip(added.items(), already) if not known}
+        added = list(added.values())
+
+        id_width = max([base.face_ids.dtype.itemsize] + [len(face_id.encode()) for _, face_id, _ in added])
+
+        def chunks():
+            for start in range(0, len(kept_rows), WRITE_CHUNK_SIZE):
+                rows = kept_rows[start:start + WRITE_CHUNK_SIZE]
+                yield (np.asarray(base.encodings[rows]),
+                       [base.persons[label] for label in base.labels[rows]],
+                       base.face_ids[rows])
+            for start in range(0, len(added), WRITE_CHUNK_SIZE):
+                block = added[start:start + WRITE_CHUNK_SIZE]
+                yield (np.asarray([encoding for _, _, encoding in block], dtype=np.float32).reshape(-1, ENCODING_SIZE),
+                       [person_name for person_name, _, _ in block],
+                       [face_id.encode() for _, face_id, _ in block])
+
+        version = self._next_version(base.version)
+        self._write_version(version, len(kept_rows) + len(added), id_width, chunks())
+        return version
+
+    # Gallery index interface
+
+    def open(self, loader):
+
+        # Map the current snapshot; the first process to find none builds it
+        # from loader(), an iterable of (person_name, face_id, encoding)
+        with self._publish_lock:
+            lock_file = self._locked()
+            try:
+                version = self._read_pointer()
+                if version is None:
+                    version = self._write_entries(None, loader())
+            finally:
+                lock_file.close()
+
+            with self._lock:
+                self._pointer = self._pointer_stat()
+                self._rebase(_Snapshot(self.directory, version), self._ops)
+                self.loaded = True
+
+    def load(self, entries):
+
+        # Replace the whole gallery with (person_name, face_id, encoding) entries
+        with self._publish_lock:
+            lock_file = self._locked()
+            try:
+                version = self._write_entries(self._read_pointer(), entries)
+            finally:
+                lock_file.close()
+
+            with self._lock:
+                self._pointer = self._pointer_stat()
+                self._rebase(_Snapshot(self.directory, version), [])
+                self.loaded = True
+
+    def add(self, person_name, face_id, face_encoding):
+
+        self._change('add', [(person_name, face_id, face_encoding)])
+
+    def add_many(self, entries):
+
+        entries = list(entries)
+        if entries:
+            self._change('add', entries)
+
+    def replace(self, face_id, entry):
+
+        # Published snapshots are never written: the row is hidden and the new
+        # one added to the overlay until the next snapshot (an unknown face_id
+        # only adds the entry)
+        with self._lock:
+            for op, argument in (('remove_face', face_id), ('add', [entry])):
+                self._ops.append((op, argument))
+                self._apply(op, argument)
+        self._schedule_publish()
+        return 1
+
+    def remove_person(self, person_name):
+
+        self._change('remove_person', person_name)
+
+    def remove_face(self, face_id):
+
+        self._change('remove_face', face_id)
+
+    def clear(self):
+
+        self._change('clear')
+
+    def face_ids(self):
+
+        self._refresh()
+        base, hidden, overlay = self._view()
+        rows = np.flatnonzero(~hidden) if hidden is not None else np.arange(len(base))
+        return {face_id.decode() for face_id in base.face_ids[rows]} | overlay.face_ids()
+
+    def search_batch(self, face_encodings, threshold=0.6, top_k=None):
+
+        self._refresh()
+        queries = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        base, hidden, overlay = self._view()
+
+        found = nearest_rows(queries, base.encodings, base.sq_norms, threshold, top_k, hidden)
+        pending = overlay.search_batch(queries, threshold, top_k) if len(overlay) else None
+
+        results = []
+        for i, (rows, distances) in enumerate(found):
+            matches = [
+                (base.persons[base.labels[row]], base.face_ids[row].decode(), float(distance))
+                for row, distance in zip(rows, distances)
+            ]
+            if pending is not None and pending[i]:
+                matches = sorted(matches + pending[i], key=lambda match: match[2])[:top_k]
+            results.append(matches)
+
+        return results
+
+    def search(self, face_encoding, threshold=0.6, top_k=None):
+
+        return self.search_batch([face_encoding], threshold, top_k)[0]
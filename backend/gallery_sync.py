@@ -0,0 +1,172 @@
+import time
+import logging
+import threading
+from datetime import datetime
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Keeps this process's gallery index in step with changes made by other
+# processes. Every change to the persons' faces is logged in storage under a
+# generation number from one shared counter. A process applies its own
+# changes to its index directly and, at most every interval seconds before a
+# match, reads the changes logged since the last generation it applied: an
+# idle check is a single lookup of the latest generation, and new changes are
+# applied as deltas (added faces are fetched in one query). A process too far
+# behind, or facing a gap in the log that does not fill within GAP_GRACE
+# seconds (changes pruned, or a writer that died between taking a generation
+# and logging its change), reloads the whole gallery instead.
+
+# Seconds a gap in the change log may stay open before the gallery is reloaded
+GAP_GRACE = 10.0
+
+# Distance under which an added face counts as already indexed
+SAME_ENCODING_DISTANCE = 0.01
+
+class GallerySync:
+
+    def __init__(self, store, gallery, reload, interval=1.0, max_changes=10000):
+        self.store = store
+        self.gallery = gallery
+        self.reload = reload
+        self.interval = interval
+        self.max_changes = max_changes
+        # Last generation applied to this process's index
+        self.generation = 0
+        self._lock = threading.RLock()
+        # Generations of changes this process made (and applied) itself
+        self._own = set()
+        self._checked = 0.0
+        self._gap_since = None
+
+    @property
+    def enabled(self):
+        # A shared snapshot index follows the other processes by itself
+        return self.interval >= 0 and not getattr(self.gallery, 'shared', False)
+
+    def reset(self, generation):
+
+        # The index was (re)loaded with every change up to generation
+        with self._lock:
+            self.generation = generation
+            self._own = {own for own in self._own if own > generation}
+            self._gap_since = None
+            self._checked = time.monotonic()
+
+    def record(self, changes):
+
+        # Log changes already applied to this process's index
+        generations = self.store.append_gallery_changes(changes)
+        with self._lock:
+            self._own.update(generation for generation in generations if generation > self.generation)
+            # Nothing to catch up with when the log continues with our own changes
+            while self.generation + 1 in self._own:
+                self.generation += 1
+                self._own.discard(self.generation)
+        return generations
+
+    def behind(self, latest):
+
+        # Changes logged up to latest this process has not applied yet; its
+        # own changes past a gap are applied already
+        with self._lock:
+            return max(0, latest - self.generation - sum(1 for own in self._own if own <= latest))
+
+    def poll(self, force=False):
+
+        # Apply the changes other processes logged; returns how many
+        if not self.enabled or not self.gallery.loaded:
+            return 0
+        if not force and time.monotonic() - self._checked < self.interval:
+            return 0
+        # One thread catches up while the others match against the current index
+        if not self._lock.acquire(blocking=force):
+            return 0
+
+        try:
+            self._checked = time.monotonic()
+            latest = self.store.gallery_generation()
+            if latest <= self.generation:
+                self._gap_since = None
+                return 0
+
+            if latest - self.generation > self.max_changes:
+                self._reload('backlog')
+                return 0
+
+            changes = self.store.gallery_changes(self.generation, latest - self.generation)
+            # Only a run of consecutive generations can be applied safely
+            run = []
+            for change in changes:
+                if change['generation'] != self.generation + len(run) + 1:
+                    break
+                run.append(change)
+
+            applied = self._apply(run)
+            self.generation += len(run)
+
+            if self.generation < latest:
+                self._wait_for_gap()
+            else:
+                self._gap_since = None
+            return applied
+        finally:
+            self._lock.release()
+
+    def _wait_for_gap(self):
+        now = time.monotonic()
+        if self._gap_since is None:
+            self._gap_since = now
+        elif now - self._gap_since > GAP_GRACE:
+            self._reload('gap')
+
+    def _reload(self, reason):
+        logger.info("Reloading the gallery index (%s at generation %d)", reason, self.generation)
+        metrics.gallery_reloads_total.inc(reason=reason)
+        # reload() calls reset() with the generation it loaded up to
+        self.reload()
+
+    def _apply(self, changes):
+        applied = 0
+        added_ids = []
+        now = datetime.now()
+
+        for change in changes:
+            if change['generation'] in self._own:
+                self._own.discard(change['generation'])
+                continue
+
+            if change['op'] == 'add':
+                added_ids.append(change['face_id'])
+            else:
+                # Removals apply in log order, after the adds before them
+                self._add_faces(added_ids)
+                added_ids = []
+                if change['op'] == 'remove_face':
+                    self.gallery.remove_face(change['face_id'])
+                elif change['op'] == 'remove_person':
+                    self.gallery.remove_person(change['person_name'])
+                elif change['op'] == 'clear':
+                    self.gallery.clear()
+
+            applied += 1
+            if change['timestamp']:
+                metrics.gallery_sync_lag_seconds.observe(max(0.0, (now - change['timestamp']).total_seconds()))
+
+        self._add_faces(added_ids)
+        return applied
+
+    def _add_faces(self, face_ids):
+        if not face_ids:
+            return
+
+        # Faces deleted since are simply not found
+        entries = list(self.store.iter_faces(face_ids=face_ids))
+        if not entries:
+            return
+
+        matches = self.gallery.search_batch([encoding for _, _, encoding in entries], SAME_ENCODING_DISTANCE)
+        self.gallery.add_many(
+            entry for entry, found in zip(entries, matches)
+            if not any(face_id == entry[1] for _, face_id, _ in found)
+        )
@@ -0,0 +1,64 @@
+import threading
+from collections import OrderedDict
+
+# Bounded LRU of recently served face images, keyed by face id.
+# Face images never change once stored, so entries only need dropping when
+# the face is deleted. The budget is in bytes of image data; the least
+# recently used images are evicted to stay within it.
+
+class ImageCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+
+        # Returns (img_bytes, etag) or None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, img_bytes, etag):
+
+        # Images bigger than the whole budget are not cached
+        if len(img_bytes) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+
+            self._entries[key] = (img_bytes, etag)
+            self.size += len(img_bytes)
+
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard(self, keys):
+
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.size -= len(entry[0])
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
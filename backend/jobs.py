@@ -0,0 +1,161 @@
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import config
+
+logger = logging.getLogger(__name__)
+
+# Background jobs for long-running work such as wiping the gallery or
+# processing an upload. Jobs run on a runner's worker threads and report
+# progress as (done, total); streaming jobs also emit events (e.g. one per
+# face) that clients can follow while the job runs. Finished jobs are kept
+# for status polling until MAX_FINISHED_JOBS newer ones have finished, or
+# for a runner's ttl seconds.
+
+MAX_FINISHED_JOBS = 100
+
+class JobQueueFull(Exception):
+    pass
+
+class JobFailed(Exception):
+    # Expected failure of a job (e.g. no faces in an upload), reported without a traceback
+    pass
+
+class Job:
+
+    def __init__(self, kind, stream=False):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.status = 'queued'
+        self.done = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.created_at = datetime.now()
+        self.finished_at = None
+        # Events of a streaming job as {'id', 'event', 'data'}, ids counting from 1
+        self.events = [] if stream else None
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def progress(self, done, total=None):
+
+        self.done = done
+        if total is not None:
+            self.total = total
+
+    def emit(self, event, data):
+
+        with self._changed:
+            self.events.append({"id": len(self.events) + 1, "event": event, "data": data})
+            self._changed.notify_all()
+
+    def finish(self, status):
+
+        with self._changed:
+            self.status = status
+            self.finished_at = datetime.now()
+            self._changed.notify_all()
+
+    def wait_events(self, after=0, timeout=None):
+
+        # Events after the id 'after', waiting up to timeout seconds for new
+        # ones unless the job has finished
+        with self._changed:
+            if len(self.events) <= after and not self.finished:
+                self._changed.wait(timeout)
+            return self.events[after:]
+
+    def to_dict(self):
+
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": {"done": self.done, "total": self.total},
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class JobRunner:
+
+    def __init__(self, max_finished=MAX_FINISHED_JOBS, workers=1, max_pending=0, ttl=0, name="maintenance-job"):
+        # max_pending bounds queued plus running jobs (0 = unbounded), ttl
+        # drops finished jobs after that many seconds (0 = keep)
+        self.max_finished = max_finished
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+    def submit(self, kind, fn, stream=False):
+
+        # fn(progress) does the work; progress(done, total) updates the job.
+        # Streaming jobs get fn(progress, emit) and emit(event, data) events
+        job = Job(kind, stream)
+        self._prune()
+        with self._lock:
+            pending = sum(1 for other in self._jobs.values() if not other.finished)
+            if self.max_pending and pending >= self.max_pending:
+                raise JobQueueFull(f"Too many {kind} jobs waiting ({pending})")
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        job.status = 'running'
+        status = 'failed'
+        try:
+            job.result = fn(job.progress, job.emit) if job.events is not None else fn(job.progress)
+            status = 'done'
+        except JobFailed as e:
+            logger.info("%s job %s failed: %s", job.kind, job.id, e)
+            job.error = str(e)
+        except Exception as e:
+            logger.exception("Error in %s job %s: %s", job.kind, job.id, e)
+            job.error = str(e)
+        finally:
+            job.finish(status)
+            self._prune()
+
+    def _prune(self):
+        with self._lock:
+            finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+            expired = set(finished[:max(0, len(finished) - self.max_finished)])
+            if self.ttl:
+                oldest = datetime.now() - timedelta(seconds=self.ttl)
+                expired.update(job_id for job_id in finished if self._jobs[job_id].finished_at < oldest)
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+
+        self._prune()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+
+        self._prune()
+        with self._lock:
+            return list(self._jobs.values())
+
+jobs = JobRunner()
+
+# Uploads submitted with ?async=1, streaming a result per face
+upload_jobs = JobRunner(
+    max_finished=config.UPLOAD_JOB_MAX_FINISHED,
+    workers=config.UPLOAD_JOB_WORKERS,
+    max_pending=config.UPLOAD_JOB_QUEUE,
+    ttl=config.UPLOAD_JOB_TTL,
+    name="upload-job"
+)
@@ -0,0 +1,196 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# In-process metrics in the Prometheus text exposition format.
+# Histograms time the stages of the upload pipeline, counters follow the
+# faces going through it and gauges are read from callbacks at scrape time.
+# StageTimer collects the stage durations of one request, so they can also
+# be returned to the caller as a Server-Timing header.
+
+# Histogram buckets in seconds, from a cached lookup to a slow 12MP detection
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(labels):
+
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+def _format_value(value):
+
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+
+        key = tuple((name, labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+
+        return self._values.get(tuple((name, labels[name]) for name in self.label_names), 0)
+
+    def render(self):
+
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+class Gauge:
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help_text = help_text
+        self._callback = callback
+
+    def render(self):
+
+        try:
+            value = self._callback()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_value(value)}"]
+
+class Histogram:
+
+    def __init__(self, name, help_text, label_names=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., count, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+
+        key = tuple((name, labels[name]) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def count(self, **labels):
+
+        series = self._series.get(tuple((name, labels[name]) for name in self.label_names))
+        return series[-2] if series else 0
+
+    def render(self):
+
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, bucket_count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', repr(bound)),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-1]!r}")
+        return lines
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    'face_pipeline_stage_seconds', 'Time spent in each stage of the upload pipeline', ('endpoint', 'stage')
+))
+request_seconds = registry.register(Histogram(
+    'face_request_seconds', 'Total time of upload requests', ('endpoint',)
+))
+requests_total = registry.register(Counter(
+    'face_requests_total', 'Upload requests by response status', ('endpoint', 'status')
+))
+faces_total = registry.register(Counter(
+    'face_faces_total', 'Faces by pipeline outcome: detected, filtered out by the size/aspect checks, '
+    'matched to a person, unrecognized and suppressed as duplicates', ('outcome',)
+))
+
+detection_cache_total = registry.register(Counter(
+    'face_detection_cache_total', 'Detection cache lookups of uploaded images by result: hit or miss', ('result',)
+))
+
+verifications_total = registry.register(Counter(
+    'face_verifications_total', '1:1 verifications by decision: accepted or rejected', ('decision',)
+))
+
+# How long after another process changed the gallery the change reached this
+# one, and full reloads when the change log could not be followed
+gallery_sync_lag_seconds = registry.register(Histogram(
+    'face_gallery_sync_lag_seconds', 'Delay between a gallery change in another process and its arrival in this one',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+))
+gallery_reloads_total = registry.register(Counter(
+    'face_gallery_reloads_total', 'Full gallery reloads by reason: backlog or gap in the change log', ('reason',)
+))
+
+def register_gauge(name, help_text, callback):
+
+    return registry.register(Gauge(name, help_text, callback))
+
+class StageTimer:
+    # Times the stages of one request. A stage entered once per face adds up,
+    # and finish() records each stage's total for the request in stage_seconds
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def record(self, name, seconds):
+
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def finish(self, status):
+
+        total = time.perf_counter() - self._started
+        for name, seconds in self.stages.items():
+            stage_seconds.observe(seconds, endpoint=self.endpoint, stage=name)
+        request_seconds.observe(total, endpoint=self.endpoint)
+        requests_total.inc(endpoint=self.endpoint, status=str(status))
+        return total
+
+    def server_timing(self):
+
+        # Server-Timing header value, durations in milliseconds
+        return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items())
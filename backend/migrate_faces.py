@@ -0,0 +1,123 @@
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import database as db
+from mongo_storage import MongoStorage, face_document, pack_encoding
+
+# One-off migration: moves the parallel face_ids/file_ids/encodings arrays of
+# each person document into the faces collection (one document per face,
+# encoding packed as float32 bytes), carries over the image hashes recorded in
+# the old face_hashes collection, and slims the person documents down. On
+# either backend it then removes faces repeating an image their person already
+# had, so the unique (person_name, image_hash) index can be built.
+# Safe to run again - faces already migrated are skipped.
+
+BATCH_SIZE = 500
+
+# Older versions always stored their data in MongoDB
+store = db.store
+
+def insert_faces(documents):
+    if not documents:
+        return 0
+    try:
+        return len(store.faces_collection.insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        # Duplicate face_id errors are faces migrated by an earlier run
+        errors = [error for error in e.details['writeErrors'] if error['code'] != 11000]
+        if errors:
+            raise
+        return e.details['nInserted']
+
+def migrate_persons():
+    print("Moving person encodings into the faces collection...")
+    old_hashes = store.db['face_hashes']
+    persons = 0
+    inserted = 0
+    
+    legacy = {'$or': [{'face_ids': {'$exists': True}}, {'encodings': {'$exists': True}}]}
+    for person in store.persons_collection.find(legacy):
+        face_ids = person.get('face_ids', [])
+        file_ids = person.get('file_ids', [])
+        encodings = person.get('encodings', [])
+    
+        # Hashes come from the old face_hashes records, else from the GridFS files
+        recorded = {
+            record['face_id']: record
+            for record in old_hashes.find({'person_name': person['name']}, {'face_id': 1, 'image_hash': 1, 'phash': 1})
+        }
+        file_hashes = db.get_file_hashes(file_ids)
+        file_phashes = db.get_file_phashes(file_ids)
+    
+        documents = []
+        for face_id, file_id, encoding in zip(face_ids, file_ids, encodings):
+            record = recorded.get(face_id, {})
+            document = face_document(
+                person['name'], face_id, file_id, encoding,
+                record.get('image_hash') or file_hashes.get(file_id),
+                record['phash'] if record.get('phash') is not None else file_phashes.get(file_id)
+            )
+            document['created_at'] = person.get('created_at', datetime.now())
+            documents.append(document)
+    
+            if len(documents) >= BATCH_SIZE:
+                inserted += insert_faces(documents)
+                documents = []
+        inserted += insert_faces(documents)
+    
+        store.persons_collection.update_one(
+            {'_id': person['_id']},
+            {
+                '$unset': {'face_ids': '', 'file_ids': '', 'encodings': ''},
+                '$set': {'face_count': store.faces_collection.count_documents({'person_name': person['name']})}
+            }
+        )
+        persons += 1
+    
+    print(f"- {persons} persons migrated, {inserted} faces written")
+
+def pack_face_encodings():
+    print("Packing face encodings stored as lists...")
+    operations = []
+    count = 0
+    
+    for face in store.faces_collection.find({'encoding': {'$type': 'array'}}, {'_id': 1, 'encoding': 1}):
+        operations.append(UpdateOne({'_id': face['_id']}, {'$set': {'encoding': pack_encoding(face['encoding'])}}))
+        count += 1
+        if len(operations) >= BATCH_SIZE:
+            store.faces_collection.bulk_write(operations, ordered=False)
+            operations = []
+    
+    if operations:
+        store.faces_collection.bulk_write(operations, ordered=False)
+    print(f"- {count} encodings packed")
+
+def remove_duplicate_faces():
+    print("Removing faces that repeat an image of their person...")
+    duplicates = store.duplicate_faces()
+    
+    # The oldest face of each image stays
+    for person_name, face_id in duplicates:
+        db.delete_face_from_person(person_name, face_id)
+    print(f"- {len(duplicates)} duplicate faces removed")
+
+def migrate():
+    print("Creating indexes...")
+    db.ensure_indexes()
+    
+    if isinstance(store, MongoStorage):
+        migrate_persons()
+        pack_face_encodings()
+    
+        # Everything face_hashes held now lives on the face documents
+        store.db.drop_collection('face_hashes')
+    
+    remove_duplicate_faces()
+    
+    # Now that each image is stored once per person, the unique index builds
+    db.ensure_indexes()
+    
+    print("\nDone! Person faces are now stored one document per face.")
+
+if __name__ == "__main__":
+    migrate()
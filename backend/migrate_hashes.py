@@ -0,0 +1,107 @@
+from pymongo import UpdateOne
+import database as db
+from mongo_storage import MongoStorage
+import near_duplicate
+
+# One-off migration: backfills content and perceptual hashes for images
+# stored before hashes were recorded at save time, so duplicate checks
+# become indexed lookups instead of re-reading every GridFS file
+
+BATCH_SIZE = 500
+
+# Older versions always stored their data in MongoDB
+store = db.store
+
+def flush(collection, operations):
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    return []
+
+def backfill_file_hashes():
+    print("Hashing GridFS files without stored hashes...")
+    files = store.db['fs.files']
+    operations = []
+    count = 0
+    
+    missing = {'$or': [{'image_hash': {'$exists': False}}, {'phash': None}]}
+    for file_doc in files.find(missing, {'_id': 1}):
+        try:
+            img_bytes = store.fs.get(file_doc['_id']).read()
+            hashes = {
+                'image_hash': db.image_hash(img_bytes),
+                'phash': near_duplicate.dhash_from_bytes(img_bytes)
+            }
+        except Exception as e:
+            print(f"Error reading file {file_doc['_id']}: {e}")
+            continue
+        
+        operations.append(UpdateOne({'_id': file_doc['_id']}, {'$set': hashes}))
+        count += 1
+        if len(operations) >= BATCH_SIZE:
+            operations = flush(files, operations)
+    
+    flush(files, operations)
+    print(f"- {count} files hashed")
+
+def backfill_person_hashes():
+    print("Recording image hashes for persons...")
+    operations = []
+    count = 0
+    
+    missing = {'$or': [{'image_hash': None}, {'phash': None}]}
+    faces = list(store.faces_collection.find(missing, {'_id': 1, 'file_id': 1}))
+    for start in range(0, len(faces), BATCH_SIZE):
+        batch = faces[start:start + BATCH_SIZE]
+        file_ids = [face['file_id'] for face in batch]
+        file_hashes = db.get_file_hashes(file_ids)
+        file_phashes = db.get_file_phashes(file_ids)
+        
+        for face in batch:
+            img_hash = file_hashes.get(face['file_id'])
+            if img_hash:
+                hashes = {'image_hash': img_hash, 'phash': file_phashes.get(face['file_id'])}
+                operations.append(UpdateOne({'_id': face['_id']}, {'$set': hashes}))
+                count += 1
+        operations = flush(store.faces_collection, operations)
+    
+    print(f"- {count} person faces recorded")
+
+def backfill_unrecognized_hashes():
+    print("Recording image hashes for unrecognized faces...")
+    operations = []
+    count = 0
+    
+    missing = {'$or': [{'image_hash': {'$exists': False}}, {'phash': None}]}
+    faces = list(store.encodings_collection.find(missing, {'_id': 1, 'file_id': 1}))
+    for start in range(0, len(faces), BATCH_SIZE):
+        batch = faces[start:start + BATCH_SIZE]
+        file_ids = [face['file_id'] for face in batch if 'file_id' in face]
+        file_hashes = db.get_file_hashes(file_ids)
+        file_phashes = db.get_file_phashes(file_ids)
+        
+        for face in batch:
+            img_hash = file_hashes.get(face.get('file_id'))
+            if img_hash:
+                hashes = {'image_hash': img_hash, 'phash': file_phashes.get(face['file_id'])}
+                operations.append(UpdateOne({'_id': face['_id']}, {'$set': hashes}))
+                count += 1
+        operations = flush(store.encodings_collection, operations)
+    
+    print(f"- {count} unrecognized faces updated")
+
+def migrate():
+    if not isinstance(store, MongoStorage):
+        print("Nothing to migrate - this migration only applies to the MongoDB storage backend")
+        return
+    
+    print("Creating indexes...")
+    db.ensure_indexes()
+    
+    backfill_file_hashes()
+    backfill_person_hashes()
+    backfill_unrecognized_hashes()
+    
+    print("\nDone! Duplicate checks now use the stored hashes.")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,106 @@
+from datetime import datetime
+from bson.objectid import ObjectId
+import database as db
+from mongo_storage import MongoStorage
+
+# One-off migration: converts the old single history document
+# ({'type': 'history'} with image_history / recognized_persons /
+# unrecognized_persons arrays) into one history event per entry. Embedded
+# base64 images are dropped - events reference the stored faces by id.
+
+# Formats of the toLocaleString() timestamps the frontend used to store
+TIMESTAMP_FORMATS = ('%m/%d/%Y, %I:%M:%S %p', '%d/%m/%Y, %H:%M:%S', '%Y-%m-%dT%H:%M:%S')
+
+# Older versions always stored their data in MongoDB
+store = db.store
+
+def parse_timestamp(value, fallback):
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(str(value), timestamp_format)
+        except ValueError:
+            continue
+    return fallback
+
+def history_events(history):
+    now = datetime.now()
+    events = []
+    
+    # The arrays are newest first; events are built oldest first so their ids
+    # (which order the history pages) keep the same order
+    for item in reversed(history.get('image_history', [])):
+        events.append({
+            'type': 'upload',
+            'timestamp': parse_timestamp(item.get('timestamp'), now),
+            'filename': None,
+            'faces': [
+                {'face_id': result.get('id'), 'name': result.get('name'), 'confidence': result.get('confidence', 0)}
+                for result in item.get('results', [])
+            ]
+        })
+    
+    for person in history.get('recognized_persons', []):
+        for image in reversed(person.get('images', [])):
+            events.append({
+                'type': 'recognized',
+                'timestamp': parse_timestamp(image.get('timestamp'), now),
+                'person_name': person.get('name'),
+                'face_id': image.get('id'),
+                'confidence': image.get('confidence', 0)
+            })
+    
+    for face in reversed(history.get('unrecognized_persons', [])):
+        events.append({
+            'type': 'unrecognized',
+            'timestamp': parse_timestamp(face.get('timestamp'), now),
+            'face_id': face.get('id'),
+            'face_position': face.get('facePosition')
+        })
+    
+    # Only keep faces that are still stored in the list they were in
+    person_face_ids = {face['face_id'] for face in store.faces_collection.find({}, {'_id': 0, 'face_id': 1})}
+    unrecognized_ids = {
+        face['face_id'] for face in store.encodings_collection.find({'recognized': False}, {'_id': 0, 'face_id': 1})
+    }
+    events = [
+        event for event in events
+        if event['type'] == 'upload'
+        or (event['type'] == 'recognized' and event['face_id'] in person_face_ids)
+        or (event['type'] == 'unrecognized' and event['face_id'] in unrecognized_ids)
+    ]
+    
+    for event in sorted(events, key=lambda event: event['timestamp']):
+        event['_id'] = ObjectId()
+    
+    return events
+
+def migrate():
+    if not isinstance(store, MongoStorage):
+        print("Nothing to migrate - this migration only applies to the MongoDB storage backend")
+        return
+    
+    print("Creating indexes...")
+    db.ensure_indexes()
+    
+    history = store.history_collection.find_one({'type': 'history'})
+    if not history:
+        print("No single-document history found - nothing to migrate")
+        return
+    
+    print("Converting history entries into events...")
+    events = history_events(history)
+    if events:
+        store.history_events_collection.insert_many(events, ordered=False)
+    
+    counts = {}
+    for event in events:
+        counts[event['type']] = counts.get(event['type'], 0) + 1
+    for event_type in db.HISTORY_EVENT_TYPES:
+        print(f"- {counts.get(event_type, 0)} {event_type} events")
+    
+    store.history_collection.delete_one({'_id': history['_id']})
+    
+    print("\nDone! History is now stored one event per document.")
+
+if __name__ == "__main__":
+    migrate()
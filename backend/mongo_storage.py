@@ -0,0 +1,720 @@
+import time
+import hashlib
+import logging
+import numpy as np
+import gridfs
+from datetime import datetime, timedelta
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from storage import Storage, prefix_upper_bound
+
+logger = logging.getLogger(__name__)
+
+# MongoDB/GridFS storage. Person faces live one document per face in
+# 'faces' (encoding packed as float32 bytes), persons only hold a name and a
+# face count, unrecognized faces are in 'encodings' and images in GridFS.
+
+# Chunk size GridFS uses by default (255 KiB)
+GRIDFS_CHUNK_SIZE = 255 * 1024
+
+# Files removed per delete_many round trip by bulk deletes
+GRIDFS_DELETE_BATCH = 1000
+
+def pack_encoding(face_encoding):
+
+    # 128 float32 values as 512 raw bytes instead of a list of 128 doubles
+    return Binary(np.asarray(face_encoding, dtype=np.float32).tobytes())
+
+def unpack_encoding(value):
+
+    # Lists are accepted for documents written before encodings were packed
+    if isinstance(value, (bytes, Binary)):
+        return np.frombuffer(value, dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+def face_document(person_name, face_id, file_id, face_encoding, img_hash, phash, created_at=None):
+
+    return {
+        'face_id': face_id,
+        'person_name': person_name,
+        'file_id': file_id,
+        'encoding': pack_encoding(face_encoding),
+        'image_hash': img_hash,
+        'phash': phash,
+        'created_at': created_at or datetime.now()
+    }
+
+class MongoStorage(Storage):
+
+    def __init__(self, uri, db_name, max_pool_size=100, min_pool_size=0, timeout_ms=None, write_concern=None):
+        options = {'maxPoolSize': max_pool_size, 'minPoolSize': min_pool_size}
+        if timeout_ms:
+            options['serverSelectionTimeoutMS'] = timeout_ms
+            options['connectTimeoutMS'] = timeout_ms
+        if write_concern:
+            options['w'] = int(write_concern) if write_concern.isdigit() else write_concern
+
+        # The client connects lazily, on the first operation
+        self.client = MongoClient(uri, **options)
+        self.db_name = db_name
+        self.db = self.client[db_name]
+        self.fs = gridfs.GridFS(self.db)
+
+        self.persons_collection = self.db['persons']
+        self.encodings_collection = self.db['encodings']
+        # Legacy single-document history, only read by migrate_history.py
+        self.history_collection = self.db['history']
+        # Append-only upload history, one document per event
+        self.history_events_collection = self.db['history_events']
+        # Progress of background maintenance (garbage collector cursors)
+        self.maintenance_collection = self.db['maintenance']
+        self.faces_collection = self.db['faces']
+        # Gallery change log, keyed by generation
+        self.gallery_changes_collection = self.db['gallery_changes']
+        self.files_collection = self.db['fs.files']
+        self.chunks_collection = self.db['fs.chunks']
+
+    def ensure_schema(self):
+
+        self.persons_collection.create_index('name', unique=True, name='name')
+        self.faces_collection.create_index('face_id', unique=True, name='face_id')
+        self.faces_collection.create_index('person_name', name='person_name')
+        # Duplicate checks are a single lookup on (person_name, image_hash),
+        # and the index keeps one face per image and person. Faces stored
+        # without a hash are left out of it
+        try:
+            self.faces_collection.create_index(
+                [('person_name', 1), ('image_hash', 1)],
+                unique=True,
+                partialFilterExpression={'image_hash': {'$gt': ''}},
+                name='person_image_hash_unique'
+            )
+        except DuplicateKeyError:
+            logger.error("Persons have the same image stored twice; run migrate_faces.py to remove the copies "
+                         "and enforce one face per image and person")
+            self.faces_collection.create_index([('person_name', 1), ('image_hash', 1)], name='person_image_hash')
+        else:
+            # Non-unique index of earlier versions
+            if 'person_image_hash' in self.faces_collection.index_information():
+                self.faces_collection.drop_index('person_image_hash')
+        self.encodings_collection.create_index('face_id', name='face_id')
+        # The garbage collector looks up which records still reference a file,
+        # and expiry scans unrecognized faces by age
+        self.faces_collection.create_index('file_id', name='file_id')
+        self.encodings_collection.create_index('file_id', name='file_id')
+        self.encodings_collection.create_index([('recognized', 1), ('timestamp', 1)], name='recognized_timestamp')
+        # Unrecognized faces are listed newest first
+        self.encodings_collection.create_index([('recognized', 1), ('_id', -1)], name='recognized_id')
+        # History pages are read newest first per event type
+        self.history_events_collection.create_index([('type', 1), ('_id', -1)], name='type_id')
+        self.history_events_collection.create_index('face_id', name='face_id')
+        self.history_events_collection.create_index('person_name', name='person_name')
+        self.gallery_changes_collection.create_index('timestamp', name='timestamp')
+
+    def drop(self):
+
+        self.client.drop_database(self.db_name)
+
+    def person_exists(self, person_name):
+
+        return self.persons_collection.find_one({'name': person_name}, {'_id': 1}) is not None
+
+    def person_names(self):
+
+        return [person['name'] for person in self.persons_collection.find({}, {'_id': 0, 'name': 1})]
+
+    def _name_query(self, prefix=None, cursor=None):
+
+        # A range on the unique name index
+        name = {}
+        if prefix:
+            name['$gte'] = prefix
+            bound = prefix_upper_bound(prefix)
+            if bound is not None:
+                name['$lt'] = bound
+        if cursor is not None:
+            name['$gt'] = cursor
+        return {'name': name} if name else {}
+
+    def person_page(self, prefix=None, cursor=None, limit=100):
+
+        persons = self.persons_collection.find(
+            self._name_query(prefix, cursor), {'_id': 0, 'name': 1, 'face_count': 1}
+        ).sort('name', 1).limit(limit)
+
+        return [{'name': person['name'], 'face_count': person.get('face_count', 0)} for person in persons]
+
+    def count_persons(self, prefix=None):
+
+        return self.persons_collection.count_documents(self._name_query(prefix))
+
+    def add_faces(self, faces):
+
+        duplicates = {}
+        try:
+            self.faces_collection.insert_many([
+                face_document(face['person_name'], face['face_id'], face['file_id'], face['encoding'],
+                              face['image_hash'], face['phash'], face.get('created_at'))
+                for face in faces
+            ], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                if error['code'] != 11000:
+                    raise
+                # The person already has this image, stored by a concurrent request
+                face = faces[error['index']]
+                stored_id = face['image_hash'] and self.find_face_by_hash(face['person_name'], face['image_hash'])
+                if not stored_id:
+                    raise
+                duplicates[face['face_id']] = stored_id
+
+        counts = {}
+        for face in faces:
+            if face['face_id'] not in duplicates:
+                counts[face['person_name']] = counts.get(face['person_name'], 0) + 1
+        if not counts:
+            return duplicates
+
+        # Create each person on their first face
+        self.persons_collection.bulk_write([
+            UpdateOne(
+                {'name': person_name},
+                {'$inc': {'face_count': count}, '$setOnInsert': {'created_at': datetime.now()}},
+                upsert=True
+            )
+            for person_name, count in counts.items()
+        ], ordered=False)
+
+        return duplicates
+
+    def duplicate_faces(self):
+
+        groups = self.faces_collection.aggregate([
+            {'$match': {'image_hash': {'$gt': ''}}},
+            {'$sort': {'_id': 1}},
+            {'$group': {'_id': {'person_name': '$person_name', 'image_hash': '$image_hash'},
+                        'face_ids': {'$push': '$face_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}}
+        ], allowDiskUse=True)
+
+        return [(group['_id']['person_name'], face_id) for group in groups for face_id in group['face_ids'][1:]]
+
+    def has_face(self, person_name, face_id):
+
+        return self.faces_collection.find_one({'person_name': person_name, 'face_id': face_id}, {'_id': 1}) is not None
+
+    def person_face_ids(self, person_name):
+
+        return [
+            face['face_id']
+            for face in self.faces_collection.find({'person_name': person_name}, {'_id': 0, 'face_id': 1}).sort('_id', -1)
+        ]
+
+    def iter_faces(self, person_name=None, face_ids=None):
+
+        query = {}
+        if person_name is not None:
+            query['person_name'] = person_name
+        if face_ids is not None:
+            query['face_id'] = {'$in': list(face_ids)}
+
+        projection = {'_id': 0, 'person_name': 1, 'face_id': 1, 'encoding': 1}
+        for face in self.faces_collection.find(query, projection, batch_size=self.batch_size):
+            yield face['person_name'], face['face_id'], unpack_encoding(face['encoding'])
+
+    def face_ids(self):
+
+        return {
+            face['face_id']
+            for face in self.faces_collection.find({}, {'_id': 0, 'face_id': 1}, batch_size=self.batch_size)
+        }
+
+    def face_file_ids(self):
+
+        return [face['file_id'] for face in self.faces_collection.find({}, {'_id': 0, 'file_id': 1})]
+
+    def find_face_by_hash(self, person_name, img_hash):
+
+        # Single indexed lookup on (person_name, image_hash)
+        face = self.faces_collection.find_one(
+            {'person_name': person_name, 'image_hash': img_hash},
+            {'_id': 0, 'face_id': 1}
+        )
+
+        return face['face_id'] if face else None
+
+    def find_faces_by_hashes(self, person_name, img_hashes):
+
+        return {
+            face['image_hash']: face['face_id']
+            for face in self.faces_collection.find(
+                {'person_name': person_name, 'image_hash': {'$in': list(img_hashes)}},
+                {'_id': 0, 'face_id': 1, 'image_hash': 1}
+            )
+        }
+
+    def face_phashes(self, person_name, face_ids):
+
+        return {
+            face['face_id']: face.get('phash')
+            for face in self.faces_collection.find(
+                {'person_name': person_name, 'face_id': {'$in': list(face_ids)}},
+                {'_id': 0, 'face_id': 1, 'phash': 1}
+            )
+        }
+
+    def delete_face(self, person_name, face_id):
+
+        # Remove the face document and get its file back in the same round trip
+        face = self.faces_collection.find_one_and_delete(
+            {'person_name': person_name, 'face_id': face_id},
+            projection={'_id': 0, 'face_id': 1, 'file_id': 1}
+        )
+
+        if face:
+            self.persons_collection.update_one({'name': person_name}, {'$inc': {'face_count': -1}})
+
+        return face
+
+    def delete_person(self, person_name):
+
+        faces = list(self.faces_collection.find({'person_name': person_name}, {'_id': 0, 'face_id': 1, 'file_id': 1}))
+
+        result = self.persons_collection.delete_one({'name': person_name})
+        self.faces_collection.delete_many({'person_name': person_name})
+
+        return faces if result.deleted_count > 0 else None
+
+    def delete_all_persons(self):
+
+        result = self.persons_collection.delete_many({})
+        self.faces_collection.delete_many({})
+
+        return result.deleted_count
+
+    def _unrecognized_record(self, document):
+
+        record = dict(document)
+        record['id'] = str(record.pop('_id'))
+        record['encoding'] = unpack_encoding(record['encoding'])
+        return record
+
+    def add_unrecognized(self, faces):
+
+        result = self.encodings_collection.insert_many([
+            {
+                '_id': ObjectId(),
+                'face_id': face['face_id'],
+                'file_id': face['file_id'],
+                'encoding': np.asarray(face['encoding'], dtype=float).tolist(),
+                'image_hash': face['image_hash'],
+                'phash': face['phash'],
+                'recognized': False,
+                'timestamp': datetime.now()
+            }
+            for face in faces
+        ], ordered=False)
+        self._unrecognized_changed(len(result.inserted_ids))
+
+        return bool(result.acknowledged)
+
+    def _unrecognized_changed(self, changes):
+
+        # One step per face added, named, put back or deleted, after the
+        # change itself, so the version never runs ahead of the listing
+        if changes:
+            self.maintenance_collection.update_one(
+                {'_id': 'unrecognized_version'}, {'$inc': {'value': changes}}, upsert=True
+            )
+
+    def get_unrecognized(self, face_id):
+
+        document = self.encodings_collection.find_one({'face_id': face_id, 'recognized': False})
+
+        return self._unrecognized_record(document) if document else None
+
+    def get_unrecognized_many(self, face_ids):
+
+        return [
+            self._unrecognized_record(document)
+            for document in self.encodings_collection.find({'face_id': {'$in': list(face_ids)}, 'recognized': False})
+        ]
+
+    def iter_unrecognized(self, after=None):
+
+        query = {'recognized': False}
+        if after:
+            query['_id'] = {'$gt': ObjectId(after)}
+
+        faces = self.encodings_collection.find(
+            query, {'_id': 0, 'face_id': 1, 'encoding': 1}
+        ).sort('_id', 1).batch_size(self.batch_size)
+
+        for face in faces:
+            yield face['face_id'], unpack_encoding(face['encoding'])
+
+    def unrecognized_ids(self):
+
+        return [str(face['_id']) for face in self.encodings_collection.find({'recognized': False}, {'_id': 1})]
+
+    def unrecognized_page(self, cursor=None, limit=100):
+
+        query = {'recognized': False}
+        if cursor:
+            query['_id'] = {'$lt': ObjectId(cursor)}
+
+        faces = self.encodings_collection.find(
+            query, {'_id': 1, 'face_id': 1, 'timestamp': 1}
+        ).sort('_id', -1).limit(limit)
+
+        return [{'id': str(face['_id']), 'face_id': face['face_id'], 'timestamp': face.get('timestamp')} for face in faces]
+
+    def unrecognized_state(self):
+
+        # The version is read first: a change landing in between shows up as
+        # a version step on the next read
+        counter = self.maintenance_collection.find_one({'_id': 'unrecognized_version'})
+        newest = self.encodings_collection.find_one({'recognized': False}, {'_id': 1}, sort=[('_id', -1)])
+        count = self.encodings_collection.count_documents({'recognized': False})
+        return count, str(newest['_id']) if newest else None, counter['value'] if counter else 0
+
+    def mark_recognized(self, face_id, person_name):
+
+        result = self.encodings_collection.update_one(
+            {'face_id': face_id},
+            {'$set': {'recognized': True, 'person_name': person_name}}
+        )
+        self._unrecognized_changed(result.modified_count)
+
+        return bool(result.acknowledged)
+
+    def mark_recognized_many(self, face_ids, person_name):
+
+        result = self.encodings_collection.update_many(
+            {'face_id': {'$in': list(face_ids)}},
+            {'$set': {'recognized': True, 'person_name': person_name}}
+        )
+        self._unrecognized_changed(result.modified_count)
+
+        return bool(result.acknowledged)
+
+    def unmark_recognized(self, face_ids=None, person_name=None):
+
+        query = {'recognized': True}
+        if face_ids is not None:
+            query['face_id'] = {'$in': list(face_ids)}
+        if person_name is not None:
+            query['person_name'] = person_name
+
+        result = self.encodings_collection.update_many(query, {'$set': {'recognized': False, 'person_name': None}})
+        self._unrecognized_changed(result.modified_count)
+
+    def delete_unrecognized(self, face_id):
+
+        # Remove the face document and get its file back in the same round trip
+        face = self.encodings_collection.find_one_and_delete(
+            {'face_id': face_id, 'recognized': False},
+            projection={'_id': 0, 'face_id': 1, 'file_id': 1}
+        )
+        self._unrecognized_changed(1 if face else 0)
+
+        return face
+
+    def unrecognized_file_ids(self):
+
+        return [
+            face.get('file_id')
+            for face in self.encodings_collection.find({'recognized': False}, {'_id': 0, 'file_id': 1})
+        ]
+
+    def delete_all_unrecognized(self):
+
+        deleted = self.encodings_collection.delete_many({'recognized': False}).deleted_count
+        self._unrecognized_changed(deleted)
+
+        return deleted
+
+    def expired_unrecognized(self, before, limit=0):
+
+        faces = self.encodings_collection.find(
+            {'recognized': False, 'timestamp': {'$lt': before}},
+            {'_id': 1, 'face_id': 1, 'file_id': 1}
+        ).limit(limit)
+
+        return [{'id': face['_id'], 'face_id': face.get('face_id'), 'file_id': face.get('file_id')} for face in faces]
+
+    def delete_unrecognized_ids(self, ids):
+
+        deleted = self.encodings_collection.delete_many({'_id': {'$in': list(ids)}}).deleted_count
+        self._unrecognized_changed(deleted)
+
+        return deleted
+
+    def face_file_id(self, face_id):
+
+        face = (self.faces_collection.find_one({'face_id': face_id}, {'_id': 0, 'file_id': 1})
+                or self.encodings_collection.find_one({'face_id': face_id}, {'_id': 0, 'file_id': 1}))
+
+        return face.get('file_id') if face else None
+
+    def put_blob(self, img_bytes, filename, img_hash, phash):
+
+        # The content and perceptual hashes are stored with the file so duplicate
+        # checks never re-read it
+        return self.fs.put(img_bytes, filename=filename, content_type="image/jpeg",
+                           image_hash=img_hash, phash=phash)
+
+    def put_blobs(self, blobs):
+
+        # Writes fs.chunks and fs.files with one insert_many each, in the same
+        # layout GridFS uses, so the files read back through fs.get as usual
+        file_ids = []
+        files = []
+        chunks = []
+        upload_date = datetime.utcnow()
+
+        for img_bytes, filename, img_hash, phash in blobs:
+            file_id = ObjectId()
+            file_ids.append(file_id)
+
+            for n, offset in enumerate(range(0, len(img_bytes), GRIDFS_CHUNK_SIZE)):
+                chunks.append({
+                    'files_id': file_id,
+                    'n': n,
+                    'data': Binary(img_bytes[offset:offset + GRIDFS_CHUNK_SIZE])
+                })
+
+            files.append({
+                '_id': file_id,
+                'filename': filename,
+                'contentType': 'image/jpeg',
+                'chunkSize': GRIDFS_CHUNK_SIZE,
+                'length': len(img_bytes),
+                'uploadDate': upload_date,
+                'image_hash': img_hash,
+                'phash': phash
+            })
+
+        # Chunks first so a file document never points at missing data
+        if chunks:
+            self.chunks_collection.insert_many(chunks, ordered=False)
+        if files:
+            self.files_collection.insert_many(files, ordered=False)
+
+        return file_ids
+
+    def get_blob(self, file_id):
+
+        try:
+            grid_file = self.fs.get(file_id)
+            img_bytes = grid_file.read()
+        except gridfs.errors.NoFile:
+            return None
+
+        return img_bytes, getattr(grid_file, 'image_hash', None)
+
+    def blob_hashes(self, file_ids):
+
+        # Content hashes recorded on the GridFS files, computed and backfilled for
+        # files stored before hashes were recorded
+        hashes = {}
+        for file_doc in self.files_collection.find({'_id': {'$in': list(file_ids)}}, {'image_hash': 1}):
+            hashes[file_doc['_id']] = file_doc.get('image_hash')
+
+        for file_id, img_hash in hashes.items():
+            if img_hash is None:
+                try:
+                    img_hash = hashlib.md5(self.fs.get(file_id).read()).hexdigest()
+                    self.files_collection.update_one({'_id': file_id}, {'$set': {'image_hash': img_hash}})
+                    hashes[file_id] = img_hash
+                except Exception as e:
+                    logger.error("Error hashing file %s: %s", file_id, e)
+
+        return hashes
+
+    def blob_phashes(self, file_ids):
+
+        # Perceptual hashes recorded on the GridFS files (None for older files)
+        return {
+            file_doc['_id']: file_doc.get('phash')
+            for file_doc in self.files_collection.find({'_id': {'$in': list(file_ids)}}, {'phash': 1})
+        }
+
+    def blob_sizes(self, file_ids):
+
+        return {
+            file_doc['_id']: file_doc.get('length', 0)
+            for file_doc in self.files_collection.find({'_id': {'$in': list(file_ids)}}, {'length': 1})
+        }
+
+    def delete_blobs(self, file_ids, progress=None):
+
+        # Bulk version of fs.delete: removes the file documents, then their chunks,
+        # GRIDFS_DELETE_BATCH files per delete_many
+        file_ids = [file_id for file_id in file_ids if file_id is not None]
+        deleted = 0
+
+        for start in range(0, len(file_ids), GRIDFS_DELETE_BATCH):
+            batch = file_ids[start:start + GRIDFS_DELETE_BATCH]
+            # Same order as GridFS: a crash in between leaves orphaned chunks, never a broken file
+            deleted += self.files_collection.delete_many({'_id': {'$in': batch}}).deleted_count
+            self.chunks_collection.delete_many({'files_id': {'$in': batch}})
+
+            if progress:
+                progress(start + len(batch))
+
+        return deleted
+
+    def blob_page(self, after=None, limit=500):
+
+        query = {'_id': {'$gt': after}} if after else {}
+        files = self.files_collection.find(query, {'length': 1, 'uploadDate': 1}).sort('_id', 1).limit(limit)
+
+        return [
+            {'file_id': file_doc['_id'], 'length': file_doc.get('length', 0), 'created_at': file_doc.get('uploadDate')}
+            for file_doc in files
+        ]
+
+    def referenced_blobs(self, file_ids):
+
+        referenced = set()
+
+        for face in self.faces_collection.find({'file_id': {'$in': file_ids}}, {'_id': 0, 'file_id': 1}):
+            referenced.add(face['file_id'])
+
+        for face in self.encodings_collection.find({'file_id': {'$in': file_ids}}, {'_id': 0, 'file_id': 1}):
+            referenced.add(face['file_id'])
+
+        # Databases not yet converted by migrate_faces.py keep file ids on the person
+        for person in self.persons_collection.find({'file_ids': {'$in': file_ids}}, {'_id': 0, 'file_ids': 1}):
+            referenced.update(person['file_ids'])
+
+        return referenced
+
+    def collect_orphan_data(self, batch_size, pause, grace, dry_run=False):
+
+        # Chunks of files whose document is gone, e.g. after an interrupted delete.
+        # Every file has a chunk n=0, so walking those finds each file once
+        cutoff = datetime.utcnow() - timedelta(seconds=grace)
+        deleted = 0
+        cursor = None
+
+        while True:
+            query = {'n': 0, '_id': {'$gt': cursor}} if cursor else {'n': 0}
+            chunks = list(self.chunks_collection.find(query, {'files_id': 1}).sort('_id', 1).limit(batch_size))
+            if not chunks:
+                break
+
+            files_ids = [chunk['files_id'] for chunk in chunks]
+            existing = {
+                file_doc['_id'] for file_doc in self.files_collection.find({'_id': {'$in': files_ids}}, {'_id': 1})
+            }
+            # Bulk uploads write chunks before their file document
+            orphans = [
+                chunk['files_id'] for chunk in chunks
+                if chunk['files_id'] not in existing and chunk['_id'].generation_time.replace(tzinfo=None) <= cutoff
+            ]
+
+            if orphans:
+                if dry_run:
+                    deleted += self.chunks_collection.count_documents({'files_id': {'$in': orphans}})
+                else:
+                    deleted += self.chunks_collection.delete_many({'files_id': {'$in': orphans}}).deleted_count
+
+            cursor = chunks[-1]['_id']
+            time.sleep(pause)
+
+        return deleted
+
+    def valid_event_id(self, event_id):
+
+        return ObjectId.is_valid(event_id)
+
+    def append_history(self, events):
+
+        documents = [dict(event, _id=ObjectId()) for event in events]
+        self.history_events_collection.insert_many(documents, ordered=True)
+
+        return [self._event_record(document) for document in documents]
+
+    def _event_record(self, document):
+
+        event = dict(document)
+        event['id'] = str(event.pop('_id'))
+        return event
+
+    def history_page(self, event_type, cursor=None, limit=50):
+
+        query = {'type': event_type}
+        if cursor:
+            query['_id'] = {'$lt': ObjectId(cursor)}
+
+        return [
+            self._event_record(event)
+            for event in self.history_events_collection.find(query).sort('_id', -1).limit(limit)
+        ]
+
+    def delete_history_event(self, event_id):
+
+        return self.history_events_collection.delete_one({'_id': ObjectId(event_id)}).deleted_count > 0
+
+    def delete_history(self, event_type, face_ids=None, person_name=None):
+
+        query = {'type': event_type}
+        if face_ids is not None:
+            query['face_id'] = {'$in': list(face_ids)}
+        if person_name is not None:
+            query['person_name'] = person_name
+
+        return self.history_events_collection.delete_many(query).deleted_count
+
+    def append_gallery_changes(self, changes):
+
+        # Generations are reserved on one counter document, so they are unique
+        # and ordered; an insert still in flight leaves a short gap readers wait out
+        if not changes:
+            return []
+        counter = self.maintenance_collection.find_one_and_update(
+            {'_id': 'gallery_generation'}, {'$inc': {'value': len(changes)}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+        first = counter['value'] - len(changes) + 1
+        timestamp = datetime.now()
+        documents = [
+            {'_id': first + i, 'op': change['op'], 'person_name': change.get('person_name'),
+             'face_id': change.get('face_id'), 'timestamp': timestamp}
+            for i, change in enumerate(changes)
+        ]
+        self.gallery_changes_collection.insert_many(documents, ordered=True)
+
+        return [document['_id'] for document in documents]
+
+    def gallery_changes(self, after, limit=1000):
+
+        return [
+            {'generation': document['_id'], 'op': document['op'], 'person_name': document.get('person_name'),
+             'face_id': document.get('face_id'), 'timestamp': document['timestamp']}
+            for document in self.gallery_changes_collection.find({'_id': {'$gt': after}}).sort('_id', 1).limit(limit)
+        ]
+
+    def gallery_generation(self):
+
+        counter = self.maintenance_collection.find_one({'_id': 'gallery_generation'})
+        return counter['value'] if counter else 0
+
+    def prune_gallery_changes(self, before):
+
+        return self.gallery_changes_collection.delete_many({'timestamp': {'$lt': before}}).deleted_count
+
+    def get_state(self, key):
+
+        state = self.maintenance_collection.find_one({'_id': key})
+        if state:
+            state.pop('_id')
+        return state
+
+    def set_state(self, key, values):
+
+        self.maintenance_collection.update_one({'_id': key}, {'$set': values}, upsert=True)
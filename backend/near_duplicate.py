@@ -0,0 +1,77 @@
+import threading
+import numpy as np
+import dlib
+import face_recognition_models
+from PIL import Image
+from io import BytesIO
+
+# Near-duplicate detection for face crops.
+# The exact MD5 check misses the same photo re-uploaded with a slightly
+# different detector box or recompression. A difference hash (dHash) of the
+# landmark-aligned face is stable under both, and combined with a small
+# encoding distance it tells a re-upload apart from a genuinely new photo
+# of the same person. Hashing the raw crop does not work: a box shifted by
+# a tenth of the face width already flips a third of the bits.
+
+# dHash grid: HASH_SIZE x HASH_SIZE bits from a (HASH_SIZE + 1) x HASH_SIZE thumbnail
+HASH_SIZE = 8
+
+# Side of the aligned face chip the hash is computed from
+CHIP_SIZE = 64
+
+# 5-point landmark model shipped with face_recognition, loaded on first use.
+# dlib objects are not thread-safe, so calls are serialized
+_predictor = None
+_predictor_lock = threading.Lock()
+
+def align_face(face_image):
+
+    global _predictor
+
+    face_image = np.ascontiguousarray(face_image)
+    height, width = face_image.shape[:2]
+
+    with _predictor_lock:
+        if _predictor is None:
+            _predictor = dlib.shape_predictor(face_recognition_models.pose_predictor_five_point_model_location())
+
+        # The crop is the detector box, so the whole crop is the face rectangle
+        shape = _predictor(face_image, dlib.rectangle(0, 0, width - 1, height - 1))
+        return dlib.get_face_chip(face_image, shape, size=CHIP_SIZE, padding=0.0)
+
+def dhash(face_image):
+
+    # face_image is an RGB numpy array (a face crop)
+    thumbnail = Image.fromarray(align_face(face_image)).convert('L').resize(
+        (HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR
+    )
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+
+    # One bit per pixel: is it brighter than its right-hand neighbour
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+
+    # Stored as a signed 64-bit integer, which is what MongoDB supports
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def dhash_from_bytes(img_bytes):
+
+    return dhash(np.asarray(Image.open(BytesIO(img_bytes)).convert('RGB')))
+
+def hamming_distance(hash_a, hash_b):
+
+    return bin((hash_a ^ hash_b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+def encoding_distance(encoding_a, encoding_b):
+
+    return float(np.linalg.norm(np.asarray(encoding_a) - np.asarray(encoding_b)))
+
+def is_near_duplicate(encoding_a, phash_a, encoding_b, phash_b, hash_distance, max_encoding_distance):
+
+    if phash_a is None or phash_b is None:
+        return False
+
+    return (hamming_distance(phash_a, phash_b) <= hash_distance
+            and encoding_distance(encoding_a, encoding_b) <= max_encoding_distance)
@@ -0,0 +1,249 @@
+import threading
+import numpy as np
+from gallery_index import ENCODING_SIZE
+
+# Prototype compression of the gallery.
+# Instead of every stored encoding, each person is represented in the match
+# index by their centroid plus up to k medoids - real encodings of theirs,
+# picked to be spread out so unusual poses or lighting stay covered.
+# Matching cost then grows with the number of people, not photos.
+
+# Face id of the centroid row of a person in the underlying index
+def centroid_id(person_name):
+
+    return f"centroid:{person_name}"
+
+def select_medoids(encodings, k):
+
+    # Greedy k-center: start from the encoding closest to the centroid, then
+    # keep adding the encoding farthest from everything picked so far
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    if len(encodings) <= k:
+        return list(range(len(encodings)))
+
+    centroid = encodings.mean(axis=0)
+    picked = [int(np.argmin(np.linalg.norm(encodings - centroid, axis=1)))]
+    nearest = np.linalg.norm(encodings - encodings[picked[0]], axis=1)
+
+    while len(picked) < k:
+        candidate = int(np.argmax(nearest))
+        picked.append(candidate)
+        nearest = np.minimum(nearest, np.linalg.norm(encodings - encodings[candidate], axis=1))
+
+    return picked
+
+class _Person:
+
+    def __init__(self):
+        self.count = 0
+        self.total = np.zeros(ENCODING_SIZE, dtype=np.float64)
+        self.face_ids = set()
+        # face_id -> encoding of the current medoids
+        self.medoids = {}
+
+class PrototypeIndex:
+    # Wraps another gallery index (exact, ivf or hnsw) and stores only the
+    # prototypes in it. loader(person_name) returns the person's stored
+    # (person_name, face_id, encoding) entries; it is used to recompute the
+    # prototypes when one of their faces is deleted.
+
+    persistent = False
+
+    def __init__(self, inner, k, loader):
+        self._inner = inner
+        self._lock = threading.RLock()
+        self.k = max(1, k)
+        self._loader = loader
+        self._persons = {}
+        self._face_persons = {}
+
+    @property
+    def loaded(self):
+        return self._inner.loaded
+
+    def __len__(self):
+        return len(self._face_persons)
+
+    def prototype_count(self):
+
+        return len(self._inner)
+
+    def _prototype_entries(self, person_name, person):
+        entries = [(person_name, centroid_id(person_name), person.total / person.count)]
+        entries += [(person_name, face_id, encoding) for face_id, encoding in person.medoids.items()]
+        return entries
+
+    def _build_person(self, person_name, entries):
+        person = _Person()
+        if entries:
+            encodings = np.asarray([encoding for _, _, encoding in entries], dtype=np.float32)
+            person.count = len(entries)
+            person.total = encodings.sum(axis=0, dtype=np.float64)
+            person.face_ids = {face_id for _, face_id, _ in entries}
+            for i in select_medoids(encodings, self.k):
+                person.medoids[entries[i][1]] = encodings[i]
+        return person
+
+    def load(self, entries):
+
+        grouped = {}
+        for entry in entries:
+            grouped.setdefault(entry[0], []).append(entry)
+
+        with self._lock:
+            self._persons = {}
+            self._face_persons = {}
+            prototype_entries = []
+
+            for person_name, person_entries in grouped.items():
+                person = self._build_person(person_name, person_entries)
+                self._persons[person_name] = person
+                for _, face_id, _ in person_entries:
+                    self._face_persons[face_id] = person_name
+                prototype_entries += self._prototype_entries(person_name, person)
+
+            self._inner.load(prototype_entries)
+
+    def add(self, person_name, face_id, face_encoding):
+
+        self.add_many([(person_name, face_id, face_encoding)])
+
+    def add_many(self, entries):
+
+        grouped = {}
+        for person_name, face_id, face_encoding in entries:
+            grouped.setdefault(person_name, []).append((face_id, np.asarray(face_encoding, dtype=np.float32)))
+
+        with self._lock:
+            added = []
+            for person_name, faces in grouped.items():
+                added += self._add_person_faces(person_name, faces)
+            self._inner.add_many(added)
+
+    def _add_person_faces(self, person_name, faces):
+        # Folds one person's new faces into their prototypes. Rows that change
+        # are overwritten in place in the inner index - the centroid once per
+        # call, a dropped medoid by the medoid replacing it; returns the rows
+        # to add to it
+        person = self._persons.get(person_name)
+        is_new = person is None
+        if is_new:
+            person = _Person()
+        medoids_before = set(person.medoids)
+
+        count_before = person.count
+        for face_id, encoding in faces:
+            # A face indexed already (e.g. one the change log delivers again)
+            # would count twice in the centroid
+            if face_id in self._face_persons:
+                continue
+            self._face_persons[face_id] = person_name
+            person.face_ids.add(face_id)
+            person.count += 1
+            person.total += encoding
+            self._offer_medoid(person, face_id, encoding)
+
+        if person.count == count_before:
+            return []
+        self._persons[person_name] = person
+
+        added = []
+        dropped = [face_id for face_id in medoids_before if face_id not in person.medoids]
+        picked = [face_id for face_id in person.medoids if face_id not in medoids_before]
+        for i, face_id in enumerate(picked):
+            entry = (person_name, face_id, person.medoids[face_id])
+            if i < len(dropped):
+                self._inner.replace(dropped[i], entry)
+            else:
+                added.append(entry)
+
+        centroid = (person_name, centroid_id(person_name), person.total / person.count)
+        if is_new:
+            added.append(centroid)
+        else:
+            self._inner.replace(centroid_id(person_name), centroid)
+        return added
+
+    def _offer_medoid(self, person, face_id, encoding):
+        if len(person.medoids) < self.k:
+            person.medoids[face_id] = encoding
+            return
+
+        # Swap the new encoding in when it is farther from the medoids than
+        # the two closest medoids are from each other - the set stays spread out
+        medoid_ids = list(person.medoids)
+        medoids = np.asarray([person.medoids[i] for i in medoid_ids])
+        new_distance = np.linalg.norm(medoids - encoding, axis=1).min()
+
+        pairwise = np.linalg.norm(medoids[:, None, :] - medoids[None, :, :], axis=2)
+        np.fill_diagonal(pairwise, np.inf)
+        i, j = np.unravel_index(np.argmin(pairwise), pairwise.shape)
+
+        if new_distance > pairwise[i, j]:
+            # Of the closest pair, drop the one nearer to the rest of the set
+            others_i = np.delete(pairwise[i], [i, j]).min(initial=np.inf)
+            others_j = np.delete(pairwise[j], [i, j]).min(initial=np.inf)
+            del person.medoids[medoid_ids[i] if others_i < others_j else medoid_ids[j]]
+            person.medoids[face_id] = encoding
+
+    def _drop_person(self, person_name):
+        person = self._persons.pop(person_name, None)
+        if person is None:
+            return 0
+
+        self._inner.remove_person(person_name)
+        for face_id in person.face_ids:
+            self._face_persons.pop(face_id, None)
+        return len(person.face_ids)
+
+    def remove_person(self, person_name):
+
+        with self._lock:
+            return self._drop_person(person_name)
+
+    def remove_face(self, face_id):
+
+        with self._lock:
+            person_name = self._face_persons.get(face_id)
+            if person_name is None:
+                return 0
+
+            # Recompute the person's prototypes from what is left in storage
+            entries = [entry for entry in self._loader(person_name) if entry[1] != face_id]
+            self._drop_person(person_name)
+
+            if entries:
+                person = self._build_person(person_name, entries)
+                self._persons[person_name] = person
+                for _, other_face_id, _ in entries:
+                    self._face_persons[other_face_id] = person_name
+                self._inner.add_many(self._prototype_entries(person_name, person))
+            return 1
+
+    def clear(self):
+
+        with self._lock:
+            self._persons = {}
+            self._face_persons = {}
+            self._inner.clear()
+
+    def face_ids(self):
+
+        return set(self._face_persons)
+
+    def prototypes(self, person_name):
+
+        # Centroid and medoid encodings of one person, None for an unknown person
+        with self._lock:
+            person = self._persons.get(person_name)
+            if person is None:
+                return None
+            return [encoding for _, _, encoding in self._prototype_entries(person_name, person)]
+
+    def search_batch(self, face_encodings, threshold=0.6, top_k=None):
+
+        return self._inner.search_batch(face_encodings, threshold, top_k)
+
+    def search(self, face_encoding, threshold=0.6, top_k=None):
+
+        return self._inner.search(face_encoding, threshold, top_k)
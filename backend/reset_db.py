@@ -1,44 +1,21 @@
-from pymongo import MongoClient
-import gridfs
-import os
-import shutil
-
-# MongoDB connection setup
-mongo_uri = 'mongodb://localhost:27017/'
-db_name = 'face_recognition_db'
+import config
+import database
 
 def reset_database():
-    print("Connecting to MongoDB...")
-    client = MongoClient(mongo_uri)
-    
-    # Drop existing database
-    print(f"Dropping database: {db_name}")
-    client.drop_database(db_name)
-    
-    # Create new database
-    db = client[db_name]
-    
-    # Create collections
-    db.create_collection('persons')
-    db.create_collection('encodings')
-    db.create_collection('history')
+    if config.STORAGE == 'mongo':
+        print(f"Dropping MongoDB database: {config.MONGO_DB}")
+    else:
+        print(f"Deleting SQLite database {config.SQLITE_PATH} and images in {config.BLOB_DIR}")
     
-    # Initialize GridFS
-    fs = gridfs.GridFS(db)
+    # Drop all existing data
+    database.store.drop()
     
-    # Create initial history document
-    db.history.insert_one({
-        'type': 'history',
-        'image_history': [],
-        'recognized_persons': [],
-        'unrecognized_persons': []
-    })
+    # Create the collections / tables and indexes the application relies on
+    database.ensure_indexes()
     
-    print(f"Database {db_name} successfully reset with collections:")
-    for collection in db.list_collection_names():
-        print(f"- {collection}")
+    print(f"Storage ({config.STORAGE}) successfully reset")
     
     print("\nDone! The application should now work correctly.")
 
 if __name__ == "__main__":
-    reset_database() 
\ No newline at end of file
+    reset_database()
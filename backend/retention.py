@@ -0,0 +1,187 @@
+import time
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+import config
+import database as db
+from jobs import jobs
+
+logger = logging.getLogger(__name__)
+
+# Retention and image garbage collection.
+# Unrecognized faces older than FACE_UNRECOGNIZED_TTL are expired together
+# with their images. The garbage collector is an incremental mark-and-sweep
+# over the stored images: each batch (in id order) is checked against the
+# face and unrecognized face records that may reference it, and images
+# nobody references are deleted. The position is saved after every batch, so
+# a run can stop anywhere and the next one continues from there. Backend
+# leftovers (GridFS chunks without a file, blob files without a record) are
+# swept at the end of each cycle.
+
+def file_sizes(file_ids):
+
+    return db.store.blob_sizes(file_ids)
+
+def expire_unrecognized_faces(ttl=None, batch_size=None, pause=None, dry_run=False):
+
+    ttl = config.UNRECOGNIZED_TTL if ttl is None else ttl
+    batch_size = batch_size or config.GC_BATCH_SIZE
+    pause = config.GC_BATCH_PAUSE if pause is None else pause
+    report = {"faces_expired": 0, "bytes_reclaimed": 0}
+    
+    if ttl <= 0:
+        return report
+    
+    # Unrecognized faces are timestamped with local time
+    before = datetime.now() - timedelta(seconds=ttl)
+    
+    if dry_run:
+        faces = db.store.expired_unrecognized(before)
+        report["faces_expired"] = len(faces)
+        report["bytes_reclaimed"] = sum(file_sizes(face['file_id'] for face in faces).values())
+        return report
+    
+    while True:
+        faces = db.store.expired_unrecognized(before, batch_size)
+        if not faces:
+            break
+    
+        file_ids = [face['file_id'] for face in faces]
+        face_ids = [face['face_id'] for face in faces]
+    
+        report["bytes_reclaimed"] += sum(file_sizes(file_ids).values())
+        db.delete_files(file_ids)
+        report["faces_expired"] += db.store.delete_unrecognized_ids([face['id'] for face in faces])
+        db.delete_face_history(face_ids, 'unrecognized')
+        db.face_image_cache.discard(face_ids)
+        db.unknown_clusters.remove(face_ids)
+    
+        if len(faces) < batch_size:
+            break
+        time.sleep(pause)
+    
+    return report
+
+def referenced_file_ids(file_ids):
+
+    # Mark: the files of this batch that some record still points at
+    return db.store.referenced_blobs(file_ids)
+
+def collect_garbage(max_batches=0, batch_size=None, pause=None, grace=None, dry_run=False, progress=None):
+
+    batch_size = batch_size or config.GC_BATCH_SIZE
+    pause = config.GC_BATCH_PAUSE if pause is None else pause
+    grace = config.GC_GRACE if grace is None else grace
+    
+    # Files are written before the record that references them, so recent
+    # files are left alone. Blob creation times are UTC
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    state = db.store.get_state('gc') or {}
+    cursor = state.get('files_cursor')
+    
+    report = {
+        "files_scanned": 0,
+        "files_deleted": 0,
+        "bytes_reclaimed": 0,
+        "orphan_chunks_deleted": 0,
+        "completed_cycle": False
+    }
+    batches = 0
+    
+    while not max_batches or batches < max_batches:
+        files = db.store.blob_page(cursor, batch_size)
+    
+        if not files:
+            # Reached the end: sweep backend leftovers, then start over next time
+            report["orphan_chunks_deleted"] = db.store.collect_orphan_data(batch_size, pause, grace, dry_run)
+            report["completed_cycle"] = True
+            cursor = None
+            break
+    
+        file_ids = [file_doc['file_id'] for file_doc in files]
+        referenced = referenced_file_ids(file_ids)
+        orphans = [
+            file_doc for file_doc in files
+            if file_doc['file_id'] not in referenced and (file_doc['created_at'] or cutoff) <= cutoff
+        ]
+    
+        if orphans and not dry_run:
+            db.delete_files([file_doc['file_id'] for file_doc in orphans])
+    
+        report["files_scanned"] += len(files)
+        report["files_deleted"] += len(orphans)
+        report["bytes_reclaimed"] += sum(file_doc['length'] for file_doc in orphans)
+        cursor = file_ids[-1]
+        batches += 1
+    
+        if not dry_run:
+            db.store.set_state('gc', {'files_cursor': cursor})
+        if progress:
+            progress(report["files_scanned"])
+    
+        time.sleep(pause)
+    
+    if not dry_run:
+        db.store.set_state('gc', {'files_cursor': cursor})
+    
+    return report
+
+def prune_gallery_changes(ttl=None, dry_run=False):
+
+    # Processes further behind than the log reaches reload the whole gallery
+    ttl = config.GALLERY_CHANGES_TTL if ttl is None else ttl
+    if ttl <= 0 or dry_run:
+        return 0
+    
+    return db.store.prune_gallery_changes(datetime.now() - timedelta(seconds=ttl))
+
+def run_retention(dry_run=False, max_batches=0, progress=None):
+
+    report = expire_unrecognized_faces(dry_run=dry_run)
+    garbage = collect_garbage(max_batches=max_batches, dry_run=dry_run, progress=progress)
+    report["faces_bytes_reclaimed"] = report.pop("bytes_reclaimed")
+    report.update(garbage)
+    report["bytes_reclaimed"] = report["faces_bytes_reclaimed"] + garbage["bytes_reclaimed"]
+    report["gallery_changes_pruned"] = prune_gallery_changes(dry_run=dry_run)
+    report["dry_run"] = dry_run
+    
+    logger.info("Retention: %d unrecognized faces expired, %d orphaned files deleted, %d bytes reclaimed",
+                report['faces_expired'], report['files_deleted'], report['bytes_reclaimed'])
+    
+    return report
+
+def submit_retention_job(dry_run=False, max_batches=0):
+
+    return jobs.submit('retention', lambda progress: run_retention(dry_run, max_batches, progress))
+
+_scheduler = None
+
+def start_retention_scheduler(interval=None):
+
+    # Queue a retention job every interval seconds on the maintenance job runner
+    global _scheduler
+    
+    interval = config.RETENTION_INTERVAL if interval is None else interval
+    if interval <= 0 or _scheduler is not None:
+        return None
+    
+    def schedule():
+        while True:
+            time.sleep(interval)
+            # Skip a round while the previous run is still going
+            if not any(job.kind == 'retention' and job.finished_at is None for job in jobs.list()):
+                submit_retention_job()
+    
+    _scheduler = threading.Thread(target=schedule, name="retention-scheduler", daemon=True)
+    _scheduler.start()
+    return _scheduler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Expire old unrecognized faces and delete orphaned GridFS files")
+    parser.add_argument('--dry-run', action='store_true', help="only report what would be deleted")
+    parser.add_argument('--max-batches', type=int, default=0, help="stop the file sweep after this many batches")
+    args = parser.parse_args()
+    
+    db.ensure_indexes()
+    print(run_retention(dry_run=args.dry_run, max_batches=args.max_batches))
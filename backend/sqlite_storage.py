@@ -0,0 +1,799 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import shutil
+import tempfile
+import threading
+import numpy as np
+from datetime import datetime
+from storage import Storage, prefix_upper_bound
+
+logger = logging.getLogger(__name__)
+
+# Embedded storage for edge boxes and tests: one SQLite database plus a
+# content-addressed image directory. A blob's id is the SHA-256 of its bytes
+# and it lives at <blob_dir>/<id[:2]>/<id>, so identical images are stored
+# once; the blobs table counts the references and a blob is removed with its
+# last one. All access goes through one connection guarded by a lock.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS persons (
+    name TEXT PRIMARY KEY,
+    face_count INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS faces (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    face_id TEXT NOT NULL UNIQUE,
+    person_name TEXT NOT NULL,
+    file_id TEXT,
+    encoding BLOB NOT NULL,
+    image_hash TEXT,
+    phash INTEGER,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS faces_person_name ON faces (person_name);
+CREATE INDEX IF NOT EXISTS faces_file_id ON faces (file_id);
+CREATE TABLE IF NOT EXISTS unrecognized (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    face_id TEXT NOT NULL,
+    file_id TEXT,
+    encoding BLOB NOT NULL,
+    image_hash TEXT,
+    phash INTEGER,
+    recognized INTEGER NOT NULL DEFAULT 0,
+    person_name TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS unrecognized_face_id ON unrecognized (face_id);
+CREATE INDEX IF NOT EXISTS unrecognized_file_id ON unrecognized (file_id);
+CREATE INDEX IF NOT EXISTS unrecognized_recognized_timestamp ON unrecognized (recognized, timestamp);
+CREATE INDEX IF NOT EXISTS unrecognized_recognized_id ON unrecognized (recognized, id);
+CREATE TABLE IF NOT EXISTS blobs (
+    id TEXT PRIMARY KEY,
+    length INTEGER NOT NULL,
+    image_hash TEXT,
+    phash INTEGER,
+    refs INTEGER NOT NULL DEFAULT 1,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    type TEXT NOT NULL,
+    face_id TEXT,
+    person_name TEXT,
+    timestamp TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_type_id ON history (type, id);
+CREATE INDEX IF NOT EXISTS history_face_id ON history (face_id);
+CREATE INDEX IF NOT EXISTS history_person_name ON history (person_name);
+CREATE TABLE IF NOT EXISTS gallery_changes (
+    generation INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    person_name TEXT,
+    face_id TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS gallery_changes_timestamp ON gallery_changes (timestamp);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Most variables per statement in older SQLite builds
+MAX_VARIABLES = 999
+
+def _placeholders(values):
+
+    return ','.join('?' * len(values))
+
+def _chunks(values, size=MAX_VARIABLES - 10):
+
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _encoding_bytes(face_encoding):
+
+    return np.asarray(face_encoding, dtype=np.float32).tobytes()
+
+def _timestamp(value):
+
+    return value.isoformat() if value else None
+
+def _datetime(value):
+
+    return datetime.fromisoformat(value) if value else None
+
+class SQLiteStorage(Storage):
+
+    def __init__(self, path, blob_dir):
+        self.path = path
+        self.blob_dir = blob_dir
+        self._lock = threading.RLock()
+        self._connect()
+
+    def _connect(self):
+        if self.path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params)
+
+    def _transaction(self, statements):
+        # statements: (sql, params) pairs run atomically; returns the cursors
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                cursors = [self._connection.execute(sql, params) for sql, params in statements]
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+        return cursors
+
+    def ensure_schema(self):
+
+        with self._lock:
+            self._connection.executescript(SCHEMA)
+            # Duplicate checks are a single lookup on (person_name, image_hash),
+            # and the index keeps one face per image and person
+            try:
+                self._connection.execute(
+                    'CREATE UNIQUE INDEX IF NOT EXISTS faces_person_image_hash_unique ON faces (person_name, image_hash)'
+                )
+            except sqlite3.IntegrityError:
+                logger.error("Persons have the same image stored twice; run migrate_faces.py to remove the copies "
+                             "and enforce one face per image and person")
+                self._connection.execute(
+                    'CREATE INDEX IF NOT EXISTS faces_person_image_hash ON faces (person_name, image_hash)'
+                )
+            else:
+                # Non-unique index of earlier versions
+                self._connection.execute('DROP INDEX IF EXISTS faces_person_image_hash')
+
+    def drop(self):
+
+        with self._lock:
+            self._connection.close()
+            if self.path != ':memory:':
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(self.path + suffix):
+                        os.remove(self.path + suffix)
+            shutil.rmtree(self.blob_dir, ignore_errors=True)
+            self._connect()
+
+    def person_exists(self, person_name):
+
+        return bool(self._query('SELECT 1 FROM persons WHERE name = ?', (person_name,)))
+
+    def person_names(self):
+
+        return [row['name'] for row in self._query('SELECT name FROM persons ORDER BY rowid')]
+
+    def _name_conditions(self, prefix=None, cursor=None):
+
+        # A range on the primary key index of persons
+        conditions, params = [], []
+        if prefix:
+            conditions.append('name >= ?')
+            params.append(prefix)
+            bound = prefix_upper_bound(prefix)
+            if bound is not None:
+                conditions.append('name < ?')
+                params.append(bound)
+        if cursor is not None:
+            conditions.append('name > ?')
+            params.append(cursor)
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+    def person_page(self, prefix=None, cursor=None, limit=100):
+
+        where, params = self._name_conditions(prefix, cursor)
+        rows = self._query(f'SELECT name, face_count FROM persons{where} ORDER BY name LIMIT ?', params + [limit])
+        return [{'name': row['name'], 'face_count': row['face_count']} for row in rows]
+
+    def count_persons(self, prefix=None):
+
+        where, params = self._name_conditions(prefix)
+        return self._query(f'SELECT COUNT(*) AS count FROM persons{where}', params)[0]['count']
+
+    def add_faces(self, faces):
+
+        now = _timestamp(datetime.now())
+        duplicates = {}
+        counts = {}
+
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                for face in faces:
+                    # Ignored when the unique index already has the person's image
+                    inserted = self._connection.execute(
+                        'INSERT OR IGNORE INTO faces (face_id, person_name, file_id, encoding, image_hash, phash, created_at) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (face['face_id'], face['person_name'], face['file_id'], _encoding_bytes(face['encoding']),
+                         face['image_hash'], face['phash'], _timestamp(face.get('created_at')) or now)
+                    ).rowcount
+                    if inserted:
+                        counts[face['person_name']] = counts.get(face['person_name'], 0) + 1
+                    else:
+                        duplicates[face['face_id']] = self.find_face_by_hash(face['person_name'], face['image_hash'])
+
+                # Create each person on their first face
+                for person_name, count in counts.items():
+                    self._connection.execute(
+                        'INSERT INTO persons (name, face_count, created_at) VALUES (?, ?, ?) '
+                        'ON CONFLICT (name) DO UPDATE SET face_count = face_count + excluded.face_count',
+                        (person_name, count, now)
+                    )
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+
+        return duplicates
+
+    def duplicate_faces(self):
+
+        rows = self._query(
+            'SELECT person_name, face_id FROM faces AS face WHERE image_hash IS NOT NULL AND EXISTS ('
+            'SELECT 1 FROM faces AS earlier WHERE earlier.person_name = face.person_name '
+            'AND earlier.image_hash = face.image_hash AND earlier.seq < face.seq) ORDER BY seq'
+        )
+        return [(row['person_name'], row['face_id']) for row in rows]
+
+    def has_face(self, person_name, face_id):
+
+        return bool(self._query('SELECT 1 FROM faces WHERE person_name = ? AND face_id = ?', (person_name, face_id)))
+
+    def person_face_ids(self, person_name):
+
+        rows = self._query('SELECT face_id FROM faces WHERE person_name = ? ORDER BY seq DESC', (person_name,))
+        return [row['face_id'] for row in rows]
+
+    def iter_faces(self, person_name=None, face_ids=None):
+
+        if face_ids is not None:
+            for chunk in _chunks(face_ids):
+                rows = self._query(
+                    f'SELECT person_name, face_id, encoding FROM faces WHERE face_id IN ({_placeholders(chunk)})'
+                    + (' AND person_name = ?' if person_name is not None else ''),
+                    chunk + ([person_name] if person_name is not None else [])
+                )
+                for row in rows:
+                    yield row['person_name'], row['face_id'], np.frombuffer(row['encoding'], dtype=np.float32)
+            return
+
+        # Page through by seq so the lock is not held while the caller consumes rows
+        after = 0
+        while True:
+            rows = self._query(
+                'SELECT seq, person_name, face_id, encoding FROM faces WHERE seq > ?'
+                + (' AND person_name = ?' if person_name is not None else '')
+                + ' ORDER BY seq LIMIT ?',
+                (after,) + ((person_name,) if person_name is not None else ()) + (self.batch_size,)
+            )
+            for row in rows:
+                yield row['person_name'], row['face_id'], np.frombuffer(row['encoding'], dtype=np.float32)
+            if len(rows) < self.batch_size:
+                break
+            after = rows[-1]['seq']
+
+    def face_ids(self):
+
+        return {row['face_id'] for row in self._query('SELECT face_id FROM faces')}
+
+    def face_file_ids(self):
+
+        return [row['file_id'] for row in self._query('SELECT file_id FROM faces')]
+
+    def find_face_by_hash(self, person_name, img_hash):
+
+        rows = self._query(
+            'SELECT face_id FROM faces WHERE person_name = ? AND image_hash = ? LIMIT 1', (person_name, img_hash)
+        )
+        return rows[0]['face_id'] if rows else None
+
+    def find_faces_by_hashes(self, person_name, img_hashes):
+
+        face_ids = {}
+        for chunk in _chunks(img_hashes):
+            rows = self._query(
+                f'SELECT image_hash, face_id FROM faces WHERE person_name = ? AND image_hash IN ({_placeholders(chunk)})',
+                [person_name] + chunk
+            )
+            face_ids.update((row['image_hash'], row['face_id']) for row in rows)
+        return face_ids
+
+    def face_phashes(self, person_name, face_ids):
+
+        phashes = {}
+        for chunk in _chunks(face_ids):
+            rows = self._query(
+                f'SELECT face_id, phash FROM faces WHERE person_name = ? AND face_id IN ({_placeholders(chunk)})',
+                [person_name] + chunk
+            )
+            phashes.update((row['face_id'], row['phash']) for row in rows)
+        return phashes
+
+    def delete_face(self, person_name, face_id):
+
+        with self._lock:
+            rows = self._query(
+                'SELECT face_id, file_id FROM faces WHERE person_name = ? AND face_id = ?', (person_name, face_id)
+            )
+            if not rows:
+                return None
+            self._transaction([
+                ('DELETE FROM faces WHERE face_id = ?', (face_id,)),
+                ('UPDATE persons SET face_count = face_count - 1 WHERE name = ?', (person_name,)),
+            ])
+        return dict(rows[0])
+
+    def delete_person(self, person_name):
+
+        with self._lock:
+            if not self.person_exists(person_name):
+                return None
+            faces = [dict(row) for row in self._query(
+                'SELECT face_id, file_id FROM faces WHERE person_name = ?', (person_name,)
+            )]
+            self._transaction([
+                ('DELETE FROM persons WHERE name = ?', (person_name,)),
+                ('DELETE FROM faces WHERE person_name = ?', (person_name,)),
+            ])
+        return faces
+
+    def delete_all_persons(self):
+
+        cursor, _ = self._transaction([('DELETE FROM persons', ()), ('DELETE FROM faces', ())])
+        return cursor.rowcount
+
+    def _unrecognized_record(self, row):
+
+        record = dict(row)
+        record['id'] = str(record['id'])
+        record['encoding'] = np.frombuffer(record['encoding'], dtype=np.float32)
+        record['recognized'] = bool(record['recognized'])
+        record['timestamp'] = _datetime(record['timestamp'])
+        return record
+
+    def add_unrecognized(self, faces):
+
+        now = _timestamp(datetime.now())
+        self._transaction([
+            ('INSERT INTO unrecognized (face_id, file_id, encoding, image_hash, phash, recognized, timestamp) '
+             'VALUES (?, ?, ?, ?, ?, 0, ?)',
+             (face['face_id'], face['file_id'], _encoding_bytes(face['encoding']), face['image_hash'],
+              face['phash'], now))
+            for face in faces
+        ])
+        self._unrecognized_changed(len(faces))
+        return True
+
+    def _unrecognized_changed(self, changes):
+
+        # One step per face added, named, put back or deleted, after the
+        # change itself, so the version never runs ahead of the listing
+        if changes:
+            self._execute(
+                "INSERT INTO counters (name, value) VALUES ('unrecognized_version', ?) "
+                'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                (changes,)
+            )
+
+    def get_unrecognized(self, face_id):
+
+        rows = self._query('SELECT * FROM unrecognized WHERE face_id = ? AND recognized = 0 LIMIT 1', (face_id,))
+        return self._unrecognized_record(rows[0]) if rows else None
+
+    def get_unrecognized_many(self, face_ids):
+
+        records = []
+        for chunk in _chunks(face_ids):
+            rows = self._query(
+                f'SELECT * FROM unrecognized WHERE recognized = 0 AND face_id IN ({_placeholders(chunk)})', chunk
+            )
+            records.extend(self._unrecognized_record(row) for row in rows)
+        return records
+
+    def iter_unrecognized(self, after=None):
+
+        after = int(after) if after else 0
+        while True:
+            rows = self._query(
+                'SELECT id, face_id, encoding FROM unrecognized WHERE recognized = 0 AND id > ? ORDER BY id LIMIT ?',
+                (after, self.batch_size)
+            )
+            for row in rows:
+                yield row['face_id'], np.frombuffer(row['encoding'], dtype=np.float32)
+            if len(rows) < self.batch_size:
+                return
+            after = rows[-1]['id']
+
+    def unrecognized_ids(self):
+
+        return [str(row['id']) for row in self._query('SELECT id FROM unrecognized WHERE recognized = 0 ORDER BY id')]
+
+    def unrecognized_page(self, cursor=None, limit=100):
+
+        if cursor:
+            rows = self._query(
+                'SELECT id, face_id, timestamp FROM unrecognized WHERE recognized = 0 AND id < ? ORDER BY id DESC LIMIT ?',
+                (int(cursor), limit)
+            )
+        else:
+            rows = self._query(
+                'SELECT id, face_id, timestamp FROM unrecognized WHERE recognized = 0 ORDER BY id DESC LIMIT ?', (limit,)
+            )
+
+        return [{'id': str(row['id']), 'face_id': row['face_id'], 'timestamp': _datetime(row['timestamp'])} for row in rows]
+
+    def unrecognized_state(self):
+
+        row = self._query(
+            "SELECT COUNT(*) AS count, MAX(id) AS newest, "
+            "(SELECT value FROM counters WHERE name = 'unrecognized_version') AS version "
+            'FROM unrecognized WHERE recognized = 0'
+        )[0]
+        return row['count'], str(row['newest']) if row['newest'] is not None else None, row['version'] or 0
+
+    def mark_recognized(self, face_id, person_name):
+
+        changed = self._execute(
+            'UPDATE unrecognized SET recognized = 1, person_name = ? WHERE face_id = ?', (person_name, face_id)
+        ).rowcount
+        self._unrecognized_changed(changed)
+        return True
+
+    def mark_recognized_many(self, face_ids, person_name):
+
+        changed = 0
+        for chunk in _chunks(face_ids):
+            changed += self._execute(
+                f'UPDATE unrecognized SET recognized = 1, person_name = ? WHERE face_id IN ({_placeholders(chunk)})',
+                [person_name] + chunk
+            ).rowcount
+        self._unrecognized_changed(changed)
+        return True
+
+    def unmark_recognized(self, face_ids=None, person_name=None):
+
+        if face_ids is None:
+            changed = self._execute(
+                'UPDATE unrecognized SET recognized = 0, person_name = NULL WHERE recognized = 1'
+                + (' AND person_name = ?' if person_name is not None else ''),
+                (person_name,) if person_name is not None else ()
+            ).rowcount
+            self._unrecognized_changed(changed)
+            return
+
+        changed = 0
+        for chunk in _chunks(face_ids):
+            changed += self._execute(
+                f'UPDATE unrecognized SET recognized = 0, person_name = NULL '
+                f'WHERE recognized = 1 AND face_id IN ({_placeholders(chunk)})'
+                + (' AND person_name = ?' if person_name is not None else ''),
+                chunk + ([person_name] if person_name is not None else [])
+            ).rowcount
+        self._unrecognized_changed(changed)
+
+    def delete_unrecognized(self, face_id):
+
+        with self._lock:
+            rows = self._query(
+                'SELECT id, face_id, file_id FROM unrecognized WHERE face_id = ? AND recognized = 0 LIMIT 1', (face_id,)
+            )
+            if not rows:
+                return None
+            self._execute('DELETE FROM unrecognized WHERE id = ?', (rows[0]['id'],))
+            self._unrecognized_changed(1)
+        return {'face_id': rows[0]['face_id'], 'file_id': rows[0]['file_id']}
+
+    def unrecognized_file_ids(self):
+
+        return [row['file_id'] for row in self._query('SELECT file_id FROM unrecognized WHERE recognized = 0')]
+
+    def delete_all_unrecognized(self):
+
+        deleted = self._execute('DELETE FROM unrecognized WHERE recognized = 0').rowcount
+        self._unrecognized_changed(deleted)
+        return deleted
+
+    def expired_unrecognized(self, before, limit=0):
+
+        rows = self._query(
+            'SELECT id, face_id, file_id FROM unrecognized WHERE recognized = 0 AND timestamp < ? ORDER BY timestamp'
+            + (' LIMIT ?' if limit else ''),
+            (_timestamp(before),) + ((limit,) if limit else ())
+        )
+        return [dict(row) for row in rows]
+
+    def delete_unrecognized_ids(self, ids):
+
+        deleted = 0
+        for chunk in _chunks(ids):
+            deleted += self._execute(f'DELETE FROM unrecognized WHERE id IN ({_placeholders(chunk)})', chunk).rowcount
+        self._unrecognized_changed(deleted)
+        return deleted
+
+    def face_file_id(self, face_id):
+
+        rows = (self._query('SELECT file_id FROM faces WHERE face_id = ?', (face_id,))
+                or self._query('SELECT file_id FROM unrecognized WHERE face_id = ? LIMIT 1', (face_id,)))
+        return rows[0]['file_id'] if rows else None
+
+    def _blob_path(self, file_id):
+
+        return os.path.join(self.blob_dir, file_id[:2], file_id)
+
+    def _write_blob(self, file_id, img_bytes):
+
+        path = self._blob_path(file_id)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file and rename, so a blob is never seen half written
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(img_bytes)
+        os.replace(temp_path, path)
+
+    def put_blob(self, img_bytes, filename, img_hash, phash):
+
+        return self.put_blobs([(img_bytes, filename, img_hash, phash)])[0]
+
+    def put_blobs(self, blobs):
+
+        # Files first, so a blob record never points at missing data
+        file_ids = []
+        for img_bytes, _, _, _ in blobs:
+            file_id = hashlib.sha256(img_bytes).hexdigest()
+            self._write_blob(file_id, img_bytes)
+            file_ids.append(file_id)
+
+        now = _timestamp(datetime.utcnow())
+        self._transaction([
+            ('INSERT INTO blobs (id, length, image_hash, phash, refs, created_at) VALUES (?, ?, ?, ?, 1, ?) '
+             'ON CONFLICT (id) DO UPDATE SET refs = refs + 1',
+             (file_id, len(img_bytes), img_hash, phash, now))
+            for file_id, (img_bytes, _, img_hash, phash) in zip(file_ids, blobs)
+        ])
+
+        return file_ids
+
+    def get_blob(self, file_id):
+
+        rows = self._query('SELECT image_hash FROM blobs WHERE id = ?', (file_id,))
+        if not rows:
+            return None
+
+        try:
+            with open(self._blob_path(file_id), 'rb') as f:
+                return f.read(), rows[0]['image_hash']
+        except FileNotFoundError:
+            return None
+
+    def _blob_column(self, column, file_ids):
+
+        values = {}
+        for chunk in _chunks(file_id for file_id in file_ids if file_id is not None):
+            rows = self._query(f'SELECT id, {column} FROM blobs WHERE id IN ({_placeholders(chunk)})', chunk)
+            values.update((row['id'], row[column]) for row in rows)
+        return values
+
+    def blob_hashes(self, file_ids):
+
+        return self._blob_column('image_hash', file_ids)
+
+    def blob_phashes(self, file_ids):
+
+        return self._blob_column('phash', file_ids)
+
+    def blob_sizes(self, file_ids):
+
+        return self._blob_column('length', file_ids)
+
+    def delete_blobs(self, file_ids, progress=None):
+
+        # Drops one reference per id; a blob goes once nothing references it
+        file_ids = [file_id for file_id in file_ids if file_id is not None]
+        deleted = 0
+
+        for done, chunk in enumerate(_chunks(file_ids, 500)):
+            counts = {}
+            for file_id in chunk:
+                counts[file_id] = counts.get(file_id, 0) + 1
+
+            with self._lock:
+                self._transaction([
+                    ('UPDATE blobs SET refs = refs - ? WHERE id = ?', (count, file_id))
+                    for file_id, count in counts.items()
+                ])
+                unreferenced = [
+                    row['id'] for row in self._query(
+                        f'SELECT id FROM blobs WHERE refs <= 0 AND id IN ({_placeholders(list(counts))})', list(counts)
+                    )
+                ]
+                if unreferenced:
+                    # Record first: a crash in between leaves a stray file, never a broken record
+                    self._execute(f'DELETE FROM blobs WHERE id IN ({_placeholders(unreferenced)})', unreferenced)
+
+            for file_id in unreferenced:
+                try:
+                    os.remove(self._blob_path(file_id))
+                except FileNotFoundError:
+                    pass
+            deleted += len(unreferenced)
+
+            if progress:
+                progress(min(len(file_ids), (done + 1) * 500))
+
+        return deleted
+
+    def blob_page(self, after=None, limit=500):
+
+        rows = self._query(
+            'SELECT id, length, created_at FROM blobs WHERE id > ? ORDER BY id LIMIT ?', (after or '', limit)
+        )
+        return [
+            {'file_id': row['id'], 'length': row['length'], 'created_at': _datetime(row['created_at'])}
+            for row in rows
+        ]
+
+    def referenced_blobs(self, file_ids):
+
+        referenced = set()
+        for chunk in _chunks(file_ids):
+            for table in ('faces', 'unrecognized'):
+                rows = self._query(f'SELECT DISTINCT file_id FROM {table} WHERE file_id IN ({_placeholders(chunk)})', chunk)
+                referenced.update(row['file_id'] for row in rows)
+        return referenced
+
+    def collect_orphan_data(self, batch_size, pause, grace, dry_run=False):
+
+        # Blob files without a record, e.g. written by a put that failed before
+        # its transaction or left by an interrupted delete
+        cutoff = time.time() - grace
+        found = 0
+
+        for prefix in sorted(os.listdir(self.blob_dir)):
+            directory = os.path.join(self.blob_dir, prefix)
+            if not os.path.isdir(directory):
+                continue
+
+            names = sorted(os.listdir(directory))
+            for start in range(0, len(names), batch_size):
+                batch = names[start:start + batch_size]
+                known = self._blob_column('id', batch)
+                for name in batch:
+                    path = os.path.join(directory, name)
+                    if name in known or os.path.getmtime(path) > cutoff:
+                        continue
+                    found += 1
+                    if not dry_run:
+                        os.remove(path)
+                time.sleep(pause)
+
+        return found
+
+    def valid_event_id(self, event_id):
+
+        return str(event_id).isdigit()
+
+    def _event_record(self, row):
+
+        event = json.loads(row['data'])
+        event.update(id=str(row['id']), type=row['type'], timestamp=_datetime(row['timestamp']))
+        return event
+
+    def append_history(self, events):
+
+        statements = []
+        for event in events:
+            payload = {key: value for key, value in event.items() if key not in ('type', 'timestamp')}
+            statements.append((
+                'INSERT INTO history (type, face_id, person_name, timestamp, data) VALUES (?, ?, ?, ?, ?)',
+                (event['type'], event.get('face_id'), event.get('person_name'), _timestamp(event['timestamp']),
+                 json.dumps(payload))
+            ))
+        cursors = self._transaction(statements)
+
+        return [dict(event, id=str(cursor.lastrowid)) for event, cursor in zip(events, cursors)]
+
+    def history_page(self, event_type, cursor=None, limit=50):
+
+        if cursor:
+            rows = self._query(
+                'SELECT * FROM history WHERE type = ? AND id < ? ORDER BY id DESC LIMIT ?', (event_type, int(cursor), limit)
+            )
+        else:
+            rows = self._query('SELECT * FROM history WHERE type = ? ORDER BY id DESC LIMIT ?', (event_type, limit))
+        return [self._event_record(row) for row in rows]
+
+    def delete_history_event(self, event_id):
+
+        return self._execute('DELETE FROM history WHERE id = ?', (int(event_id),)).rowcount > 0
+
+    def delete_history(self, event_type, face_ids=None, person_name=None):
+
+        condition = 'type = ?' + (' AND person_name = ?' if person_name is not None else '')
+        params = [event_type] + ([person_name] if person_name is not None else [])
+
+        if face_ids is None:
+            return self._execute(f'DELETE FROM history WHERE {condition}', params).rowcount
+
+        deleted = 0
+        for chunk in _chunks(face_ids):
+            deleted += self._execute(
+                f'DELETE FROM history WHERE {condition} AND face_id IN ({_placeholders(chunk)})', params + chunk
+            ).rowcount
+        return deleted
+
+    def append_gallery_changes(self, changes):
+
+        timestamp = _timestamp(datetime.now())
+        cursors = self._transaction([
+            ('INSERT INTO gallery_changes (op, person_name, face_id, timestamp) VALUES (?, ?, ?, ?)',
+             (change['op'], change.get('person_name'), change.get('face_id'), timestamp))
+            for change in changes
+        ])
+        return [cursor.lastrowid for cursor in cursors]
+
+    def gallery_changes(self, after, limit=1000):
+
+        rows = self._query(
+            'SELECT * FROM gallery_changes WHERE generation > ? ORDER BY generation LIMIT ?', (after, limit)
+        )
+        return [
+            {'generation': row['generation'], 'op': row['op'], 'person_name': row['person_name'],
+             'face_id': row['face_id'], 'timestamp': _datetime(row['timestamp'])}
+            for row in rows
+        ]
+
+    def gallery_generation(self):
+
+        # AUTOINCREMENT keeps the highest generation even after pruning
+        rows = self._query("SELECT seq FROM sqlite_sequence WHERE name = 'gallery_changes'")
+        return rows[0]['seq'] if rows else 0
+
+    def prune_gallery_changes(self, before):
+
+        return self._execute('DELETE FROM gallery_changes WHERE timestamp < ?', (_timestamp(before),)).rowcount
+
+    def get_state(self, key):
+
+        rows = self._query('SELECT data FROM state WHERE key = ?', (key,))
+        return json.loads(rows[0]['data']) if rows else None
+
+    def set_state(self, key, values):
+
+        with self._lock:
+            state = self.get_state(key) or {}
+            state.update(values)
+            self._execute(
+                'INSERT INTO state (key, data) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET data = excluded.data',
+                (key, json.dumps(state))
+            )
@@ -0,0 +1,275 @@
+import config
+
+# Storage backends. database.py keeps the domain logic (matching, duplicate
+# checks, caches) and reaches persons, faces, unrecognized faces, image blobs,
+# history and maintenance state only through a Storage object, so the same
+# code runs on MongoDB/GridFS or on an embedded SQLite database with images
+# in a content-addressed directory.
+#
+# Records are plain dicts:
+#   face          {'face_id', 'person_name', 'file_id', 'encoding', 'image_hash', 'phash', 'created_at'}
+#   unrecognized  {'id', 'face_id', 'file_id', 'encoding', 'image_hash', 'phash', 'recognized',
+#                  'person_name', 'timestamp'}
+#   event         {'id', 'type', 'timestamp', ...payload}
+# Encodings come back as float32 arrays, ids as the backend's own type (str for
+# event and unrecognized ids), datetimes as naive local time except blob
+# created_at, which is UTC.
+
+def prefix_upper_bound(prefix):
+
+    # Smallest string above every string starting with prefix, so a prefix
+    # search is a range scan of the name index: prefix <= name < bound
+    # (None when there is no such string and the range is open-ended)
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class Storage:
+
+    # Stored face records read per round trip when loading the gallery
+    batch_size = 5000
+
+    # Schema and lifecycle
+    def ensure_schema(self):
+        raise NotImplementedError
+
+    def drop(self):
+        # Delete everything this backend stores
+        raise NotImplementedError
+
+    # Persons and their faces
+    def person_exists(self, person_name):
+        raise NotImplementedError
+
+    def person_names(self):
+        raise NotImplementedError
+
+    def person_page(self, prefix=None, cursor=None, limit=100):
+        # {'name', 'face_count'} of persons whose names start with prefix and
+        # sort after the cursor name, by name
+        raise NotImplementedError
+
+    def count_persons(self, prefix=None):
+        raise NotImplementedError
+
+    def add_faces(self, faces):
+        # Insert face records, creating persons on their first face. A face
+        # whose image the person already has is not stored: the unique
+        # (person_name, image_hash) index catches concurrent uploads the
+        # lookups before the insert cannot. Returns {face_id: face_id of the
+        # stored copy} for those
+        raise NotImplementedError
+
+    def duplicate_faces(self):
+        # (person_name, face_id) of faces repeating an image their person
+        # already had, all but the oldest per (person_name, image_hash)
+        raise NotImplementedError
+
+    def has_face(self, person_name, face_id):
+        raise NotImplementedError
+
+    def person_face_ids(self, person_name):
+        # Newest first
+        raise NotImplementedError
+
+    def iter_faces(self, person_name=None, face_ids=None):
+        # (person_name, face_id, encoding) of every stored face, or of one
+        # person's faces / the given face ids
+        raise NotImplementedError
+
+    def face_ids(self):
+        raise NotImplementedError
+
+    def face_file_ids(self):
+        raise NotImplementedError
+
+    def find_face_by_hash(self, person_name, img_hash):
+        raise NotImplementedError
+
+    def find_faces_by_hashes(self, person_name, img_hashes):
+        # {image_hash: face_id} of the person's faces with any of these images
+        raise NotImplementedError
+
+    def face_phashes(self, person_name, face_ids):
+        # {face_id: phash} of those of the person's faces
+        raise NotImplementedError
+
+    def delete_face(self, person_name, face_id):
+        # The deleted face record (face_id, file_id), None if it did not exist
+        raise NotImplementedError
+
+    def delete_person(self, person_name):
+        # The person's deleted face records, None if there was no such person
+        raise NotImplementedError
+
+    def delete_all_persons(self):
+        # Number of persons deleted, with all their faces
+        raise NotImplementedError
+
+    # Unrecognized faces
+    def add_unrecognized(self, faces):
+        raise NotImplementedError
+
+    def get_unrecognized(self, face_id):
+        # Only faces still waiting to be named
+        raise NotImplementedError
+
+    def get_unrecognized_many(self, face_ids):
+        # Bulk get_unrecognized, in no particular order
+        raise NotImplementedError
+
+    def iter_unrecognized(self, after=None):
+        # (face_id, encoding) of the faces waiting to be named, oldest first;
+        # only those stored after the face with id 'after' when given
+        raise NotImplementedError
+
+    def unrecognized_ids(self):
+        raise NotImplementedError
+
+    def unrecognized_page(self, cursor=None, limit=100):
+        # {'id', 'face_id', 'timestamp'} of the faces waiting to be named that
+        # are older than the cursor id, newest first
+        raise NotImplementedError
+
+    def unrecognized_state(self):
+        # (count, newest id or None, version) of the faces waiting to be
+        # named. The version goes up with every face added, named, put back
+        # or deleted
+        raise NotImplementedError
+
+    def mark_recognized(self, face_id, person_name):
+        raise NotImplementedError
+
+    def mark_recognized_many(self, face_ids, person_name):
+        raise NotImplementedError
+
+    def unmark_recognized(self, face_ids=None, person_name=None):
+        # Put named faces (all of them, or these face ids of person_name) back
+        # on the unrecognized list
+        raise NotImplementedError
+
+    def delete_unrecognized(self, face_id):
+        # The deleted record (face_id, file_id), None if it did not exist
+        raise NotImplementedError
+
+    def unrecognized_file_ids(self):
+        raise NotImplementedError
+
+    def delete_all_unrecognized(self):
+        raise NotImplementedError
+
+    def expired_unrecognized(self, before, limit=0):
+        # Unrecognized faces stored before a local time, as {'id', 'face_id', 'file_id'}
+        raise NotImplementedError
+
+    def delete_unrecognized_ids(self, ids):
+        raise NotImplementedError
+
+    def face_file_id(self, face_id):
+        # File of a person's face or of an unrecognized face, None if gone
+        raise NotImplementedError
+
+    # Image blobs
+    def put_blob(self, img_bytes, filename, img_hash, phash):
+        raise NotImplementedError
+
+    def put_blobs(self, blobs):
+        # Bulk put_blob for (img_bytes, filename, img_hash, phash) tuples, returns the file ids
+        raise NotImplementedError
+
+    def get_blob(self, file_id):
+        # (img_bytes, img_hash), None if the blob is gone
+        raise NotImplementedError
+
+    def blob_hashes(self, file_ids):
+        raise NotImplementedError
+
+    def blob_phashes(self, file_ids):
+        raise NotImplementedError
+
+    def blob_sizes(self, file_ids):
+        raise NotImplementedError
+
+    def delete_blobs(self, file_ids, progress=None):
+        # progress(done) is called as batches are deleted; returns the number removed
+        raise NotImplementedError
+
+    def blob_page(self, after=None, limit=500):
+        # Blobs in id order after a cursor, as {'file_id', 'length', 'created_at'}
+        raise NotImplementedError
+
+    def referenced_blobs(self, file_ids):
+        # Those of the file ids some face or unrecognized face still points at
+        raise NotImplementedError
+
+    def collect_orphan_data(self, batch_size, pause, grace, dry_run=False):
+        # Backend-level leftovers of interrupted deletes (GridFS chunks without a
+        # file, blob files without a record); returns how many were found
+        raise NotImplementedError
+
+    # History events
+    def valid_event_id(self, event_id):
+        raise NotImplementedError
+
+    def append_history(self, events):
+        # Stores events (dicts with a 'type', payload and 'timestamp') in order,
+        # returns them with their ids
+        raise NotImplementedError
+
+    def history_page(self, event_type, cursor=None, limit=50):
+        # Events of a type older than the cursor event, newest first
+        raise NotImplementedError
+
+    def delete_history_event(self, event_id):
+        raise NotImplementedError
+
+    def delete_history(self, event_type, face_ids=None, person_name=None):
+        raise NotImplementedError
+
+    # Gallery change log: one entry per change to the persons' faces,
+    # numbered by a generation counter shared by all processes
+    def append_gallery_changes(self, changes):
+        # Stores changes ({'op', 'person_name', 'face_id'}) in order, returns
+        # their generations
+        raise NotImplementedError
+
+    def gallery_changes(self, after, limit=1000):
+        # Changes with a generation above after, oldest first, as
+        # {'generation', 'op', 'person_name', 'face_id', 'timestamp'}
+        raise NotImplementedError
+
+    def gallery_generation(self):
+        # Latest generation handed out, 0 before the first change
+        raise NotImplementedError
+
+    def prune_gallery_changes(self, before):
+        # Drop changes logged before a local time; returns how many
+        raise NotImplementedError
+
+    # Maintenance state, e.g. the garbage collector's position
+    def get_state(self, key):
+        raise NotImplementedError
+
+    def set_state(self, key, values):
+        raise NotImplementedError
+
+def create_storage(kind=None):
+
+    kind = kind or config.STORAGE
+
+    if kind == 'mongo':
+        from mongo_storage import MongoStorage
+        return MongoStorage(
+            config.MONGO_URI,
+            config.MONGO_DB,
+            max_pool_size=config.MONGO_MAX_POOL_SIZE,
+            min_pool_size=config.MONGO_MIN_POOL_SIZE,
+            timeout_ms=config.MONGO_TIMEOUT_MS,
+            write_concern=config.MONGO_WRITE_CONCERN
+        )
+    if kind == 'sqlite':
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(config.SQLITE_PATH, config.BLOB_DIR)
+
+    raise ValueError(f"Unknown storage backend: {kind}")
@@ -0,0 +1,235 @@
+import time
+import cv2
+import numpy as np
+from collections import deque
+import detection
+
+# Video ingestion. Frames are sampled at sample_fps and the engine detects
+# faces in each sampled frame without encoding them. Detections are linked
+# into tracks by the overlap (IoU) of their box with where each track's box
+# is predicted to be, moving at its last velocity. A track is encoded when it
+# appears and then every encode_interval sampled frames, at most
+# max_encodings times, so a face seen in hundreds of frames costs a few
+# encoder calls instead of one per frame. Tracks not seen for more than
+# max_gap sampled frames are finished and handed to the caller.
+
+# Frame rate assumed when the container does not report one
+DEFAULT_FPS = 25.0
+
+class VideoError(Exception):
+    pass
+
+def box_area(box):
+
+    top, right, bottom, left = box
+    return max(0, right - left) * max(0, bottom - top)
+
+def box_iou(a, b):
+
+    # Boxes as (top, right, bottom, left)
+    intersection = box_area((max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])))
+    if intersection == 0:
+        return 0.0
+    return intersection / float(box_area(a) + box_area(b) - intersection)
+
+def sample_frames(path, sample_fps, max_seconds=0):
+
+    # (timestamp in seconds, RGB frame) of every sampled frame. Skipped frames
+    # are only grabbed, not converted
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise VideoError("Could not open the video")
+
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        if not 0 < fps < 1000:
+            fps = DEFAULT_FPS
+        step = max(1, int(round(fps / sample_fps))) if sample_fps > 0 else 1
+
+        frame_no = 0
+        while True:
+            if max_seconds and frame_no / fps > max_seconds:
+                break
+            if frame_no % step == 0:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield frame_no / fps, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            elif not capture.grab():
+                break
+            frame_no += 1
+    finally:
+        capture.release()
+
+class Track:
+
+    def __init__(self, track_id, box, timestamp, sample_no):
+        self.id = track_id
+        self.box = box
+        self.velocity = (0.0, 0.0, 0.0, 0.0)
+        self.start = timestamp
+        self.end = timestamp
+        self.last_sample = sample_no
+        self.last_encoded = None
+        self.detections = 1
+        # (encode future, index in its result, box, face crop) per encoded detection
+        self._encoded = []
+
+    def predicted_box(self, sample_no):
+
+        steps = sample_no - self.last_sample
+        return tuple(value + change * steps for value, change in zip(self.box, self.velocity))
+
+    def update(self, box, timestamp, sample_no):
+
+        steps = max(1, sample_no - self.last_sample)
+        self.velocity = tuple((new - old) / steps for new, old in zip(box, self.box))
+        self.box = box
+        self.end = timestamp
+        self.last_sample = sample_no
+        self.detections += 1
+
+    def wants_encoding(self, sample_no, max_encodings, encode_interval):
+
+        if len(self._encoded) >= max_encodings:
+            return False
+        return self.last_encoded is None or sample_no - self.last_encoded >= encode_interval
+
+    def add_encoding(self, future, index, box, crop, sample_no):
+
+        self._encoded.append((future, index, box, crop))
+        self.last_encoded = sample_no
+
+    @property
+    def encode_count(self):
+        return len(self._encoded)
+
+    def faces(self, timeout=None):
+
+        # (encoding, box, crop) of the encoded detections, largest face first
+        faces = [
+            (future.result(timeout=timeout)["face_encodings"][index], box, crop)
+            for future, index, box, crop in self._encoded
+        ]
+        return sorted(faces, key=lambda face: box_area(face[1]), reverse=True)
+
+    def mean_encoding(self, faces):
+
+        return np.mean([encoding for encoding, _, _ in faces], axis=0)
+
+def associate(tracks, boxes, sample_no, min_iou):
+
+    # Greedy matching, most overlapping pair first; returns {box index: track}
+    pairs = []
+    for track in tracks:
+        predicted = track.predicted_box(sample_no)
+        for i, box in enumerate(boxes):
+            overlap = box_iou(predicted, box)
+            if overlap >= min_iou:
+                pairs.append((overlap, i, track))
+    pairs.sort(key=lambda pair: pair[0], reverse=True)
+
+    matched = {}
+    taken = set()
+    for _, i, track in pairs:
+        if i in matched or track.id in taken:
+            continue
+        matched[i] = track
+        taken.add(track.id)
+
+    return matched
+
+class FaceTracker:
+
+    def __init__(self, face_engine, min_iou=0.3, max_gap=2, max_encodings=3, encode_interval=4, timeout=None,
+                 progress=None):
+        self.engine = face_engine
+        self.min_iou = min_iou
+        self.max_gap = max_gap
+        self.max_encodings = max(1, max_encodings)
+        self.encode_interval = encode_interval
+        self.timeout = timeout
+        self.progress = progress
+        # Detection of the next frames runs while the current one is tracked
+        self.lookahead = max(1, face_engine.workers)
+        self.frames = 0
+        self.detections = 0
+        self.encoded = 0
+        self.timings = {"decode": 0.0, "detect": 0.0}
+        self._active = []
+        self._next_id = 1
+        self._encode_futures = []
+
+    def run(self, frames):
+
+        # Generator of finished tracks, in the order they end
+        pending = deque()
+        frames = iter(frames)
+        sample_no = 0
+
+        while True:
+            started = time.perf_counter()
+            sampled = next(frames, None)
+            self.timings["decode"] += time.perf_counter() - started
+            if sampled is None:
+                break
+
+            timestamp, frame = sampled
+            future = self.engine.submit(frame, block=True, timeout=self.timeout, encode=False)
+            pending.append((sample_no, timestamp, frame, future))
+            sample_no += 1
+            if len(pending) >= self.lookahead:
+                yield from self._track(*pending.popleft())
+
+        while pending:
+            yield from self._track(*pending.popleft())
+
+        # Whatever is still in view ends with the video
+        finished, self._active = self._active, []
+        yield from finished
+
+    def _track(self, sample_no, timestamp, frame, future):
+        job = future.result(timeout=self.timeout)
+        boxes = job["filtered_face_locations"]
+        self.frames += 1
+        self.detections += len(boxes)
+        self.timings["detect"] += job["timings"]["detect"]
+
+        matched = associate(self._active, boxes, sample_no, self.min_iou)
+        to_encode = []
+        for i, box in enumerate(boxes):
+            track = matched.get(i)
+            if track is None:
+                track = Track(self._next_id, box, timestamp, sample_no)
+                self._next_id += 1
+                self._active.append(track)
+            else:
+                track.update(box, timestamp, sample_no)
+
+            if track.wants_encoding(sample_no, self.max_encodings, self.encode_interval):
+                to_encode.append((track, box))
+
+        # One encoder job for all faces of the frame that need it; the crops
+        # are copied so the frame itself is not kept
+        if to_encode:
+            encode_future = self.engine.submit_encode(frame, [box for _, box in to_encode],
+                                                      block=True, timeout=self.timeout)
+            self._encode_futures.append(encode_future)
+            for index, (track, box) in enumerate(to_encode):
+                track.add_encoding(encode_future, index, box, detection.crop_face(frame, box).copy(), sample_no)
+            self.encoded += len(to_encode)
+
+        if self.progress:
+            self.progress(self.frames)
+
+        finished = [track for track in self._active if sample_no - track.last_sample > self.max_gap]
+        self._active = [track for track in self._active if sample_no - track.last_sample <= self.max_gap]
+        return finished
+
+    def encode_seconds(self):
+
+        # Worker time of the encoder jobs that have finished
+        return sum(
+            future.result()["timings"]["encode"]
+            for future in self._encode_futures if future.done() and future.exception() is None
+        )
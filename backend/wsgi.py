@@ -0,0 +1,12 @@
+import logging
+import config
+from app import create_app
+
+# Entry point for WSGI servers running several worker processes, e.g.
+#   FACE_MATCH_INDEX=snapshot gunicorn -w 4 --threads 4 wsgi:app
+# Each worker builds its own application (do not preload it in the master
+# process: the job threads and detection workers must start after the fork)
+
+logging.basicConfig(level=config.LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+app = create_app()
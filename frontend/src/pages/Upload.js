@@ -5,6 +5,60 @@ import '../styles/Upload.css';
 
 const API_URL = 'http://localhost:5000/api';
 
+// History events fetched per page
+const HISTORY_PAGE_SIZE = 20;
+const PERSONS_PAGE_SIZE = 200;
+const PERSONS_LIST_PAGE_SIZE = 1000;
+
+// History events reference stored faces by id; images are fetched by URL
+const faceImageUrl = (faceId) => `${API_URL}/face/${faceId}/image`;
+
+const formatTimestamp = (timestamp) => new Date(timestamp).toLocaleString();
+
+// Convert an upload event into an item of the upload history sidebar
+const uploadItemFromEvent = (event) => ({
+  id: event.id,
+  image: event.faces.length > 0 ? faceImageUrl(event.faces[0].face_id) : null,
+  timestamp: formatTimestamp(event.timestamp),
+  results: event.faces
+});
+
+// Convert an unrecognized event into an item of the unrecognized tab
+const unrecognizedFromEvent = (event) => ({
+  id: event.face_id,
+  image: faceImageUrl(event.face_id),
+  timestamp: formatTimestamp(event.timestamp),
+  facePosition: event.face_position || null
+});
+
+// Fold recognized events (newest first) into the persons list, newest images first
+const addRecognizedEvents = (persons, events) => {
+  const updatedPersons = persons.map(person => ({ ...person, images: [...person.images] }));
+  
+  [...events].reverse().forEach(event => {
+    let person = updatedPersons.find(p => p.name === event.person_name);
+    
+    if (!person) {
+      person = { name: event.person_name, images: [] };
+      updatedPersons.push(person);
+    }
+    
+    if (!person.images.some(img => img.id === event.face_id)) {
+      person.images = [
+        {
+          id: event.face_id,
+          image: faceImageUrl(event.face_id),
+          confidence: event.confidence,
+          timestamp: formatTimestamp(event.timestamp)
+        },
+        ...person.images
+      ];
+    }
+  });
+  
+  return updatedPersons;
+};
+
 // Helper function to deduplicate unrecognized faces
 const deduplicateUnrecognizedFaces = (faces) => {
   const uniqueImages = new Map();
@@ -28,6 +82,7 @@ const Upload = () => {
   
   // State for persons and image history
   const [imageHistory, setImageHistory] = useState([]);
+  const [historyCursor, setHistoryCursor] = useState(null);
   const [recognizedPersons, setRecognizedPersons] = useState([]);
   const [unrecognizedPersons, setUnrecognizedPersons] = useState([]);
   const [allPersons, setAllPersons] = useState([]);
@@ -46,53 +101,79 @@ const Upload = () => {
   // State to track if data is being loaded initially
   const [initialLoad, setInitialLoad] = useState(true);
   
-  // Fetch persons callback function to avoid recreating on each render
+  // Fetch persons callback function to avoid recreating on each render.
+  // Pages are revalidated with their ETag, so a refetch after an action that
+  // did not change the persons is answered with 304 and no body
   const fetchPersons = useCallback(async () => {
     try {
-      const response = await axios.get(`${API_URL}/persons`);
-      setAllPersons(response.data.persons);
+      const names = [];
+      let cursor = null;
+      do {
+        const response = await axios.get(`${API_URL}/persons/page`, {
+          params: { limit: PERSONS_LIST_PAGE_SIZE, ...(cursor ? { cursor } : {}) }
+        });
+        names.push(...response.data.persons.map(person => person.name));
+        cursor = response.data.next_cursor;
+      } while (cursor);
+      setAllPersons(names);
     } catch (error) {
       console.error('Error fetching persons:', error);
     }
   }, []);
   
-  // Fetch history data from backend
+  // Fetch the first page of each history list from backend
   const fetchHistoryFromBackend = useCallback(async () => {
     try {
-      const response = await axios.get(`${API_URL}/history`);
-      if (response.data) {
-        // Update state with data from backend
-        if (response.data.image_history?.length > 0) {
-          setImageHistory(response.data.image_history);
-        }
-        
-        if (response.data.recognized_persons?.length > 0) {
-          setRecognizedPersons(response.data.recognized_persons);
-        }
-        
-        if (response.data.unrecognized_persons?.length > 0) {
-          // Deduplicate unrecognized persons before setting state
-          const deduplicated = deduplicateUnrecognizedFaces(response.data.unrecognized_persons);
-          setUnrecognizedPersons(deduplicated);
-        }
-      }
+      const [uploads, recognized, unrecognized] = await Promise.all([
+        axios.get(`${API_URL}/history`, { params: { type: 'upload', limit: HISTORY_PAGE_SIZE } }),
+        axios.get(`${API_URL}/history`, { params: { type: 'recognized', limit: PERSONS_PAGE_SIZE } }),
+        axios.get(`${API_URL}/history`, { params: { type: 'unrecognized', limit: PERSONS_PAGE_SIZE } })
+      ]);
+      
+      setImageHistory(uploads.data.events.map(uploadItemFromEvent));
+      setHistoryCursor(uploads.data.next_cursor);
+      setRecognizedPersons(addRecognizedEvents([], recognized.data.events));
+      setUnrecognizedPersons(deduplicateUnrecognizedFaces(unrecognized.data.events.map(unrecognizedFromEvent)));
     } catch (error) {
       console.error('Error fetching history from backend:', error);
     }
   }, []);
   
-  // Save history data to backend
-  const saveHistoryToBackend = useCallback(async () => {
+  // Fetch the next page of upload history
+  const loadMoreHistory = async () => {
+    if (!historyCursor) return;
+    
     try {
-      await axios.post(`${API_URL}/history`, {
-        image_history: imageHistory,
-        recognized_persons: recognizedPersons,
-        unrecognized_persons: unrecognizedPersons
+      const response = await axios.get(`${API_URL}/history`, {
+        params: { type: 'upload', cursor: historyCursor, limit: HISTORY_PAGE_SIZE }
       });
+      
+      setImageHistory(prev => [...prev, ...response.data.events.map(uploadItemFromEvent)]);
+      setHistoryCursor(response.data.next_cursor);
     } catch (error) {
-      console.error('Error saving history to backend:', error);
+      console.error('Error fetching more history:', error);
+    }
+  };
+  
+  // Apply history events recorded by the backend (oldest first) to the sidebars
+  const applyHistoryEvents = useCallback((events = []) => {
+    const newestFirst = [...events].reverse();
+    const uploads = newestFirst.filter(event => event.type === 'upload').map(uploadItemFromEvent);
+    const recognized = newestFirst.filter(event => event.type === 'recognized');
+    const unrecognized = newestFirst.filter(event => event.type === 'unrecognized').map(unrecognizedFromEvent);
+    
+    if (uploads.length > 0) {
+      setImageHistory(prev => [...uploads, ...prev]);
+    }
+    
+    if (recognized.length > 0) {
+      setRecognizedPersons(prev => addRecognizedEvents(prev, recognized));
+    }
+    
+    if (unrecognized.length > 0) {
+      setUnrecognizedPersons(prev => deduplicateUnrecognizedFaces([...unrecognized, ...prev]));
     }
-  }, [imageHistory, recognizedPersons, unrecognizedPersons]);
+  }, []);
 
   // Load data from localStorage on mount
   useEffect(() => {
@@ -169,18 +250,18 @@ const Upload = () => {
     };
   }, [fetchHistoryFromBackend, fetchPersons]);
 
-  // Save to localStorage and backend when data changes
+  // Cache the lists in localStorage for quick display on the next load.
+  // The backend records history itself as images and faces are processed
   useEffect(() => {
     // Don't save during initial load
     if (initialLoad) return;
     
     try {
       localStorage.setItem('imageHistory', JSON.stringify(imageHistory));
-      saveHistoryToBackend();
     } catch (error) {
       console.error('Error saving image history:', error);
     }
-  }, [imageHistory, initialLoad, saveHistoryToBackend]);
+  }, [imageHistory, initialLoad]);
   
   useEffect(() => {
     // Don't save during initial load
@@ -188,11 +269,10 @@ const Upload = () => {
     
     try {
       localStorage.setItem('recognizedPersons', JSON.stringify(recognizedPersons));
-      saveHistoryToBackend();
     } catch (error) {
       console.error('Error saving recognized persons:', error);
     }
-  }, [recognizedPersons, initialLoad, saveHistoryToBackend]);
+  }, [recognizedPersons, initialLoad]);
   
   useEffect(() => {
     // Don't save during initial load
@@ -200,11 +280,10 @@ const Upload = () => {
     
     try {
       localStorage.setItem('unrecognizedPersons', JSON.stringify(unrecognizedPersons));
-      saveHistoryToBackend();
     } catch (error) {
       console.error('Error saving unrecognized persons:', error);
     }
-  }, [unrecognizedPersons, initialLoad, saveHistoryToBackend]);
+  }, [unrecognizedPersons, initialLoad]);
 
   const handleChange = (e) => {
     const file = e.target.files[0];
@@ -237,6 +316,26 @@ const Upload = () => {
     }
   };
 
+  // Follow an upload job's events, showing each face as soon as it is stored.
+  // Resolves with the rest of the upload response once the job is done
+  const followUploadJob = (jobId) => new Promise((resolve, reject) => {
+    const source = new EventSource(`${API_URL}/jobs/${jobId}/events`);
+    
+    source.addEventListener('face', (e) => {
+      const face = JSON.parse(e.data);
+      setResults(prev => [...prev, face]);
+    });
+    source.addEventListener('done', (e) => {
+      source.close();
+      resolve(JSON.parse(e.data));
+    });
+    source.addEventListener('error', (e) => {
+      source.close();
+      // Failed jobs send an error event with a message, lost connections do not
+      reject(new Error(e.data ? JSON.parse(e.data).error : 'Lost connection while processing the image'));
+    });
+  });
+
   const handleUpload = async () => {
     if (!image) return;
     
@@ -249,102 +348,19 @@ const Upload = () => {
     formData.append('image', image);
 
     try {
-      const response = await axios.post(`${API_URL}/upload`, formData);
+      // Process the image as a job and ask for image links instead of inline base64 crops
+      const response = await axios.post(`${API_URL}/upload`, formData, { params: { images: 'url', async: 1 } });
+      const upload = await followUploadJob(response.data.job.id);
       
-      if (response.data.message) {
-        setMessage(response.data.message);
+      if (upload.message) {
+        setMessage(upload.message);
       }
       
-      if (response.data.results && response.data.results.length > 0) {
-        setResults(response.data.results);
-        
-        // Add to image history
-        const timestamp = new Date().toLocaleString();
-        const newHistoryItem = {
-          id: Date.now(),
-          image: preview,
-          timestamp,
-          results: response.data.results
-        };
-        
-        setImageHistory(prev => [newHistoryItem, ...prev].slice(0, 20)); // Keep max 20 items
-        
-        // Update recognized persons
-        const newPersons = [...recognizedPersons];
-        const newUnrecognized = [];
-        
-        response.data.results.forEach(result => {
-          if (result.name !== 'Person not found' && result.confidence > 0) {
-            // Check if person already exists in the list
-            const existingIndex = newPersons.findIndex(p => p.name === result.name);
-            
-            if (existingIndex === -1) {
-              // Add new person
-              newPersons.push({
-                name: result.name,
-                images: [{ 
-                  id: result.id,
-                  image: result.face_image,
-                  confidence: result.confidence,
-                  timestamp 
-                }]
-              });
-            } else {
-              // Check if this exact image already exists for this person (by comparing base64)
-              const isDuplicate = newPersons[existingIndex].images.some(
-                img => img.image === result.face_image
-              );
-              
-              // Only add face if it's not a duplicate
-              if (!isDuplicate) {
-                // Add face to existing person
-                newPersons[existingIndex].images = [
-                  { 
-                    id: result.id,
-                    image: result.face_image,
-                    confidence: result.confidence,
-                    timestamp 
-                  },
-                  ...newPersons[existingIndex].images
-                ].slice(0, 20); // Keep max 20 images per person
-              }
-            }
-          } else if (result.name === 'Person not found') {
-            // Add to unrecognized persons
-            newUnrecognized.push({
-              id: result.id,
-              image: result.face_image,
-              timestamp,
-              facePosition: result.face_position || null
-            });
-          }
-        });
-        
-        setRecognizedPersons(newPersons);
-        
-        // Deduplicate unrecognized faces by checking image data
-        setUnrecognizedPersons(prev => {
-          const combinedUnrecognized = [...newUnrecognized, ...prev];
-          
-          // Use a map to track unique images
-          const uniqueImages = new Map();
-          
-          // Filter out duplicates based on image data
-          const deduplicatedUnrecognized = combinedUnrecognized.filter(face => {
-            // If we haven't seen this image before, keep it
-            if (!uniqueImages.has(face.image)) {
-              uniqueImages.set(face.image, true);
-              return true;
-            }
-            return false;
-          });
-          
-          return deduplicatedUnrecognized.slice(0, 50); // Keep max 50 items
-        });
-        
-        // Refresh persons list
-        fetchPersons();
-      }
+      // Add the upload and its faces to the history sidebars
+      applyHistoryEvents(upload.history);
+      
+      // Refresh persons list
+      fetchPersons();
     } catch (error) {
       console.error('Error:', error);
       setError(error.response?.data?.error || error.message || 'An error occurred');
@@ -364,19 +380,28 @@ const Upload = () => {
       confirmButtonColor: '#7b47e5',
       cancelButtonColor: '#d33',
       confirmButtonText: 'Yes, delete it!'
-    }).then((result) => {
+    }).then(async (result) => {
       if (result.isConfirmed) {
-        // Remove from state
-        setImageHistory(prev => prev.filter(item => item.id !== id));
-        
-        // Update backend
-        saveHistoryToBackend();
-        
-        Swal.fire(
-          'Deleted!',
-          'The image has been deleted.',
-          'success'
-        );
+        try {
+          // Delete the history event on the backend
+          await axios.post(`${API_URL}/history/delete`, { id });
+          
+          // Remove from state
+          setImageHistory(prev => prev.filter(item => item.id !== id));
+          
+          Swal.fire(
+            'Deleted!',
+            'The image has been deleted.',
+            'success'
+          );
+        } catch (error) {
+          console.error('Error deleting history item:', error);
+          Swal.fire(
+            'Error!',
+            'Failed to delete history item.',
+            'error'
+          );
+        }
       }
     });
   };
@@ -537,56 +562,10 @@ const Upload = () => {
       setUnrecognizedPersons(deduplicateUnrecognizedFaces(updatedUnrecognized));
       
       // Check if it was a duplicate
-      const isDuplicate = response.data.is_duplicate;
+      const isDuplicate = response.data.suppressed;
       
-      if (!isDuplicate) {
-        // Add to recognized persons immediately (only if not a duplicate)
-        const timestamp = new Date().toLocaleString();
-        const newPerson = {
-          name: newPersonName.trim(),
-          images: [
-            {
-              id: selectedFace.id,
-              image: selectedFace.image,
-              confidence: 100, // New person created with full confidence
-              timestamp
-            }
-          ]
-        };
-        
-        // Check if person already exists
-        setRecognizedPersons(prev => {
-          const existingPersonIndex = prev.findIndex(p => p.name === newPersonName.trim());
-          
-          if (existingPersonIndex !== -1) {
-            // Person exists, check if this exact image already exists
-            const isDuplicate = prev[existingPersonIndex].images.some(
-              img => img.image === selectedFace.image
-            );
-            
-            if (!isDuplicate) {
-              // Only add if not a duplicate
-              const updatedPersons = [...prev];
-              updatedPersons[existingPersonIndex].images = [
-                {
-                  id: selectedFace.id,
-                  image: selectedFace.image,
-                  confidence: 100,
-                  timestamp
-                },
-                ...updatedPersons[existingPersonIndex].images
-              ].slice(0, 20); // Keep max 20 images
-              
-              return updatedPersons;
-            }
-            // If duplicate, just return unchanged state
-            return prev;
-          } else {
-            // Add new person
-            return [...prev, newPerson];
-          }
-        });
-      }
+      // Add to recognized persons (the backend records nothing for a duplicate)
+      applyHistoryEvents(response.data.history);
       
       // Notify if it was a duplicate
       if (isDuplicate) {
@@ -629,44 +608,10 @@ const Upload = () => {
       setUnrecognizedPersons(deduplicateUnrecognizedFaces(updatedUnrecognized));
       
       // Check if it was a duplicate
-      const isDuplicate = response.data.is_duplicate;
+      const isDuplicate = response.data.suppressed;
       
-      if (!isDuplicate) {
-        // Add to recognized person immediately (only if not a duplicate)
-        const timestamp = new Date().toLocaleString();
-        
-        setRecognizedPersons(prev => {
-          const existingPersonIndex = prev.findIndex(p => p.name === selectedPersonName);
-          
-          if (existingPersonIndex !== -1) {
-            // Check if this exact image already exists
-            const isDuplicate = prev[existingPersonIndex].images.some(
-              img => img.image === selectedFace.image
-            );
-            
-            if (!isDuplicate) {
-              // Only add if not a duplicate
-              const updatedPersons = [...prev];
-              updatedPersons[existingPersonIndex].images = [
-                {
-                  id: selectedFace.id,
-                  image: selectedFace.image,
-                  confidence: 100,
-                  timestamp
-                },
-                ...updatedPersons[existingPersonIndex].images
-              ].slice(0, 20); // Keep max 20 images
-              
-              return updatedPersons;
-            }
-            // If duplicate, just return unchanged state
-            return prev;
-          }
-          
-          // Should never reach here, but just in case
-          return prev;
-        });
-      }
+      // Add to the recognized person (the backend records nothing for a duplicate)
+      applyHistoryEvents(response.data.history);
       
       // Notify if it was a duplicate
       if (isDuplicate) {
@@ -841,6 +786,9 @@ const Upload = () => {
               </div>
             ))
           )}
+          {historyCursor && (
+            <button className="load-more-btn" onClick={loadMoreHistory}>Load more</button>
+          )}
         </div>
       </div>
       
@@ -894,9 +842,9 @@ const Upload = () => {
                 <h3>Recognition Results:</h3>
                 <div className="results-list">
                   {results.map((result, index) => (
-                    <div key={index} className="result-item" onClick={() => openImageModal(result.face_image)} style={{cursor: 'pointer'}}>
+                    <div key={index} className="result-item" onClick={() => openImageModal(result.face_image_url || result.face_image)} style={{cursor: 'pointer'}}>
                       <div className="result-image">
-                        <img src={result.face_image} alt="Face" />
+                        <img src={result.face_image_url || result.face_image} alt="Face" />
                       </div>
                       <div className="result-details">
                         <div className="result-name">{result.name}</div>